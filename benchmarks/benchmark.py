@@ -0,0 +1,141 @@
+"""
+Benchmarks the stack operations of zebr0_lxd.Client (or zebr0_lxd.aio.AsyncClient) against zebr0_lxd.testing.TestServer.
+
+For each stack size (number of instances, sharing one storage pool, one network and one profile), it measures the wall-clock time,
+the number of API requests and the peak memory allocated by create_stack, start_stack, stop_stack and delete_stack,
+then compares them to a stored baseline and exits with 1 if any of them regressed.
+
+usage: python3 benchmarks/benchmark.py [-h] [--sizes <n> [<n> ...]] [--jobs <n>] [--latency <seconds>] [--operation-latency <seconds>] [--async] [--baseline <path>] [--save] [--tolerance <ratio>]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import zebr0_lxd  # noqa: E402
+from zebr0_lxd.testing import TestServer  # noqa: E402
+
+BASELINE_DEFAULT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+COMMANDS = ["create", "start", "stop", "delete"]
+
+
+def build_stack(size: int) -> dict:
+    """
+    :param size: number of instances
+    :return: a stack with the given number of instances, sharing one storage pool, one network and one profile
+    """
+
+    return {
+        "storage-pools": [{"name": "bench-storage-pool", "driver": "dir"}],
+        "networks": [{"name": "bench-network"}],
+        "profiles": [{"name": "bench-profile", "devices": {"root": {"path": "/", "pool": "bench-storage-pool", "type": "disk"},
+                                                           "eth0": {"type": "nic", "nictype": "bridged", "parent": "bench-network"}}}],
+        "instances": [{"name": f"bench-instance-{index}", "profiles": ["bench-profile"], "source": {"type": "none"}} for index in range(size)]
+    }
+
+
+def measure(server: TestServer, function) -> dict:
+    """
+    :param server: the server the function talks to
+    :param function: the function to measure
+    :return: the wall-clock time in seconds, the number of requests and the peak memory in bytes of the function's call
+    """
+
+    requests = server.count()
+    tracemalloc.start()
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        function()
+    duration = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"time": round(duration, 4), "requests": server.count() - requests, "memory": peak}
+
+
+def run(sizes, jobs: int, latency: float, operation_latency: float, use_async: bool) -> dict:
+    """
+    :return: the measures, indexed by "<command>-<size>"
+    """
+
+    results = {}
+    for size in sizes:
+        stack = build_stack(size)
+        with TestServer(latency, operation_latency) as server:
+            if use_async:
+                from zebr0_lxd.aio import AsyncClient
+                loop = asyncio.new_event_loop()
+                client = AsyncClient(server.url)
+                for command in COMMANDS:
+                    results[f"{command}-{size}"] = measure(server, lambda: loop.run_until_complete(getattr(client, command + "_stack")(stack, jobs)))
+                client.transport.close()
+                loop.close()
+            else:
+                client = zebr0_lxd.Client(server.url, pool_size=max(jobs, 10))
+                for command in COMMANDS:
+                    results[f"{command}-{size}"] = measure(server, lambda: getattr(client, command + "_stack")(stack, jobs))
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    :param results: the current measures
+    :param baseline: the reference measures
+    :param tolerance: ratio above which an increase of time or memory is a regression (any increase of the number of requests is)
+    :return: the regressions, as human-readable strings
+    """
+
+    regressions = []
+    for key, result in results.items():
+        reference = baseline.get(key)
+        if not reference:
+            continue
+        if result.get("requests") > reference.get("requests"):
+            regressions.append(f"{key}: {result.get('requests')} requests instead of {reference.get('requests')}")
+        for metric in ("time", "memory"):
+            if result.get(metric) > reference.get(metric) * (1 + tolerance):
+                regressions.append(f"{key}: {metric} {result.get(metric)} instead of {reference.get(metric)}")
+    return regressions
+
+
+def main() -> None:
+    argparser = argparse.ArgumentParser(description="Benchmarks the stack operations against a stand-in LXD API.")
+    argparser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100, 1000], help="numbers of instances in the stacks, defaults to 1 10 100 1000", metavar="<n>")
+    argparser.add_argument("--jobs", type=int, default=1, help="maximum number of resources processed concurrently, defaults to 1", metavar="<n>")
+    argparser.add_argument("--latency", type=float, default=0.001, help="in seconds, how long each request takes, defaults to 0.001", metavar="<seconds>")
+    argparser.add_argument("--operation-latency", type=float, default=0.01, help="in seconds, how long each asynchronous operation takes, defaults to 0.01", metavar="<seconds>")
+    argparser.add_argument("--async", dest="use_async", action="store_true", help="benchmarks the AsyncClient instead of the Client")
+    argparser.add_argument("--baseline", default=BASELINE_DEFAULT, help="path to the baseline, defaults to benchmarks/baseline.json", metavar="<path>")
+    argparser.add_argument("--save", action="store_true", help="saves the results as the new baseline")
+    argparser.add_argument("--tolerance", type=float, default=0.2, help="ratio above which an increase of time or memory is a regression, defaults to 0.2", metavar="<ratio>")
+    args = argparser.parse_args()
+
+    results = run(args.sizes, args.jobs, args.latency, args.operation_latency, args.use_async)
+
+    print(f"{'benchmark':<16}{'time (s)':>12}{'requests':>12}{'memory (kB)':>14}")
+    for key, result in results.items():
+        print(f"{key:<16}{result.get('time'):>12}{result.get('requests'):>12}{result.get('memory') // 1024:>14}")
+
+    if args.save:
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"baseline saved to {args.baseline}")
+    elif os.path.isfile(args.baseline):
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print("regression: " + regression)
+        if regressions:
+            exit(1)
+    else:
+        print(f"no baseline found at {args.baseline}, use --save to create one")
+
+
+if __name__ == "__main__":
+    main()
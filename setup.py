@@ -28,6 +28,7 @@ setuptools.setup(
     install_requires=[
         "zebr0",
         "PyYAML",
+        "requests",
         "requests-unixsocket"
     ]
 )
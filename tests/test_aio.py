@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from zebr0_lxd import Resource
+from zebr0_lxd.aio import AsyncClient, UnixTransport
+from zebr0_lxd.testing import TestServer
+
+LXD_STACK = {
+    "storage-pools": [{"name": "test-storage-pool", "driver": "dir"}],
+    "networks": [{"name": "test-network"}],
+    "profiles": [{"name": "test-profile", "devices": {"root": {"path": "/", "pool": "test-storage-pool", "type": "disk"}}}],
+    "instances": [{"name": "test-instance-1", "profiles": ["test-profile"], "source": {"type": "none"}},
+                  {"name": "test-instance-2", "profiles": ["test-profile"], "source": {"type": "none"}}]
+}
+
+
+def read_response(data: bytes):
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await UnixTransport.read_response(reader)
+
+    return asyncio.run(read())
+
+
+def test_read_response_content_length():
+    assert read_response(b'HTTP/1.1 200 OK\r\nContent-Length: 15\r\n\r\n{"metadata": 1}') == (200, True, b'{"metadata": 1}')
+
+
+def test_read_response_chunked():
+    assert read_response(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n5\r\n{"met\r\na\r\nadata": 1}\r\n0\r\n\r\n') == (200, True, b'{"metadata": 1}')
+
+
+def test_read_response_connection_close():
+    assert read_response(b'HTTP/1.1 404 Not Found\r\nConnection: close\r\nContent-Length: 2\r\n\r\n{}') == (404, False, b'{}')
+
+
+def test_read_response_until_eof():
+    assert read_response(b'HTTP/1.1 500 Internal Server Error\r\n\r\n{"error": "boom"}') == (500, False, b'{"error": "boom"}')
+
+
+def test_read_response_truncated():
+    with pytest.raises(asyncio.IncompleteReadError):
+        read_response(b'HTTP/1.1 200 OK\r\nContent-Length: 15\r\n\r\n{"meta')
+
+
+def test_stack_lifecycle():
+    with TestServer(operation_latency=0.01) as server:
+        async def lifecycle():
+            async with AsyncClient(server.url) as client:
+                await client.create_stack(LXD_STACK)
+                assert {resource: sorted(resources) for resource, resources in server.resources.items()} == {
+                    "storage-pools": ["test-storage-pool"], "networks": ["test-network"], "profiles": ["test-profile"], "instances": ["test-instance-1", "test-instance-2"]
+                }
+                assert server.requests.get(("GET", "instances")) == 1  # a single listing for all the existence checks
+
+                await client.start_stack(LXD_STACK)
+                assert all(instance.get("status") == "Running" for instance in server.resources.get(Resource.INSTANCES).values())
+
+                await client.stop_stack(LXD_STACK)
+                assert all(instance.get("status") == "Stopped" for instance in server.resources.get(Resource.INSTANCES).values())
+
+                await client.delete_stack(LXD_STACK)
+                assert all(not resources for resources in server.resources.values())
+
+        asyncio.run(lifecycle())
+
+
+def test_resource_lifecycle():
+    with TestServer() as server:
+        async def lifecycle():
+            async with AsyncClient(server.url) as client:
+                assert not await client.exists(Resource.INSTANCES, "test-instance")
+
+                await client.create(Resource.INSTANCES, {"name": "test-instance", "source": {"type": "none"}})
+                assert await client.exists(Resource.INSTANCES, "test-instance") and not await client.is_running("test-instance")
+
+                await client.start("test-instance")
+                assert await client.is_running("test-instance")
+
+                await client.stop("test-instance")
+                assert not await client.is_running("test-instance")
+
+                await client.delete(Resource.INSTANCES, "test-instance")
+                assert not await client.exists(Resource.INSTANCES, "test-instance")
+
+        asyncio.run(lifecycle())
@@ -65,6 +65,10 @@ instances:
     alias: focal
 """.lstrip()
 
+DOWNLOAD_OUTPUT = """
+downloading images/{"type": "image", "mode": "pull", "server": "https://cloud-images.ubuntu.com/releases", "protocol": "simplestreams", "alias": "focal"}
+""".lstrip()
+
 OK_OUTPUT1 = """
 checking storage-pools/test-storage-pool
 creating storage-pools/{"name": "test-storage-pool", "driver": "dir"}
@@ -102,7 +106,7 @@ def test_ok(server, capsys):
     server.data = {"lxd-stack": LXD_STACK}
 
     zebr0_lxd.main("create -u http://localhost:8000".split())
-    assert capsys.readouterr().out == OK_OUTPUT1
+    assert capsys.readouterr().out in (DOWNLOAD_OUTPUT + OK_OUTPUT1, OK_OUTPUT1)  # the image is only downloaded if LXD doesn't have it yet
 
     zebr0_lxd.main("start -u http://localhost:8000".split())
     assert capsys.readouterr().out == OK_OUTPUT2
@@ -130,3 +134,16 @@ def test_ko_not_a_stack(server, capsys):
         zebr0_lxd.main("create -u http://localhost:8000".split())
     assert e.value.code == 1
     assert capsys.readouterr().out == "key 'lxd-stack' on server http://localhost:8000 is not a proper yaml or json dictionary\n"
+
+
+@pytest.mark.parametrize("stack, message", [
+    ("instances: [{name: 'test-${index}', loop: {index: '1..$size'}}]", "loop variable index is not a list or a range of integers ('1..$size')"),
+    ("instances: [{name: 'test-${index}', loop: {index: '1..2'}}, {name: test-2}]", "instances/test-2 is defined more than once")
+])
+def test_ko_not_a_proper_rendering(server, capsys, stack, message):
+    server.data = {"lxd-stack": stack}
+
+    with pytest.raises(SystemExit) as e:
+        zebr0_lxd.main("create -u http://localhost:8000".split())
+    assert e.value.code == 1
+    assert capsys.readouterr().out == f"key 'lxd-stack' on server http://localhost:8000 is not a proper stack: {message}\n"
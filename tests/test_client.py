@@ -12,6 +12,11 @@ def client():
     return zebr0_lxd.Client()
 
 
+@pytest.fixture(scope="module", autouse=True)
+def log_to_stdout():
+    zebr0_lxd.configure_logging()
+
+
 @pytest.fixture(autouse=True)
 def clean_before_and_after():
     def clean():
@@ -0,0 +1,83 @@
+import http.server
+import json
+import socketserver
+import ssl
+import subprocess
+import threading
+
+import pytest
+
+import zebr0_lxd
+from zebr0_lxd import Resource
+
+
+@pytest.fixture(scope="module")
+def certificates(tmp_path_factory):
+    """
+    Generates self-signed certificates for the server and the client.
+
+    :return: the directory containing server.crt, server.key, client.crt and client.key
+    """
+
+    path = tmp_path_factory.mktemp("certificates")
+    for name in ["server", "client"]:
+        subprocess.run(f"openssl req -x509 -newkey rsa:2048 -nodes -days 1 -subj /CN=localhost -addext subjectAltName=DNS:localhost -keyout {path}/{name}.key -out {path}/{name}.crt", shell=True, check=True, capture_output=True)
+    return path
+
+
+@pytest.fixture(scope="module")
+def server(certificates):
+    """
+    Starts a stand-in LXD API over HTTPS, requiring the client certificate and counting the TLS connections.
+
+    :return: the server, whose "connections" attribute is the number of connections accepted
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive
+
+        def do_GET(self):
+            body = json.dumps({"type": "sync", "metadata": ["/1.0/profiles/default"]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_):
+            pass
+
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+        connections = 0
+
+        def get_request(self):
+            self.connections += 1
+            return super().get_request()
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(f"{certificates}/server.crt", f"{certificates}/server.key")
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.load_verify_locations(f"{certificates}/client.crt")
+
+    server = Server(("localhost", 0), Handler)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+
+def test_https(certificates, server):
+    client = zebr0_lxd.Client(f"https://localhost:{server.server_address[1]}", cert=(f"{certificates}/client.crt", f"{certificates}/client.key"), verify=f"{certificates}/server.crt")
+
+    assert client.exists(Resource.PROFILES, "default")
+    assert not client.exists(Resource.PROFILES, "test-profile")
+    assert client.exists(Resource.PROFILES, "default")
+    assert server.connections == 1  # a single handshake for all the requests
+
+
+def test_https_ko_no_client_certificate(certificates, server):
+    client = zebr0_lxd.Client(f"https://localhost:{server.server_address[1]}", verify=f"{certificates}/server.crt")
+
+    with pytest.raises(Exception):
+        client.exists(Resource.PROFILES, "default")
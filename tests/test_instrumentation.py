@@ -0,0 +1,59 @@
+import io
+import json
+
+from zebr0_lxd.instrumentation import Instrumentation, JsonLinesExporter
+
+
+def test_record():
+    instrumentation = Instrumentation()
+    instrumentation.record("request", 0.25, method="GET", resource="instances")
+    instrumentation.record("request", 0.5, method="GET", resource="instances")
+    instrumentation.record("server", 0.5, method="GET", resource="instances")
+    with instrumentation.span("phase", name="create_stack"):
+        pass
+
+    assert instrumentation.counts.get(("request", (("method", "GET"), ("resource", "instances")))) == 2
+    assert instrumentation.total("request") == 0.75
+    assert instrumentation.total("server") == 0.5
+    assert instrumentation.counts.get(("phase", (("name", "create_stack"),))) == 1
+
+
+def test_report():
+    instrumentation = Instrumentation()
+    instrumentation.record("request", 0.75, method="GET", resource="instances")
+    instrumentation.record("server", 0.5, method="GET", resource="instances")
+
+    assert instrumentation.report().splitlines()[1:] == [
+        "request   method=GET resource=instances                  1       0.750       750.0",
+        "server    method=GET resource=instances                  1       0.500       500.0",
+        "requests: 0.750s, of which 0.500s waiting for LXD and 0.250s in the client and socket",
+        "operations: 0.000s waiting for asynchronous operations"
+    ]
+
+
+def test_prometheus():
+    instrumentation = Instrumentation()
+    instrumentation.record("request", 0.25, method="GET", resource="instances")
+    instrumentation.record("operation", 1.5, name="wait_all")
+
+    assert instrumentation.prometheus() == """
+# TYPE zebr0_lxd_operation_total counter
+zebr0_lxd_operation_total{name="wait_all"} 1
+# TYPE zebr0_lxd_operation_seconds_total counter
+zebr0_lxd_operation_seconds_total{name="wait_all"} 1.5
+# TYPE zebr0_lxd_request_total counter
+zebr0_lxd_request_total{method="GET",resource="instances"} 1
+# TYPE zebr0_lxd_request_seconds_total counter
+zebr0_lxd_request_seconds_total{method="GET",resource="instances"} 0.25
+""".lstrip()
+
+
+def test_json_lines_exporter():
+    file = io.StringIO()
+    instrumentation = Instrumentation()
+    instrumentation.listeners.append(JsonLinesExporter(file))
+    instrumentation.record("request", 0.25, method="GET", resource="instances")
+
+    measure = json.loads(file.getvalue())
+    assert file.getvalue().endswith("\n")
+    assert {key: value for key, value in measure.items() if key != "time"} == {"kind": "request", "duration": 0.25, "method": "GET", "resource": "instances"}
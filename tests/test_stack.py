@@ -1,4 +1,10 @@
+import io
+import json
+import ssl
+import sys
+
 import pytest
+import requests
 
 import zebr0_lxd
 
@@ -22,10 +28,10 @@ def mock_client(monkeypatch):
     def mock_create(_, resource, config):
         log.append(("create", resource, config))
 
-    def mock_start(_, name):
+    def mock_start(_, name, wait=True):
         log.append(("start", name))
 
-    def mock_stop(_, name):
+    def mock_stop(_, name, wait=True, force=False, timeout=None):
         log.append(("stop", name))
 
     def mock_delete(_, resource, name):
@@ -101,3 +107,432 @@ def test_delete_containers_only(client, mock_client):
     client.delete_stack(CONTAINERS_ONLY)
     assert mock_client == [("delete", "instances", "test-instance-1"),
                            ("delete", "instances", "test-instance-2")]
+
+
+DEPENDENT_STACK = {
+    "storage-pools": [{"name": "test-storage-pool", "driver": "dir"}],
+    "networks": [{"name": "test-network"}],
+    "profiles": [{"name": "test-profile", "devices": {"root": {"path": "/", "pool": "test-storage-pool", "type": "disk"}}},
+                 {"name": "test-profile-2", "devices": {"eth0": {"type": "nic", "nictype": "bridged", "parent": "test-network"}}}],
+    "instances": [{"name": "test-instance-1", "profiles": ["default", "test-profile"], "source": {"type": "none"}},
+                  {"name": "test-instance-2", "profiles": ["test-profile-2"], "source": {"type": "none"}}]
+}
+
+
+def test_build_graph():
+    graph = zebr0_lxd.build_graph(DEPENDENT_STACK)
+
+    assert [key for key in graph] == [("storage-pools", "test-storage-pool"),
+                                      ("networks", "test-network"),
+                                      ("profiles", "test-profile"),
+                                      ("profiles", "test-profile-2"),
+                                      ("instances", "test-instance-1"),
+                                      ("instances", "test-instance-2")]
+    assert graph[("storage-pools", "test-storage-pool")].dependencies == set()
+    assert graph[("profiles", "test-profile")].dependencies == {("storage-pools", "test-storage-pool")}
+    assert graph[("profiles", "test-profile-2")].dependencies == {("networks", "test-network")}
+    assert graph[("instances", "test-instance-1")].dependencies == {("profiles", "test-profile")}  # "default" isn't part of the stack
+    assert graph[("instances", "test-instance-2")].dependencies == {("profiles", "test-profile-2")}
+
+
+def test_create_stack_jobs(client, mock_client):
+    client.create_stack(DEPENDENT_STACK, jobs=4)
+
+    names = [call[2].get("name") for call in mock_client]
+    assert sorted(names) == sorted(node.name for node in zebr0_lxd.build_graph(DEPENDENT_STACK).values())
+    assert names.index("test-storage-pool") < names.index("test-profile") < names.index("test-instance-1")
+    assert names.index("test-network") < names.index("test-profile-2") < names.index("test-instance-2")
+
+
+def test_delete_stack_jobs(client, mock_client):
+    client.delete_stack(DEPENDENT_STACK, jobs=4)
+
+    names = [call[2] for call in mock_client]
+    assert sorted(names) == sorted(node.name for node in zebr0_lxd.build_graph(DEPENDENT_STACK).values())
+    assert names.index("test-instance-1") < names.index("test-profile") < names.index("test-storage-pool")
+    assert names.index("test-instance-2") < names.index("test-profile-2") < names.index("test-network")
+
+
+def test_execute_failure():
+    def fail(node):
+        if node.name == "test-storage-pool":
+            raise Exception("failure")
+
+    processed = []
+    with pytest.raises(Exception) as exception:
+        zebr0_lxd.execute(zebr0_lxd.build_graph(DEPENDENT_STACK), lambda node: fail(node) or processed.append(node.name), jobs=4)
+
+    assert str(exception.value) == "failure"
+    assert "test-profile" not in processed and "test-instance-1" not in processed
+
+
+def test_execute_copy_before_source():
+    graph = zebr0_lxd.build_graph({"instances": [{"name": "b", "source": {"type": "copy", "source": "a"}}, {"name": "a", "source": {"type": "none"}}, {"name": "c", "source": {"type": "none"}}]})
+
+    processed = []
+    zebr0_lxd.execute(graph, lambda node: processed.append(node.name))
+    assert processed == ["a", "b", "c"]  # the source first, the rest in the stack's order
+
+    processed.clear()
+    zebr0_lxd.execute(graph, lambda node: processed.append(node.name), reverse=True)
+    assert processed == ["b", "a", "c"]  # the copy first
+
+
+def test_execute_replicas_reverse():
+    graph = zebr0_lxd.build_graph({"instances": [{"name": "w-{index}", "replicas": "3", "clone": "copy", "source": {"type": "none"}}]})
+
+    processed = []
+    zebr0_lxd.execute(graph, lambda node: processed.append(node.name), reverse=True)
+    assert processed == ["w-2", "w-3", "w-1"]  # the copies before their source
+
+
+def test_snapshot(monkeypatch):
+    calls = []
+
+    def mock_list(_, resource):
+        calls.append(resource)
+        return {"test-instance-1": {"name": "test-instance-1", "status": "Running"}} if resource == "instances" else {}
+
+    monkeypatch.setattr(zebr0_lxd.Client, "list", mock_list)
+    client = zebr0_lxd.Client()
+
+    with client.snapshot() as inventory:
+        assert client.exists(zebr0_lxd.Resource.INSTANCES, "test-instance-1")
+        assert not client.exists(zebr0_lxd.Resource.INSTANCES, "test-instance-2")
+        assert client.is_running("test-instance-1")
+        assert not client.exists(zebr0_lxd.Resource.PROFILES, "test-profile")
+
+        with client.snapshot() as nested:
+            assert nested is inventory
+
+        inventory.discard(zebr0_lxd.Resource.INSTANCES, "test-instance-1")
+        assert not client.exists(zebr0_lxd.Resource.INSTANCES, "test-instance-1")
+
+    assert client.inventory is None
+    assert calls == ["instances", "profiles"]  # a single call per resource type
+
+
+def test_wait_all():
+    class Response:
+        def __init__(self, value):
+            self.value = value
+
+        def json(self):
+            return self.value
+
+    class Session:
+        polls = 0
+
+        def get(self, url):
+            assert url.endswith("/1.0/operations?recursion=1")
+            self.polls += 1
+            return Response({"metadata": {
+                "success": [{"id": "1", "status": "Success", "status_code": 200}],
+                "failure": [{"id": "2", "status": "Failure", "status_code": 400, "err": "boom"}] if self.polls > 1 else [],
+                "running": [{"id": "2", "status": "Running", "status_code": 103}] if self.polls == 1 else []
+            }})
+
+    client = zebr0_lxd.Client()
+    client.session = Session()
+    operations = [zebr0_lxd.Operation(client, "/1.0/operations/" + key, {"id": key, "status_code": 103}) for key in ("1", "2")]
+
+    with pytest.raises(Exception) as exception:
+        client.wait_all(operations + [None])
+
+    assert str(exception.value) == "operation 2 failure: boom"
+    assert client.session.polls == 2
+    assert operations[0].done() and operations[1].done()
+
+
+@pytest.mark.parametrize("method, error, expected", [
+    ("GET", zebr0_lxd.RequestError("GET", "/1.0/instances", 503, '{"error": "Service Unavailable"}'), True),
+    ("PUT", zebr0_lxd.RequestError("PUT", "/1.0/instances/test-instance/state", 400, '{"error": "Instance is busy running a \\"start\\" operation"}'), True),
+    ("DELETE", ConnectionResetError(), True),
+    ("GET", zebr0_lxd.RequestError("GET", "/1.0/instances/test-instance", 404, '{"error": "Not Found"}'), False),
+    ("POST", zebr0_lxd.RequestError("POST", "/1.0/instances", 503, '{"error": "Service Unavailable"}'), False),  # not idempotent
+    ("GET", ValueError(), False),
+    ("GET", requests.exceptions.SSLError("certificate verify failed"), False),  # a ConnectionError, yet permanent
+    ("GET", ssl.SSLCertVerificationError("certificate verify failed"), False)
+])
+def test_retryable(method, error, expected):
+    assert zebr0_lxd.RetryPolicy().retryable(method, error) == expected
+
+
+def test_expand_replicas():
+    graph = zebr0_lxd.build_graph({"instances": [{"name": "worker-{index}", "replicas": "3", "clone": "snapshot", "source": {"type": "none"}}]})
+
+    assert {name: node.config.get("source") for (_, name), node in graph.items()} == {
+        "worker-1": {"type": "none"},
+        "worker-2": {"type": "copy", "source": "worker-1/" + zebr0_lxd.CLONE_SNAPSHOT, "instance_only": True},
+        "worker-3": {"type": "copy", "source": "worker-1/" + zebr0_lxd.CLONE_SNAPSHOT, "instance_only": True}
+    }
+    assert graph.get((zebr0_lxd.Resource.INSTANCES, "worker-3")).dependencies == {(zebr0_lxd.Resource.INSTANCES, "worker-1")}
+    assert zebr0_lxd.clone_snapshots(graph) == {"worker-1": zebr0_lxd.CLONE_SNAPSHOT}
+
+
+def test_render_stack():
+    template = zebr0_lxd.compile_stack("""
+parameters: {size: '2', image: focal}
+overrides: {production: {size: '3'}}
+instances:
+  - name: test-instance
+    source: {alias: $image}
+  - name: web-${zone}-${index}
+    source: {alias: $image}
+    loop: {zone: [a, b], index: 1..$size}
+""", None)
+
+    stack = zebr0_lxd.render_stack(template, ["mattermost", "production"])
+    assert [config.get("name") for config in stack.get("instances")] == ["test-instance", "web-a-1", "web-a-2", "web-a-3", "web-b-1", "web-b-2", "web-b-3"]
+    assert all(config.get("source") == {"alias": "focal"} for config in stack.get("instances"))  # iterated over again
+    assert len(zebr0_lxd.build_graph(stack)) == 7
+
+    huge = zebr0_lxd.render_stack({"instances": [{"name": "test-instance-$index", "loop": {"index": "1..1000000000"}}]})
+    assert next(iter(huge.get("instances"))) == {"name": "test-instance-1"}  # generated lazily
+
+
+def test_render_stack_dollars():
+    stack = {"instances": [{"name": "test-instance", "config": {"user.user-data": "runcmd: [echo $$ > /pid, echo $$HOME $HOME ${HOME} $ 5$]"}}]}
+    assert list(zebr0_lxd.render_stack(stack).get("instances")) == stack.get("instances")  # not a template, left as is
+
+    template = {"parameters": {"name": "test"}, "instances": [{"name": "$name-instance", "config": {"user.user-data": "echo $$name ${name}"}}]}
+    assert list(zebr0_lxd.render_stack(template).get("instances")) == [{"name": "test-instance", "config": {"user.user-data": "echo $$name test"}}]
+
+
+def test_render_stack_duplicates():
+    template = {"instances": [{"name": "test-instance-${index}", "loop": {"index": "1..2"}}, {"name": "test-instance-2"}]}
+    with pytest.raises(zebr0_lxd.StackError) as exception:
+        zebr0_lxd.build_graph(zebr0_lxd.render_stack(template))
+
+    assert str(exception.value) == "is not a proper stack: instances/test-instance-2 is defined more than once"
+
+    template = {"instances": [{"name": "test-instance", "loop": {"index": "1..2"}}]}  # the variable isn't used in the name
+    with pytest.raises(zebr0_lxd.StackError):
+        zebr0_lxd.build_graph(zebr0_lxd.render_stack(template))
+
+
+@pytest.mark.parametrize("values", ["1..$size", "1..${size}", "a..b", "3"])
+def test_render_stack_ko_range(values):
+    template = {"instances": [{"name": "test-instance-${index}", "loop": {"index": values}}]}
+    with pytest.raises(zebr0_lxd.StackError) as exception:
+        list(zebr0_lxd.render_stack(template).get("instances"))
+
+    assert str(exception.value).startswith("is not a proper stack: loop variable index is not a list or a range of integers")
+
+
+def test_merge_stacks():
+    shared = {"name": "test-profile"}
+    stack, references = zebr0_lxd.merge_stacks([
+        {"profiles": [shared], "instances": [{"name": "test-instance-1", "profiles": ["test-profile"]}]},
+        {"profiles": [shared], "instances": [{"name": "test-instance-2", "profiles": ["test-profile"]}]}
+    ])
+
+    assert stack.get("profiles") == [shared]  # once
+    assert [config.get("name") for config in stack.get("instances")] == ["test-instance-1", "test-instance-2"]
+    assert references.get((zebr0_lxd.Resource.PROFILES, "test-profile")) == 2 and references.get((zebr0_lxd.Resource.INSTANCES, "test-instance-1")) == 1
+
+
+def test_merge_stacks_ko():
+    with pytest.raises(zebr0_lxd.StackError) as exception:
+        zebr0_lxd.merge_stacks([{"profiles": [{"name": "test-profile"}]}, {"profiles": [{"name": "test-profile", "config": {"limits.cpu": "2"}}]}])
+
+    assert str(exception.value) == "is not a proper stack: profiles/test-profile is defined differently in another stack"
+
+
+def test_strip_generated():
+    live = {"name": "test-instance", "status": "Running", "status_code": 103, "created_at": "2021-01-01T00:00:00Z", "description": "", "ephemeral": False, "profiles": [],
+            "config": {"limits.cpu": "2", "volatile.base_image": "abcdef", "image.os": "ubuntu"}, "devices": {}, "expanded_config": {"limits.cpu": "2"}}
+
+    assert zebr0_lxd.strip_generated(zebr0_lxd.Resource.INSTANCES, live) == {
+        "name": "test-instance", "profiles": [], "config": {"limits.cpu": "2"}, "source": {"type": "image", "fingerprint": "abcdef"}
+    }
+
+
+def test_diff():
+    desired = {"name": "test-instance", "source": {"type": "none"}, "profiles": ["default"],
+               "config": {"limits.cpu": "2", "limits.memory": "1GB"},
+               "devices": {"eth0": {"type": "nic", "network": "lxdbr0"}}}
+    live = {"name": "test-instance", "source": {"type": "image"}, "profiles": ["default"], "status": "Running",
+            "config": {"limits.cpu": "1", "limits.memory": "1GB", "volatile.uuid": "42"},
+            "devices": {"eth0": {"type": "nic", "network": "lxdbr1"}, "root": {"type": "disk"}}}
+
+    assert zebr0_lxd.diff(desired, live) == {"config": {"limits.cpu": "2"}, "devices": {"eth0": {"type": "nic", "network": "lxdbr0"}}}
+    assert zebr0_lxd.diff(desired, dict(live, config={"limits.cpu": "2", "limits.memory": "1GB"}, devices={"eth0": {"type": "nic", "network": "lxdbr0"}})) == {}
+
+
+def test_plan_stack(monkeypatch):
+    live = {
+        "storage-pools": {"test-storage-pool": {"name": "test-storage-pool", "driver": "dir", "config": {"source": "/somewhere"}}},
+        "networks": {},
+        "profiles": {"test-profile": {"name": "test-profile", "config": {}, "devices": {}}},
+        "instances": {}
+    }
+    monkeypatch.setattr(zebr0_lxd.Client, "list", lambda _, resource: live.get(resource))
+
+    assert zebr0_lxd.Client().plan_stack(DEPENDENT_STACK) == [
+        ("create", "networks", "test-network", {"name": "test-network"}),
+        ("update", "profiles", "test-profile", {"devices": {"root": {"path": "/", "pool": "test-storage-pool", "type": "disk"}}}),
+        ("create", "profiles", "test-profile-2", DEPENDENT_STACK.get("profiles")[1]),
+        ("create", "instances", "test-instance-1", DEPENDENT_STACK.get("instances")[0]),
+        ("create", "instances", "test-instance-2", DEPENDENT_STACK.get("instances")[1])
+    ]
+
+
+def test_run_fleet():
+    def function(client):
+        assert client.logger.extra == {"host": client.url}  # the logs are attributed to the host
+        if "failing" in client.url:
+            raise Exception("failure")
+
+    results = zebr0_lxd.run_fleet(["https://host-1:8443", "https://failing-host:8443", "https://host-2:8443"], function, jobs=2)
+
+    assert list(results.keys()) == ["https://host-1:8443", "https://failing-host:8443", "https://host-2:8443"]
+    assert results.get("https://host-1:8443") is None and results.get("https://host-2:8443") is None
+    assert str(results.get("https://failing-host:8443")) == "failure"
+
+
+def test_read_hosts(tmp_path):
+    hosts = tmp_path.joinpath("hosts")
+    hosts.write_text("# local host\nhttp+unix://%2Fvar%2Fsnap%2Flxd%2Fcommon%2Flxd%2Funix.socket\n\n  https://remote:8443  \n")
+
+    assert zebr0_lxd.read_hosts(str(hosts)) == ["http+unix://%2Fvar%2Fsnap%2Flxd%2Fcommon%2Flxd%2Funix.socket", "https://remote:8443"]
+
+
+def test_stop_stack_batched(monkeypatch):
+    log = []
+    monkeypatch.setattr(zebr0_lxd.Client, "stop", lambda _, name, wait=True, force=False, timeout=None: log.append(("stop", name, wait, force, timeout)) or name)
+    monkeypatch.setattr(zebr0_lxd.Client, "wait_all", lambda _, operations: log.append(("wait_all", operations)))
+
+    zebr0_lxd.Client().stop_stack(CONTAINERS_ONLY, force=True, timeout=30)
+    assert log == [("stop", "test-instance-1", False, True, 30),
+                   ("stop", "test-instance-2", False, True, 30),
+                   ("wait_all", ["test-instance-1", "test-instance-2"])]
+
+
+@pytest.mark.parametrize("stack, error", [
+    ("not a stack", "is not a proper yaml or json dictionary"),
+    ("[unclosed", "is not a proper yaml or json dictionary"),
+    ("containers: []", "is not a proper stack: unknown element(s) containers"),
+    ("instances: {name: test-instance}", "is not a proper stack: instances is not a list"),
+    ("instances: [test-instance]", "is not a proper stack: instances[0] is not a dictionary"),
+    ("instances: [{source: {type: none}}]", "is not a proper stack: instances[0] has no name"),
+    ("instances: [{name: test-instance}, {name: test-instance}]", "is not a proper stack: instances[1] has a duplicate name 'test-instance'"),
+    ("storage-pools: [{name: test-storage-pool}]", "is not a proper stack: storage-pools[0] has no driver"),
+    ("profiles: [{name: test-profile, devices: [root]}]", "is not a proper stack: profiles[0].devices is not a dictionary"),
+    ("profiles: [{name: test-profile, devices: {root: disk}}]", "is not a proper stack: profiles[0].devices has a device that is not a dictionary"),
+    ("instances: [{name: test-instance, profiles: test-profile}]", "is not a proper stack: instances[0].profiles is not a list of names"),
+    ("profiles: [{name: 'test-profile-{index}', replicas: 2}]", "is not a proper stack: profiles[0] has replicas but isn't an instance"),
+    ("instances: [{name: 'test-instance-{index}', replicas: many}]", "is not a proper stack: instances[0].replicas is not a positive integer"),
+    ("instances: [{name: test-instance, replicas: 2}]", "is not a proper stack: instances[0] has replicas but its name has no {index} placeholder"),
+    ("instances: [{name: 'test-instance-{index}', replicas: 2, clone: fork}]", "is not a proper stack: instances[0].clone is not one of none, copy, snapshot"),
+    ("parameters: [size]", "is not a proper stack: parameters is not a dictionary"),
+    ("overrides: {production: 10}", "is not a proper stack: overrides is not a dictionary of parameters per level"),
+    ("instances: [{name: test-instance, loop: {index: 10}}]", "is not a proper stack: instances[0].loop is not a dictionary of lists or ranges")
+])
+def test_compile_stack_ko(stack, error):
+    with pytest.raises(zebr0_lxd.StackError) as exception:
+        zebr0_lxd.compile_stack(stack, None)
+
+    assert str(exception.value) == error
+
+
+def test_compile_stack(tmp_path, monkeypatch):
+    value = "config: {}\ninstances:\n- name: test-instance\n  source: {type: none}\n  ephemeral: true\nprofiles:\n"
+    expected = {"storage-pools": [], "networks": [], "profiles": [], "instances": [{"name": "test-instance", "source": {"type": "none"}, "ephemeral": "true"}]}
+
+    assert zebr0_lxd.compile_stack(value, str(tmp_path)) == expected
+    assert len(list(tmp_path.iterdir())) == 1
+
+    monkeypatch.setattr(zebr0_lxd, "validate_stack", None)  # the second call mustn't parse nor validate again
+    assert zebr0_lxd.compile_stack(value, str(tmp_path)) == expected
+
+    monkeypatch.setattr(zebr0_lxd, "STACK_FORMAT", zebr0_lxd.STACK_FORMAT + 1)  # a new version validates again
+    with pytest.raises(TypeError):
+        zebr0_lxd.compile_stack(value, str(tmp_path))
+
+
+@pytest.fixture
+def reset_logging():
+    yield
+    for handler in list(zebr0_lxd.logger.handlers):
+        if isinstance(handler, zebr0_lxd.StdoutHandler):
+            zebr0_lxd.logger.removeHandler(handler)
+    zebr0_lxd.logger.setLevel("NOTSET")
+
+
+def test_configure_logging(monkeypatch, capsys, reset_logging):
+    monkeypatch.setattr(zebr0_lxd.Client, "list", lambda _, resource: {})
+    monkeypatch.setattr(zebr0_lxd.Client, "operation", lambda _, response: None)
+    client = zebr0_lxd.Client()
+    monkeypatch.setattr(client.session, "post", lambda url, json: None)
+
+    zebr0_lxd.configure_logging()
+    client.create_stack({"profiles": [{"name": "test-profile"}]})
+    assert capsys.readouterr().out == 'checking profiles/test-profile\ncreating profiles/{"name": "test-profile"}\n'
+
+    zebr0_lxd.configure_logging("json")
+    client.create_stack({"profiles": [{"name": "test-profile"}]})
+    events = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [{key: value for key, value in event.items() if key != "time"} for event in events] == [
+        {"level": "info", "message": "checking profiles/test-profile", "action": "check", "resource": "profiles", "name": "test-profile"},
+        {"level": "info", "message": 'creating profiles/{"name": "test-profile"}', "action": "create", "resource": "profiles", "name": "test-profile", "config": {"name": "test-profile"}}
+    ]
+
+    zebr0_lxd.configure_logging(quiet=True)
+    client.create_stack({"profiles": [{"name": "test-profile"}]})
+    assert capsys.readouterr().out == ""
+
+
+def test_fetch_values(tmp_path, monkeypatch, caplog):
+    server = {"lxd-stack": "instances: []", "other-stack": "profiles: []"}
+
+    class MockClient:
+        def __init__(self, url, levels, cache, configuration_file):
+            pass
+
+        def get(self, key):
+            if server is None:
+                raise ConnectionError("server down")
+            return server.get(key, "")
+
+    monkeypatch.setattr(zebr0_lxd.zebr0, "Client", MockClient)
+
+    def fetch(keys):
+        return zebr0_lxd.fetch_values(keys, "http://localhost:8000", [], 300, "", str(tmp_path))
+
+    assert fetch(["lxd-stack", "other-stack", "unknown"]) == {"lxd-stack": "instances: []", "other-stack": "profiles: []", "unknown": ""}
+
+    server = None  # the values previously fetched are served from the cache
+    assert fetch(["lxd-stack", "other-stack"]) == {"lxd-stack": "instances: []", "other-stack": "profiles: []"}
+    assert "key 'lxd-stack' couldn't be fetched from server http://localhost:8000 (server down)" in caplog.text
+
+    with pytest.raises(ConnectionError):
+        fetch(["unknown"])
+
+
+def test_configure_logging_host(capsys, reset_logging):
+    adapter = zebr0_lxd.HostAdapter(zebr0_lxd.logger, {"host": "https://host-1:8443"})
+
+    zebr0_lxd.configure_logging()
+    adapter.info("checking %s/%s", "profiles", "test-profile", extra={"event": {"action": "check"}})
+    assert capsys.readouterr().out == "https://host-1:8443: checking profiles/test-profile\n"
+
+    zebr0_lxd.configure_logging("json")
+    adapter.info("checking %s/%s", "profiles", "test-profile", extra={"event": {"action": "check"}})
+    event = json.loads(capsys.readouterr().out)
+    assert event.get("host") == "https://host-1:8443" and event.get("action") == "check"
+
+
+def test_configure_logging_flush(monkeypatch, reset_logging):
+    class Output(io.StringIO):
+        flushes = 0
+
+        def flush(self):
+            self.flushes += 1
+
+    output = Output()
+    monkeypatch.setattr(sys, "stdout", output)
+
+    zebr0_lxd.configure_logging()
+    zebr0_lxd.logger.info("checking profiles/test-profile")
+    assert output.getvalue() == "checking profiles/test-profile\n" and output.flushes == 1  # not left in the buffer of a piped output
@@ -0,0 +1,399 @@
+import asyncio
+import io
+import json
+import time
+
+import pytest
+
+import zebr0_lxd
+from zebr0_lxd import Resource
+from zebr0_lxd.aio import AsyncClient
+from zebr0_lxd.instrumentation import Trace
+from zebr0_lxd.testing import TestServer
+
+LXD_STACK = {
+    "storage-pools": [{"name": "test-storage-pool", "driver": "dir"}],
+    "networks": [{"name": "test-network"}],
+    "profiles": [{"name": "test-profile", "devices": {"root": {"path": "/", "pool": "test-storage-pool", "type": "disk"}}}],
+    "instances": [{"name": "test-instance-1", "profiles": ["test-profile"], "source": {"type": "none"}},
+                  {"name": "test-instance-2", "profiles": ["test-profile"], "source": {"type": "none"}}]
+}
+
+
+@pytest.fixture
+def server():
+    with TestServer(operation_latency=0.01) as server:
+        yield server
+
+
+def test_stack_lifecycle(server):
+    client = zebr0_lxd.Client(server.url)
+
+    client.create_stack(LXD_STACK, jobs=4)
+    assert {resource: sorted(resources) for resource, resources in server.resources.items()} == {
+        "storage-pools": ["test-storage-pool"], "networks": ["test-network"], "profiles": ["test-profile"], "instances": ["test-instance-1", "test-instance-2"]
+    }
+    assert server.requests.get(("GET", "instances")) == 1  # a single listing for all the existence checks
+
+    client.start_stack(LXD_STACK)
+    assert all(instance.get("status") == "Running" for instance in server.resources.get(Resource.INSTANCES).values())
+
+    client.stop_stack(LXD_STACK)
+    assert all(instance.get("status") == "Stopped" for instance in server.resources.get(Resource.INSTANCES).values())
+
+    client.delete_stack(LXD_STACK, jobs=4)
+    assert all(not resources for resources in server.resources.values())
+
+
+def test_ko_request_failure():
+    with TestServer(failures={("POST", "/1.0/networks"): 500}) as server:
+        with pytest.raises(zebr0_lxd.RequestError) as exception:
+            zebr0_lxd.Client(server.url).create_stack(LXD_STACK)
+
+        assert "injected failure" in str(exception.value)
+        assert exception.value.status_code == 500 and exception.value.method == "POST"
+        assert server.requests.get(("POST", "networks")) == 1  # not idempotent, hence not retried
+        assert not server.resources.get(Resource.PROFILES)  # nothing depending on the network has been created
+
+
+def test_ko_operation_failure():
+    with TestServer(operation_failures={("PUT", "/1.0/instances/test-instance-2/state")}) as server:
+        client = zebr0_lxd.Client(server.url)
+        client.create_stack(LXD_STACK)
+
+        with pytest.raises(zebr0_lxd.OperationError) as exception:
+            client.start_stack(LXD_STACK)
+
+        assert str(exception.value).endswith("failure: injected failure")
+
+
+def test_warm_images(server):
+    source = {"type": "image", "mode": "pull", "server": "https://cloud-images.ubuntu.com/releases", "protocol": "simplestreams", "alias": "focal"}
+    stack = {"instances": [{"name": f"test-instance-{index}", "source": source} for index in range(3)]}
+    client = zebr0_lxd.Client(server.url)
+
+    client.warm_images_stack(stack)
+    assert [image.get("update_source").get("alias") for image in server.images] == ["focal"]  # downloaded once
+    assert server.requests.get(("POST", "images")) == 1
+
+    client.create_stack(stack)
+    assert server.requests.get(("POST", "images")) == 1  # already present
+
+
+def test_warm_images_fingerprint(server):
+    server.images.append({"fingerprint": "beef0123", "update_source": {"server": "https://images.example.com", "protocol": "simplestreams", "alias": "other"}})
+    client = zebr0_lxd.Client(server.url)
+
+    client.warm_images_stack({"instances": [{"name": "test-instance", "source": {"type": "image", "server": "https://images.example.com", "fingerprint": "beef"}}]})
+    assert not server.requests.get(("POST", "images"))  # a fingerprint's prefix is enough
+
+    client.warm_images_stack({"instances": [{"name": "test-instance", "source": {"type": "image", "server": "https://images.example.com", "alias": "beef"}}]})
+    assert server.requests.get(("POST", "images")) == 1  # an alias isn't a fingerprint, even if it looks like one
+
+
+def test_ko_retries():
+    with TestServer(failures={("GET", "/1.0/profiles"): 503}) as server:
+        client = zebr0_lxd.Client(server.url, retry=zebr0_lxd.RetryPolicy(retries=2, backoff=0.01))
+
+        with pytest.raises(zebr0_lxd.RequestError) as exception:
+            client.exists(Resource.PROFILES, "test-profile")
+
+        assert exception.value.status_code == 503
+        assert server.requests.get(("GET", "profiles")) == 3  # the request and its 2 retries
+
+
+def test_ko_operation_timeout():
+    with TestServer(operation_latency=3) as server:
+        client = zebr0_lxd.Client(server.url, retry=zebr0_lxd.RetryPolicy(operation_timeout=0.2))
+
+        with pytest.raises(zebr0_lxd.OperationTimeout) as exception:
+            client.create(Resource.INSTANCES, {"name": "test-instance", "source": {"type": "none"}})
+
+        assert exception.value.status_code == 103  # still running
+
+
+def test_wait_all_purged(server):
+    client = zebr0_lxd.Client(server.url)
+    operations = [client.create(Resource.INSTANCES, {"name": f"test-instance-{index}", "source": {"type": "none"}}, wait=False) for index in range(2)]
+    time.sleep(0.1)
+    with server.lock:
+        server.operations.clear()  # as LXD does a few seconds after they're over
+
+    client.wait_all(operations, timeout=2)
+    assert all(operation.done() for operation in operations)
+
+
+def test_journal_resume(tmp_path):
+    with TestServer(failures={("POST", "/1.0/profiles"): 500}) as server:
+        client = zebr0_lxd.Client(server.url)
+
+        with pytest.raises(zebr0_lxd.RequestError):
+            client.create_stack(LXD_STACK, journal=zebr0_lxd.Journal(str(tmp_path / "checkpoint.jsonl")))
+        assert [line.get("name") for line in map(json.loads, (tmp_path / "checkpoint.jsonl").read_text().splitlines())] == ["test-storage-pool", "test-network"]
+
+        server.failures.clear()
+        server.requests.clear()
+        client.create_stack(LXD_STACK, journal=zebr0_lxd.Journal(str(tmp_path / "checkpoint.jsonl"), resume=True))
+
+        assert len(server.resources.get(Resource.INSTANCES)) == 2
+        assert not server.requests.get(("GET", "storage-pools")) and not server.requests.get(("GET", "networks"))  # done steps aren't checked again
+        assert not (tmp_path / "checkpoint.jsonl").exists()
+
+
+def test_journal_rollback(tmp_path):
+    with TestServer(failures={("POST", "/1.0/profiles"): 500}) as server:
+        client = zebr0_lxd.Client(server.url)
+        client.create(Resource.NETWORKS, {"name": "test-network"})  # already existing, hence kept
+
+        with pytest.raises(zebr0_lxd.RequestError):
+            client.create_stack(LXD_STACK, journal=zebr0_lxd.Journal(str(tmp_path / "checkpoint.jsonl")), rollback=True)
+
+        assert {resource: list(resources) for resource, resources in server.resources.items() if resources} == {"networks": ["test-network"]}
+        assert not (tmp_path / "checkpoint.jsonl").exists()
+
+
+def test_export_stack(server):
+    client = zebr0_lxd.Client(server.url)
+    client.create_stack(LXD_STACK)
+
+    exported = list(client.export_stack("test-instance-1"))
+    assert [(resource, config.get("name")) for resource, config in exported] == [
+        (Resource.STORAGE_POOLS, "test-storage-pool"), (Resource.PROFILES, "test-profile"), (Resource.INSTANCES, "test-instance-1")  # the instance and its dependencies
+    ]
+
+    output = io.StringIO()
+    zebr0_lxd.dump_stack(client.export_stack(), output)
+    assert zebr0_lxd.compile_stack(output.getvalue(), None) == LXD_STACK  # round trip
+
+
+def test_replicas(server):
+    stack = {"instances": [{"name": "worker-{index}", "replicas": "3", "clone": "snapshot", "source": {"type": "none"}}]}
+    client = zebr0_lxd.Client(server.url)
+
+    client.create_stack(stack, jobs=4)
+    assert sorted(server.resources.get(Resource.INSTANCES)) == ["worker-1", "worker-2", "worker-3"]
+    assert server.snapshots == {"worker-1": [zebr0_lxd.CLONE_SNAPSHOT]}  # taken once, before the copies
+
+    client.start_stack(stack)
+    assert all(instance.get("status") == "Running" for instance in server.resources.get(Resource.INSTANCES).values())
+
+    client.stop_stack(stack)
+    client.delete_stack(stack, jobs=4)
+    assert not server.resources.get(Resource.INSTANCES)
+
+
+def test_replicas_async(server):
+    stack = {"instances": [{"name": "worker-{index}", "replicas": "3", "clone": "snapshot", "source": {"type": "none"}}]}
+
+    async def create():
+        async with AsyncClient(server.url) as client:
+            await client.create_stack(stack)
+
+    asyncio.run(create())
+    assert sorted(server.resources.get(Resource.INSTANCES)) == ["worker-1", "worker-2", "worker-3"]
+    assert server.snapshots == {"worker-1": [zebr0_lxd.CLONE_SNAPSHOT]}
+
+
+def test_delete_stacks(server):
+    shared = {"storage-pools": [{"name": "test-storage-pool", "driver": "dir"}],
+              "profiles": [{"name": "test-profile", "devices": {"root": {"path": "/", "pool": "test-storage-pool", "type": "disk"}}}]}
+    stack_1 = dict(shared, instances=[{"name": "test-instance-1", "profiles": ["test-profile"], "source": {"type": "none"}}])
+    stack_2 = dict(shared, instances=[{"name": "test-instance-2", "profiles": ["test-profile"], "source": {"type": "none"}}])
+    client = zebr0_lxd.Client(server.url)
+
+    client.create_stack(zebr0_lxd.merge_stacks([stack_1, stack_2])[0])
+    assert server.requests.get(("POST", "profiles")) == 1  # shared resources are created once
+
+    client.delete_stacks([stack_1])
+    assert {resource: list(resources) for resource, resources in server.resources.items() if resources} == {
+        "storage-pools": ["test-storage-pool"], "profiles": ["test-profile"], "instances": ["test-instance-2"]  # still used by the other stack's instance
+    }
+
+    client.delete(Resource.INSTANCES, "test-instance-2")
+    client.delete_stacks([stack_1], keep=[stack_2])
+    assert server.resources.get(Resource.PROFILES)  # still referenced by the other stack
+
+    client.delete_stacks([stack_1, stack_2])
+    assert not any(server.resources.values())
+
+
+def test_delete_stacks_images(server, monkeypatch):
+    read = server.read
+
+    def read_with_images(resource, metadata):  # as LXD, once an image has been unpacked on the storage pool
+        return dict(read(resource, metadata), used_by=read(resource, metadata).get("used_by") + ["/1.0/images/abc", "/1.0/storage-pools/test-storage-pool/volumes/image/abc"]) if resource == Resource.STORAGE_POOLS else read(resource, metadata)
+
+    monkeypatch.setattr(server, "read", read_with_images)
+    client = zebr0_lxd.Client(server.url)
+    client.create_stack(LXD_STACK)
+
+    client.delete_stacks([LXD_STACK])
+    assert not any(server.resources.values())  # images don't retain the storage pool
+
+
+def test_start_stack_ready():
+    stack = {"instances": [{"name": "worker-{index}", "replicas": "3", "source": {"type": "none"}}]}
+
+    with TestServer(boot_latency=0.3) as server:
+        client = zebr0_lxd.Client(server.url)
+        client.create_stack(stack)
+
+        latencies = client.start_stack(stack, jobs=3, ready=["ipv4", "cloud-init", "exec:test -f /ready"])
+        assert sorted(latencies) == ["worker-1", "worker-2", "worker-3"]
+        assert all(0.3 <= latency < 2 for latency in latencies.values())
+        assert client.instrumentation.counts.get(("readiness", ())) == 3
+
+
+def test_ko_start_stack_ready():
+    stack = {"instances": [{"name": "test-instance", "source": {"type": "none"}}]}
+
+    with TestServer(boot_latency=10) as server:
+        client = zebr0_lxd.Client(server.url)
+        client.create_stack(stack)
+
+        with pytest.raises(zebr0_lxd.ReadinessTimeout) as exception:
+            client.start_stack(stack, ready=["ipv4"], ready_timeout=0.3)
+
+        assert exception.value.pending == {"test-instance": ["ipv4"]}
+
+
+def test_cache(server):
+    client = zebr0_lxd.Client(server.url, cache_ttl=0.3)
+    instance = {"name": "test-instance", "source": {"type": "none"}}
+
+    client.create(Resource.INSTANCES, instance)
+    client.start("test-instance")
+    client.stop("test-instance")
+    client.start("test-instance")
+    assert client.is_running("test-instance") and client.exists(Resource.INSTANCES, "test-instance")
+    assert server.requests.get(("GET", "instances")) == 1  # kept up to date with the client's own changes
+    assert client.inventory.stats() == {"hits": 8, "misses": 1}
+
+    with server.lock:
+        server.resources.get(Resource.INSTANCES).get("test-instance")["status"] = "Stopped"  # changed behind the client's back
+    assert client.is_running("test-instance")
+    time.sleep(0.3)
+    assert not client.is_running("test-instance")  # expired
+    assert server.requests.get(("GET", "instances")) == 2
+
+
+def test_rolling_stack():
+    stack = {"instances": [{"name": "worker-{index}", "replicas": "4", "clone": "snapshot", "source": {"type": "none"}}]}
+
+    with TestServer(boot_latency=0.2) as server:
+        client = zebr0_lxd.Client(server.url)
+        client.create_stack(stack)
+        client.start_stack(stack)
+
+        start = time.monotonic()
+        downtimes = client.rolling_stack(stack, "restart", max_unavailable=2, ready=["ipv4"])
+        assert sorted(downtimes) == ["worker-1", "worker-2", "worker-3", "worker-4"]
+        assert time.monotonic() - start < sum(downtimes.values()) * 0.75  # two at a time
+
+        server.requests.clear()
+        client.rolling_stack(stack, "replace", max_unavailable=2, max_surge=2, ready=["ipv4"])
+        assert sorted(server.resources.get(Resource.INSTANCES)) == ["worker-1", "worker-2", "worker-3", "worker-4"]  # the replacements took the names
+        assert all(instance.get("status") == "Running" for instance in server.resources.get(Resource.INSTANCES).values())
+        assert server.requests.get(("DELETE", "instances")) == 4 and server.requests.get(("POST", "instances")) == 4 + 4 + 1  # creations, renamings and the snapshot
+        assert server.snapshots.get("worker-1") == [zebr0_lxd.CLONE_SNAPSHOT]  # taken again from the replaced source
+
+
+def test_rolling_stack_pipelined(caplog):
+    stack = {"instances": [{"name": "worker-{index}", "replicas": "3", "source": {"type": "none"}}]}
+
+    with TestServer(boot_latency=0.3) as server:
+        client = zebr0_lxd.Client(server.url)
+        client.create_stack(stack)
+        client.start_stack(stack)
+
+        caplog.set_level("INFO", logger="zebr0_lxd")
+        client.rolling_stack(stack, "replace", max_unavailable=1, max_surge=1, ready=["ipv4"])
+
+        events = [record.getMessage().split(" in ")[0] for record in caplog.records if record.getMessage().startswith(("creating", "rolled"))]
+        for previous, name in (("worker-1", "worker-2"), ("worker-2", "worker-3")):  # each replacement is created while the previous instance starts
+            assert events.index(f'creating instances/{{"name": "{name}-surge", "source": {{"type": "none"}}}}') < events.index(f"rolled instances/{previous}")
+
+
+def test_ko_rolling_stack():
+    stack = {"instances": [{"name": f"test-instance-{index}", "source": {"type": "none"}} for index in range(3)]}
+
+    with TestServer(operation_failures={("PUT", "/1.0/instances/test-instance-0/state")}) as server:
+        client = zebr0_lxd.Client(server.url)
+        client.create_stack(stack)
+
+        with pytest.raises(zebr0_lxd.OperationError):
+            client.rolling_stack(stack)
+
+        assert not server.requests.get(("PUT", "instances")) > 1  # the other instances weren't touched
+
+
+def test_dry_run(server):
+    trace = Trace()
+    zebr0_lxd.Client(server.url, trace=trace, dry_run=True).create_stack(LXD_STACK)
+
+    assert not any(server.resources.values())  # nothing was created
+    assert [entry.get("path") for entry in trace.entries if entry.get("dry_run")] == ["/1.0/storage-pools", "/1.0/networks", "/1.0/profiles", "/1.0/instances", "/1.0/instances"]
+    assert [entry.get("body").get("name") for entry in trace.entries if entry.get("dry_run")][-1] == "test-instance-2"
+
+
+def test_dry_run_missing_instances(server):
+    stack = {"instances": [{"name": "worker-{index}", "replicas": "2", "clone": "snapshot", "source": {"type": "none"}}]}
+    client = zebr0_lxd.Client(server.url, dry_run=True)
+
+    client.create_stack(stack)  # snapshots an instance that doesn't exist
+    client.start_stack(stack)  # starts instances that don't exist
+    assert not server.resources.get(Resource.INSTANCES) and not server.snapshots
+
+
+def test_trace_replay():
+    trace = Trace()
+    with TestServer(operation_latency=0.2) as server:
+        zebr0_lxd.Client(server.url, trace=trace).create_stack(LXD_STACK)
+
+    output = io.StringIO()
+    trace.dump(output)
+    output.seek(0)
+
+    with TestServer(trace=Trace.load(output)) as server:
+        start = time.monotonic()
+        zebr0_lxd.Client(server.url).create_stack(LXD_STACK)
+
+        assert time.monotonic() - start >= 0.2 * 2  # the two instances' creations took as long as when recorded
+        assert not server.replayed and not any(server.resources.values())  # all the calls were answered from the trace
+
+
+def test_wait_ready_hanging_neighbour(monkeypatch):
+    with TestServer(boot_latency=0.3) as server:
+        client = zebr0_lxd.Client(server.url)
+        for name in ("test-hanging", "test-instance"):
+            client.create(Resource.INSTANCES, {"name": name, "source": {"type": "none"}})
+            client.start(name)
+
+        hung = []
+        exec = client.exec
+
+        def hanging_exec(name, command, timeout=None):
+            if name == "test-hanging" and not hung:  # the first command hangs
+                hung.append(name)
+                time.sleep(2)
+                return 1
+            return exec(name, command, timeout)
+
+        monkeypatch.setattr(client, "exec", hanging_exec)
+        latencies = client.wait_ready(["test-hanging", "test-instance"], ["exec:true"], timeout=5)  # with the default jobs
+
+        assert latencies.get("test-instance") < 1.5  # not held back by the hanging command
+        assert latencies.get("test-hanging") >= 2
+
+
+def test_ko_wait_ready_hanging():
+    with TestServer() as server:
+        client = zebr0_lxd.Client(server.url)
+        client.create(Resource.INSTANCES, {"name": "test-instance", "source": {"type": "none"}})
+        client.start("test-instance")
+        server.operation_latency = 2  # the command hangs
+
+        start = time.monotonic()
+        with pytest.raises(zebr0_lxd.ReadinessTimeout):
+            client.wait_ready(["test-instance"], ["exec:true"], timeout=0.3)
+        assert time.monotonic() - start < 1.9  # bounded by the deadline, not by the command
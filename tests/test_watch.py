@@ -0,0 +1,106 @@
+import threading
+import time
+
+import pytest
+
+import zebr0_lxd
+from zebr0_lxd import Resource
+from zebr0_lxd.testing import TestServer
+from zebr0_lxd.watch import EventStream, Watcher, follow_events
+
+LXD_STACK = {
+    "storage-pools": [{"name": "test-storage-pool", "driver": "dir"}],
+    "profiles": [{"name": "test-profile", "devices": {"root": {"path": "/", "pool": "test-storage-pool", "type": "disk"}}}],
+    "instances": [{"name": "test-instance-1", "profiles": ["test-profile"], "source": {"type": "none"}},
+                  {"name": "test-instance-2", "profiles": ["test-profile"], "source": {"type": "none"}}]
+}
+
+
+@pytest.fixture
+def server():
+    with TestServer() as server:
+        yield server
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_event_stream(server):
+    client = zebr0_lxd.Client(server.url)
+    stream = EventStream(client)
+    stream.connect()
+    events = iter(stream)
+
+    client.create(Resource.PROFILES, {"name": "test-profile"})
+    client.delete(Resource.PROFILES, "test-profile")
+
+    assert [(event.get("metadata").get("action"), event.get("metadata").get("source")) for event in (next(events), next(events))] == [
+        ("profile-created", "/1.0/profiles/test-profile"), ("profile-deleted", "/1.0/profiles/test-profile")
+    ]
+    stream.close()
+
+
+def test_handle():
+    watcher = Watcher(None, LXD_STACK)
+
+    watcher.handle({"type": "logging", "metadata": {"message": "whatever"}})
+    watcher.handle({"type": "lifecycle", "metadata": {"action": "instance-stopped", "source": "/1.0/instances/unrelated-instance"}})
+    watcher.handle({"type": "lifecycle", "metadata": {"action": "instance-started", "source": "/1.0/instances/test-instance-1"}})
+    assert watcher.dirty == set()
+
+    watcher.handle({"type": "lifecycle", "metadata": {"action": "instance-stopped", "source": "/1.0/instances/test-instance-1"}})
+    watcher.handle({"type": "lifecycle", "metadata": {"action": "profile-deleted", "source": "/1.0/profiles/test-profile?project=default"}})
+    assert watcher.dirty == {(Resource.INSTANCES, "test-instance-1"), (Resource.PROFILES, "test-profile")}
+    assert watcher.state.get((Resource.INSTANCES, "test-instance-1")) == "stopped"
+
+
+def test_watch(server):
+    watcher = Watcher(zebr0_lxd.Client(server.url), LXD_STACK, debounce=0.05, interval=0.1)
+    threading.Thread(target=watcher.run, daemon=True).start()
+
+    instances = server.resources.get(Resource.INSTANCES)
+    wait_for(lambda: len(instances) == 2 and all(instance.get("status") == "Running" for instance in instances.values()) and server.subscribers)
+    server.requests.clear()
+
+    # drift: an instance is stopped, another is deleted
+    with server.lock:
+        instances.get("test-instance-1")["status"] = "Stopped"
+        server.emit("instance-stopped", Resource.INSTANCES, "test-instance-1")
+        del instances["test-instance-2"]
+        server.emit("instance-deleted", Resource.INSTANCES, "test-instance-2")
+
+    wait_for(lambda: len(instances) == 2 and all(instance.get("status") == "Running" for instance in instances.values()))
+    watcher.stop()
+
+    assert server.requests.get(("POST", "instances")) == 1  # only the deleted instance is recreated
+    assert server.requests.get(("PUT", "instances")) == 2  # and both are started
+    assert not server.requests.get(("GET", "profiles")) and not server.requests.get(("POST", "profiles"))  # the rest of the stack is left alone
+
+
+def test_follow_events(server):
+    client = zebr0_lxd.Client(server.url, cache_ttl=60)
+    client.create(Resource.PROFILES, {"name": "test-profile"})
+    stopped = follow_events(client)
+    wait_for(lambda: server.subscribers)
+
+    assert client.exists(Resource.PROFILES, "test-profile")
+    with server.lock:
+        del server.resources.get(Resource.PROFILES)["test-profile"]
+        server.emit("profile-deleted", Resource.PROFILES, "test-profile")
+
+    wait_for(lambda: not client.exists(Resource.PROFILES, "test-profile"))
+    assert client.inventory.stats().get("misses") == 2  # fetched again once invalidated
+    stopped.set()
+
+
+def test_inventory_handle():
+    inventory = zebr0_lxd.Inventory(None)
+    inventory.resources = {Resource.PROFILES: {}, Resource.INSTANCES: {}}
+
+    inventory.handle({"type": "logging", "metadata": {"message": "whatever"}})
+    inventory.handle({"type": "lifecycle", "metadata": {"action": "instance-stopped", "source": "/1.0/instances/test-instance?project=default"}})
+    assert list(inventory.resources) == [Resource.PROFILES]
@@ -1,14 +1,125 @@
 import argparse
+import collections
+import concurrent.futures
+import contextlib
 import enum
+import fnmatch
+import hashlib
+import heapq
 import json
-from typing import Optional, List
+import logging
+import os
+import random
+import re
+import shlex
+import ssl
+import sys
+import threading
+import time
+import urllib.parse
+from typing import Optional, List, Dict, Tuple, Callable, Iterable, Iterator, TextIO, Union
 
+import requests.adapters
 import requests_unixsocket
 import yaml
 import zebr0
 
+from zebr0_lxd.instrumentation import Instrumentation, Trace, TracingAdapter
+
 KEY_DEFAULT = "lxd-stack"
 URL_DEFAULT = "http+unix://%2Fvar%2Fsnap%2Flxd%2Fcommon%2Flxd%2Funix.socket"
+IMAGE_SOURCE_FIELDS = ["type", "mode", "server", "protocol", "alias", "fingerprint", "certificate", "secret"]  # fields of an instance's source needed to download its image
+IMMUTABLE_FIELDS = ["name", "type", "driver", "source"]  # fields that can't be changed once a resource has been created
+GENERATED_FIELDS = ["created_at", "last_used_at", "expanded_config", "expanded_devices", "status", "status_code", "state", "location", "locations", "project", "used_by", "managed", "stateful"]  # fields set by LXD, stripped from exported stacks
+GENERATED_CONFIG_PREFIXES = ["volatile.", "image."]  # configuration keys set by LXD, idem
+CLONE_MODES = ["none", "copy", "snapshot"]  # how the replicas of an instance are created (see zebr0_lxd.expand_replicas)
+CLONE_SNAPSHOT = "zebr0-lxd-clone"  # name of the snapshot the replicas are copied from, in "snapshot" mode
+TEMPLATE_ELEMENTS = ["parameters", "overrides"]  # root elements of stack templates (see zebr0_lxd.render_stack)
+TEMPLATE_PARAMETER = re.compile(r"\$\$|\$\{([_a-zA-Z][_a-zA-Z0-9]*)\}|\$([_a-zA-Z][_a-zA-Z0-9]*)")  # "$$" is matched so that it's skipped (e.g. a shell's PID in a cloud-init script)
+CLOUD_INIT_PROBE = ["sh", "-c", "cloud-init status 2>/dev/null | grep -qE 'status: (done|disabled)'"]  # succeeds once cloud-init is over (see zebr0_lxd.Client.is_ready)
+ROLLING_MODES = ["restart", "replace"]  # how the instances are rolled (see zebr0_lxd.Client.rolling_stack)
+PROBE_JOBS = 64  # maximum number of instances probed concurrently by default, as a hanging probe holds a thread (see zebr0_lxd.Client.wait_ready)
+SURGE_SUFFIX = "-surge"  # suffix of the names of the replacements created ahead of time, in "replace" mode
+STACK_FORMAT = 1  # version of the compiled stacks, to be bumped whenever validate_stack's rules or output change, so that the cached ones are compiled again
+STACK_CACHE_DEFAULT = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "zebr0-lxd")
+
+# the library logs an event for each check and change it makes, at the INFO level (see zebr0_lxd.configure_logging)
+logger = logging.getLogger("zebr0_lxd")
+logger.addHandler(logging.NullHandler())
+
+
+class LazyJson:
+    """
+    Wraps a value so that it's only serialized to json if the log message containing it is actually emitted.
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self) -> str:
+        return json.dumps(self.value)
+
+
+class StdoutHandler(logging.StreamHandler):
+    """
+    Logging handler writing to the current sys.stdout (even if it's replaced after the handler's creation).
+    Each record is flushed, so that it shows up right away even when the output is piped (e.g. to journald, in watch mode).
+    """
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, _):
+        pass
+
+
+class HostAdapter(logging.LoggerAdapter):
+    """
+    Attaches the URL of a LXD host to the log records, so that the concurrent logs of several hosts can be told apart (see zebr0_lxd.run_fleet).
+    """
+
+    def process(self, msg, kwargs):
+        kwargs["extra"] = dict(kwargs.get("extra") or {}, host=self.extra.get("host"))
+        return msg, kwargs
+
+
+class HumanFormatter(logging.Formatter):
+    """
+    Formats log records as their message, prefixed by the host they're about, if any (see zebr0_lxd.HostAdapter).
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        return (record.host + ": " if getattr(record, "host", None) else "") + record.getMessage()
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats log records as json lines, including the host and the structured "event" attached to them, if any.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(dict({"time": record.created, "level": record.levelname.lower(), "message": record.getMessage()}, **({"host": record.host} if getattr(record, "host", None) else {}), **getattr(record, "event", {})))
+
+
+def configure_logging(log_format: str = "human", quiet: bool = False) -> None:
+    """
+    Sends the library's log to the standard output, replacing any previous configuration made by this function.
+
+    :param log_format: either "human" (e.g. "creating instances/test-instance") or "json" (one json object per line), defaults to "human"
+    :param quiet: whether to only log warnings and errors, defaults to False
+    """
+
+    for handler in [handler for handler in logger.handlers if isinstance(handler, StdoutHandler)]:
+        logger.removeHandler(handler)
+
+    handler = StdoutHandler()
+    handler.setFormatter(JsonFormatter() if log_format == "json" else HumanFormatter())
+    logger.addHandler(handler)
+    logger.setLevel(logging.WARNING if quiet else logging.INFO)
 
 
 class Resource(str, enum.Enum):
@@ -28,12 +139,826 @@ class Resource(str, enum.Enum):
         return "/1.0/" + self
 
 
+class StackError(Exception):
+    """
+    Raised when a stack doesn't have the expected structure, before any call to the LXD API.
+    """
+
+
+def validate_stack(stack) -> dict:
+    """
+    Checks the structure of a stack and normalizes it: only the known resource types are kept, as lists (possibly empty), along with the template elements, if any (see zebr0_lxd.render_stack).
+
+    :param stack: the stack, as loaded from yaml or json
+    :return: the normalized stack
+    :raises StackError: if the stack isn't valid
+    """
+
+    if not isinstance(stack, dict):
+        raise StackError("is not a proper yaml or json dictionary")
+
+    unknown = [key for key in stack if key not in list(Resource) + TEMPLATE_ELEMENTS + ["config"]]  # the root "config" element is ignored
+    if unknown:
+        raise StackError(f"is not a proper stack: unknown element(s) {', '.join(map(str, unknown))}")
+
+    normalized = {}
+    if "parameters" in stack:
+        if not isinstance(stack.get("parameters"), dict):
+            raise StackError("is not a proper stack: parameters is not a dictionary")
+        normalized["parameters"] = stack.get("parameters")
+    if "overrides" in stack:
+        if not (isinstance(stack.get("overrides"), dict) and all(isinstance(overrides, dict) for overrides in stack.get("overrides").values())):
+            raise StackError("is not a proper stack: overrides is not a dictionary of parameters per level")
+        normalized["overrides"] = stack.get("overrides")
+
+    for resource in list(Resource):
+        configs = stack.get(resource) or []
+        if not isinstance(configs, list):
+            raise StackError(f"is not a proper stack: {resource.value} is not a list")
+
+        names = set()
+        for index, config in enumerate(configs):
+            where = f"{resource.value}[{index}]"
+            if not isinstance(config, dict):
+                raise StackError(f"is not a proper stack: {where} is not a dictionary")
+            if not isinstance(config.get("name"), str) or not config.get("name"):
+                raise StackError(f"is not a proper stack: {where} has no name")
+            if config.get("name") in names:
+                raise StackError(f"is not a proper stack: {where} has a duplicate name '{config.get('name')}'")
+            names.add(config.get("name"))
+
+            if resource == Resource.STORAGE_POOLS and not config.get("driver"):
+                raise StackError(f"is not a proper stack: {where} has no driver")
+            for key in ("config", "devices", "source"):
+                if key in config and not isinstance(config.get(key), dict):
+                    raise StackError(f"is not a proper stack: {where}.{key} is not a dictionary")
+            if not all(isinstance(device, dict) for device in (config.get("devices") or {}).values()):
+                raise StackError(f"is not a proper stack: {where}.devices has a device that is not a dictionary")
+            if "profiles" in config and not (isinstance(config.get("profiles"), list) and all(isinstance(profile, str) for profile in config.get("profiles"))):
+                raise StackError(f"is not a proper stack: {where}.profiles is not a list of names")
+            if "loop" in config and not (isinstance(config.get("loop"), dict) and all(isinstance(values, list) or (isinstance(values, str) and ".." in values) for values in config.get("loop").values())):
+                raise StackError(f"is not a proper stack: {where}.loop is not a dictionary of lists or ranges")
+            if "replicas" in config or "clone" in config:
+                if resource != Resource.INSTANCES:
+                    raise StackError(f"is not a proper stack: {where} has replicas but isn't an instance")
+                if not str(config.get("replicas")).isdigit() or int(config.get("replicas")) < 1:
+                    raise StackError(f"is not a proper stack: {where}.replicas is not a positive integer")
+                if "{index}" not in config.get("name"):
+                    raise StackError(f"is not a proper stack: {where} has replicas but its name has no {{index}} placeholder")
+                if config.get("clone", "none") not in CLONE_MODES:
+                    raise StackError(f"is not a proper stack: {where}.clone is not one of {', '.join(CLONE_MODES)}")
+
+        normalized[resource.value] = configs
+
+    return normalized
+
+
+def compile_stack(value: str, cache_directory: Optional[str] = STACK_CACHE_DEFAULT) -> dict:
+    """
+    Parses and validates a stack (see zebr0_lxd.validate_stack).
+    The result is cached on disk, keyed by a hash of the value and of the compiled stacks' version, so that an unchanged stack is only parsed and validated once.
+    Parsing uses the LibYAML bindings when they're available.
+
+    :param value: the stack as a yaml or json string
+    :param cache_directory: path to the cache directory, None to disable the cache, defaults to $XDG_CACHE_HOME/zebr0-lxd
+    :return: the normalized stack
+    :raises StackError: if the stack isn't valid
+    """
+
+    path = os.path.join(cache_directory, hashlib.sha256(f"{STACK_FORMAT}\n{value}".encode()).hexdigest() + ".json") if cache_directory else None
+    if path and os.path.isfile(path):
+        with contextlib.suppress(OSError, ValueError), open(path) as file:
+            return json.load(file)
+
+    try:
+        stack = validate_stack(yaml.load(value, Loader=getattr(yaml, "CBaseLoader", yaml.BaseLoader)))
+    except yaml.YAMLError:
+        raise StackError("is not a proper yaml or json dictionary")
+
+    if path:
+        with contextlib.suppress(OSError):  # the cache is just an optimization
+            os.makedirs(cache_directory, exist_ok=True)
+            with open(path + ".tmp", "w") as file:
+                json.dump(stack, file)
+            os.replace(path + ".tmp", path)
+
+    return stack
+
+
+def substitute(value, parameters: Dict[str, str]):
+    """
+    :param value: a value from a stack template
+    :param parameters: the parameters' values, indexed by name
+    :return: the value, with the parameters (e.g. "${size}" or "$size") replaced in all its strings (unknown ones, and "$$", are kept as is)
+    """
+
+    if isinstance(value, str):
+        return TEMPLATE_PARAMETER.sub(lambda match: str(parameters.get(match.group(1) or match.group(2), match.group(0))), value) if "$" in value else value
+    if isinstance(value, dict):
+        return {substitute(key, parameters): substitute(item, parameters) for key, item in value.items()}
+    if isinstance(value, list):
+        return [substitute(item, parameters) for item in value]
+    return value
+
+
+class Rendering:
+    """
+    The configurations of a resource type in a rendered stack template (see zebr0_lxd.render_stack).
+    They're generated lazily, anew each time they're iterated over, so that the expanded list is never held in memory.
+
+    :param configs: the configurations of the template, possibly with loops
+    :param parameters: the parameters' values, indexed by name
+    """
+
+    __slots__ = ("configs", "parameters")
+
+    def __init__(self, configs: List[dict], parameters: Dict[str, str]):
+        self.configs = configs
+        self.parameters = parameters
+
+    def __iter__(self) -> Iterator[dict]:
+        for config in self.configs:
+            if "loop" not in config:
+                yield substitute(config, self.parameters)
+                continue
+
+            # a loop iterates over the cartesian product of its variables, each being a list of values or a "<first>..<last>" range of integers
+            body = {key: value for key, value in config.items() if key != "loop"}
+            for combination in self.combinations(list(config.get("loop").items()), {}):
+                yield substitute(body, dict(self.parameters, **combination))
+
+    def combinations(self, variables: List[Tuple[str, Union[list, str]]], combination: Dict[str, str]) -> Iterator[Dict[str, str]]:
+        """
+        Unlike itertools.product, doesn't hold the variables' ranges in memory.
+
+        :param variables: the loop's remaining variables, as (name, values) tuples
+        :param combination: the values of the previous variables, indexed by name
+        :return: the combinations of the variables' values
+        :raises StackError: if a range's bounds aren't integers
+        """
+
+        if not variables:
+            yield combination
+            return
+
+        (name, values), rest = variables[0], variables[1:]
+        values = substitute(values, dict(self.parameters, **combination))
+        if isinstance(values, str):
+            first, _, last = values.partition("..")
+            try:
+                values = map(str, range(int(first), int(last) + 1))
+            except ValueError:
+                raise StackError(f"is not a proper stack: loop variable {name} is not a list or a range of integers ('{values}')") from None
+        for value in values:
+            yield from self.combinations(rest, dict(combination, **{name: value}))
+
+
+def render_stack(stack: dict, levels: Iterable[str] = ()) -> dict:
+    """
+    Renders a stack template, i.e. a stack that may have:
+
+    * a root "parameters" element, a dictionary of values referenced as "${name}" in the rest of the stack
+    * a root "overrides" element, a dictionary of parameters per level of specialization (see zebr0's levels), applied in the levels' order
+    * resources with a "loop" element, a dictionary of variables to iterate over (lists or ranges like "1..${size}"), each combination generating a resource
+
+    For example, "{name: web-${zone}-${index}, loop: {zone: [a, b], index: '1..100'}}" describes 200 instances.
+    The resources are generated lazily (see zebr0_lxd.Rendering), so that even huge fleets are never fully expanded in memory.
+
+    :param stack: the stack template as a dictionary (see zebr0_lxd.compile_stack)
+    :param levels: the levels of specialization, defaults to none
+    :return: the rendered stack
+    """
+
+    parameters = dict(stack.get("parameters") or {})
+    for level in levels:
+        parameters.update((stack.get("overrides") or {}).get(level) or {})
+    return {resource.value: Rendering(stack.get(resource) or [], parameters) for resource in Resource}
+
+
+def fetch_values(keys: List[str], url: str, levels: List[str], cache: int, configuration_file: str, cache_directory: Optional[str] = STACK_CACHE_DEFAULT, jobs: int = 10) -> Dict[str, str]:
+    """
+    Fetches several keys from the zebr0 key-value server concurrently (see zebr0.Client for the parameters), with a local fallback:
+    each value fetched is stored on disk (only rewritten when its hash changes), and served instead, with a warning, if the server can't be reached later.
+
+    :param keys: the keys to fetch
+    :param cache_directory: path to the cache directory, None to disable the fallback, defaults to $XDG_CACHE_HOME/zebr0-lxd
+    :param jobs: maximum number of keys fetched concurrently, defaults to 10
+    :return: the values indexed by key, empty if the key wasn't found
+    """
+
+    def fetch(key: str) -> str:
+        identifier = hashlib.sha256(json.dumps([url, levels, key]).encode()).hexdigest()
+        path = os.path.join(cache_directory, "values", identifier + ".json") if cache_directory else None
+
+        try:
+            value = zebr0.Client(url, levels, cache, configuration_file).get(key)
+        except Exception as exception:
+            if not path or not os.path.isfile(path):
+                raise
+            with open(path) as file:
+                cached = json.load(file)
+            logger.warning("key '%s' couldn't be fetched from server %s (%s), using the value cached on %s", key, url, exception, time.ctime(cached.get("time")))
+            return cached.get("value")
+
+        if path and value:
+            digest = hashlib.sha256(value.encode()).hexdigest()
+            with contextlib.suppress(OSError, ValueError):  # the fallback is just a convenience
+                if os.path.isfile(path):
+                    with open(path) as file:
+                        if json.load(file).get("hash") == digest:
+                            return value
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + ".tmp", "w") as file:
+                    json.dump({"value": value, "hash": digest, "time": time.time()}, file)
+                os.replace(path + ".tmp", path)
+
+        return value
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        return dict(zip(keys, executor.map(fetch, keys)))
+
+
+class Node:
+    """
+    A resource of a stack, seen as a vertex of the stack's dependency graph (see zebr0_lxd.build_graph).
+
+    :param resource: the resource's type
+    :param config: the resource's desired configuration
+    """
+
+    __slots__ = ("resource", "name", "config", "dependencies")
+
+    def __init__(self, resource: Resource, config: dict):
+        self.resource = resource
+        self.name = config.get("name")
+        self.config = config
+        self.dependencies = set()  # keys of the nodes this one relies on
+
+    def key(self) -> Tuple[Resource, str]:
+        """
+        :return: the node's unique identifier in the graph
+        """
+        return self.resource, self.name
+
+
+def expand_replicas(config: dict) -> List[dict]:
+    """
+    Expands an instance declaring "replicas" into as many instances, named after its name's pattern (e.g. "worker-{index}", the index starting at 1).
+    Depending on its "clone" mode, the replicas are either all created from the instance's source ("none", the default),
+    or the first one is and the others are copies of it ("copy") or of a snapshot of it ("snapshot"), which is near-instant on ZFS or btrfs storage pools.
+
+    :param config: the instance's configuration
+    :return: the configurations of the replicas, or the given configuration if it has no replicas
+    """
+
+    if "replicas" not in config:
+        return [config]
+
+    base = {key: value for key, value in config.items() if key not in ("replicas", "clone")}
+    replicas = [dict(base, name=config.get("name").replace("{index}", str(index))) for index in range(1, int(config.get("replicas")) + 1)]
+
+    clone = config.get("clone") or "none"
+    if clone != "none":
+        source = {"type": "copy", "source": replicas[0].get("name") + ("/" + CLONE_SNAPSHOT if clone == "snapshot" else ""), "instance_only": True}
+        replicas[1:] = [dict(replica, source=source) for replica in replicas[1:]]
+    return replicas
+
+
+def build_graph(stack: dict) -> Dict[Tuple[Resource, str], Node]:
+    """
+    Builds the dependency graph of a stack, after expanding the instances' replicas (see zebr0_lxd.expand_replicas):
+
+    * an instance depends on the profiles it references, and on the instance it's a copy of
+    * a profile or an instance depends on the storage pools and networks its devices use
+
+    References to resources outside the stack (e.g. the "default" profile) are ignored.
+    The graph's nodes are ordered by resource type, then by position in the stack, which is a valid topological order.
+
+    :param stack: the stack as a dictionary
+    :return: the graph as a dictionary of nodes indexed by their key
+    :raises StackError: if a resource is defined more than once
+    """
+
+    graph = {}
+    for resource in list(Resource):  # order: storage pools, networks, profiles, instances
+        for config in stack.get(resource) or []:
+            for expanded in expand_replicas(config) if resource == Resource.INSTANCES else [config]:
+                node = Node(resource, expanded)
+                if node.key() in graph:  # e.g. generated twice by a loop, or by a loop and a static resource
+                    raise StackError(f"is not a proper stack: {resource.value}/{node.name} is defined more than once")
+                graph[node.key()] = node
+
+    for node in graph.values():
+        references = set()
+        if node.resource == Resource.INSTANCES:
+            references.update((Resource.PROFILES, profile) for profile in node.config.get("profiles") or [])
+            if (node.config.get("source") or {}).get("type") == "copy":
+                references.add((Resource.INSTANCES, str(node.config.get("source").get("source")).split("/")[0]))
+        if node.resource in (Resource.PROFILES, Resource.INSTANCES):
+            for device in (node.config.get("devices") or {}).values():
+                if device.get("pool"):
+                    references.add((Resource.STORAGE_POOLS, device.get("pool")))
+                for key in ("network", "parent"):  # "parent" may also be a host interface, hence the filter below
+                    if device.get(key):
+                        references.add((Resource.NETWORKS, device.get(key)))
+        node.dependencies = {reference for reference in references if reference in graph}
+
+    return graph
+
+
+def merge_stacks(stacks: Iterable[dict]) -> Tuple[dict, Dict[Tuple[Resource, str], int]]:
+    """
+    Merges several stacks into one, so that they're managed in a single pass: a resource shared by several stacks (same type and name) appears once.
+
+    :param stacks: the stacks as dictionaries
+    :return: the merged stack, and the number of stacks referencing each resource, indexed by key
+    :raises StackError: if a shared resource isn't defined the same way in all the stacks
+    """
+
+    merged = {resource.value: [] for resource in Resource}
+    configs, references = {}, collections.Counter()
+    for stack in stacks:
+        for key, node in build_graph(stack).items():
+            if key not in configs:
+                configs[key] = node.config
+                merged[node.resource.value].append(node.config)
+            elif configs.get(key) != node.config:
+                raise StackError(f"is not a proper stack: {node.resource.value}/{node.name} is defined differently in another stack")
+            references[key] += 1
+    return merged, references
+
+
+def clone_snapshots(graph: Dict[Tuple[Resource, str], Node]) -> Dict[str, str]:
+    """
+    :param graph: the dependency graph of a stack
+    :return: the snapshots other instances of the stack are copied from, as a dictionary of snapshot names indexed by instance name
+    """
+
+    snapshots = {}
+    for node in graph.values():
+        source = node.config.get("source") or {}
+        if node.resource == Resource.INSTANCES and source.get("type") == "copy" and "/" in str(source.get("source")):
+            name, snapshot = source.get("source").split("/", 1)
+            if (Resource.INSTANCES, name) in graph:
+                snapshots[name] = snapshot
+    return snapshots
+
+
+def execute(graph: Dict[Tuple[Resource, str], Node], function: Callable[[Node], None], jobs: int = 1, reverse: bool = False) -> None:
+    """
+    Calls a function on each node of a graph, with up to "jobs" calls running concurrently.
+    A node is only processed once all its dependencies have been (or all its dependents, if "reverse" is set).
+    Dependencies on nodes outside the graph are ignored, so that a subset of a graph can be executed.
+    When a call fails, no new node is processed and the exception is raised once the running calls are over.
+
+    :param graph: the graph (see zebr0_lxd.build_graph)
+    :param function: the function to call on each node
+    :param jobs: maximum number of concurrent calls, defaults to 1 (sequential processing, in the graph's order as far as the dependencies allow)
+    :param reverse: whether to process the graph from the dependents to their dependencies, defaults to False
+    """
+
+    # by resource type, then by position in the stack: the order in which the nodes are processed when they're not waiting for each other
+    nodes = sorted(graph.values(), key=lambda node: list(Resource).index(node.resource), reverse=reverse)
+
+    # "blockers" counts the unprocessed nodes a node is waiting for, "unblocks" lists the nodes waiting for a node
+    blockers = {node.key(): 0 for node in nodes}
+    unblocks = {node.key(): [] for node in nodes}
+    for node in nodes:
+        for dependency in node.dependencies & graph.keys():
+            before, after = (node.key(), dependency) if reverse else (dependency, node.key())
+            blockers[after] += 1
+            unblocks[before].append(graph[after])
+
+    if jobs <= 1:
+        # a topological order, as instances may depend on instances further in the stack (e.g. a copy declared before its source)
+        positions = {node.key(): position for position, node in enumerate(nodes)}
+        available = [positions.get(node.key()) for node in nodes if blockers[node.key()] == 0]
+        while available:
+            node = nodes[heapq.heappop(available)]
+            function(node)
+            for unblocked in unblocks[node.key()]:
+                blockers[unblocked.key()] -= 1
+                if blockers[unblocked.key()] == 0:
+                    heapq.heappush(available, positions.get(unblocked.key()))
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        running = {executor.submit(function, node): node for node in nodes if blockers[node.key()] == 0}
+        while running:
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                future.result()  # raises the call's exception, if any
+                for unblocked in unblocks[node.key()]:
+                    blockers[unblocked.key()] -= 1
+                    if blockers[unblocked.key()] == 0:
+                        running[executor.submit(function, unblocked)] = unblocked
+
+
+def strip_generated(resource: Resource, metadata: dict) -> dict:
+    """
+    :param resource: the resource's type
+    :param metadata: the resource's live metadata, as returned by LXD
+    :return: the resource's configuration, without the fields set by LXD nor the empty or default ones
+    """
+
+    config = {key: value for key, value in metadata.items() if key not in GENERATED_FIELDS and value not in ("", {}, False)}
+    if isinstance(config.get("config"), dict):
+        config["config"] = {key: value for key, value in config.get("config").items() if not any(key.startswith(prefix) for prefix in GENERATED_CONFIG_PREFIXES)}
+        if not config.get("config"):
+            del config["config"]
+
+    if resource == Resource.INSTANCES:  # the source isn't part of an instance's metadata, but its image's fingerprint is
+        fingerprint = (metadata.get("config") or {}).get("volatile.base_image")
+        config["source"] = {"type": "image", "fingerprint": fingerprint} if fingerprint else {"type": "none"}
+
+    return config
+
+
+def dump_stack(resources: Iterable[Tuple[Resource, dict]], file: TextIO) -> None:
+    """
+    Writes resources as a yaml stack, one resource at a time, so that the whole document is never held in memory.
+
+    :param resources: the resources, grouped by type in the stack's order, as (resource, config) tuples (e.g. from zebr0_lxd.Client.export_stack)
+    :param file: the file to write to
+    """
+
+    current = None
+    for resource, config in resources:
+        if resource != current:
+            file.write(resource.value + ":\n")
+            current = resource
+        file.write(yaml.dump([config], Dumper=getattr(yaml, "CSafeDumper", yaml.SafeDumper), default_flow_style=False, sort_keys=False))
+
+    if current is None:
+        file.write("{}\n")
+
+
+def diff(desired: dict, live: dict) -> dict:
+    """
+    Compares the desired configuration of a resource to its live one.
+    Only the desired fields are considered, and dictionaries (e.g. "config" or "devices") are compared key by key.
+
+    :param desired: the resource's desired configuration
+    :param live: the resource's live configuration
+    :return: the desired fields that differ from the live ones, suitable for a PATCH request (empty if there's nothing to change)
+    """
+
+    changes = {}
+    for key, value in desired.items():
+        if key in IMMUTABLE_FIELDS:
+            continue
+        if isinstance(value, dict) and isinstance(live.get(key), dict):
+            nested = {nested_key: nested_value for nested_key, nested_value in value.items() if live.get(key).get(nested_key) != nested_value}
+            if nested:
+                changes[key] = nested
+        elif live.get(key) != value:
+            changes[key] = value
+    return changes
+
+
+class LXDError(Exception):
+    """
+    Base class of the errors reported by LXD.
+    """
+
+
+class RequestError(LXDError):
+    """
+    Raised when LXD rejects a request.
+
+    :param method: the request's HTTP method
+    :param url: the request's URL
+    :param status_code: the response's HTTP status code
+    :param text: the response's body, used as the exception's message
+    """
+
+    def __init__(self, method: str, url: str, status_code: int, text: str):
+        super().__init__(text)
+        self.method = method
+        self.url = url
+        self.status_code = status_code
+        try:
+            self.error = json.loads(text).get("error") or ""
+        except (ValueError, AttributeError):
+            self.error = text
+
+
+class OperationError(LXDError):
+    """
+    Raised when an asynchronous operation fails or is cancelled.
+
+    :param operation: the operation
+    """
+
+    def __init__(self, operation: "Operation", message: Optional[str] = None):
+        super().__init__(message or f"operation {operation.id()} {operation.metadata.get('status', '').lower()}: {operation.metadata.get('err')}")
+        self.operation = operation
+        self.status_code = operation.metadata.get("status_code")
+
+
+class OperationTimeout(OperationError):
+    """
+    Raised when an asynchronous operation isn't over in time.
+    """
+
+
+class ReadinessTimeout(LXDError):
+    """
+    Raised when instances aren't ready in time (see zebr0_lxd.Client.wait_ready).
+
+    :param message: the exception's message
+    :param pending: the readiness conditions not met yet, as a dictionary of lists indexed by instance name
+    """
+
+    def __init__(self, message: str, pending: Dict[str, List[str]]):
+        super().__init__(message)
+        self.pending = pending
+
+
+class RetryPolicy:
+    """
+    How the Client deals with a busy or flaky LXD: timeouts, and retries of the idempotent requests with an exponential backoff and jitter.
+    A request is retried if the connection failed (except for TLS errors) or timed out, if LXD answered with a 5xx status code, or if it refused because of another operation in progress.
+
+    :param retries: maximum number of retries of a request, defaults to 3
+    :param backoff: in seconds, the base delay before the first retry, doubled at each retry, defaults to 0.5
+    :param max_backoff: in seconds, the maximum delay before a retry, defaults to 10
+    :param timeout: in seconds, how long to wait for LXD's response to a request, defaults to 30 (None to wait forever)
+    :param operation_timeout: in seconds, how long to wait for an asynchronous operation to be over, defaults to None (forever)
+    """
+
+    IDEMPOTENT_METHODS = ["GET", "HEAD", "OPTIONS", "PUT", "DELETE"]
+    BUSY_MESSAGES = ["operation in progress", "is busy"]  # LXD's errors when a resource is locked by another operation
+
+    def __init__(self, retries: int = 3, backoff: float = 0.5, max_backoff: float = 10, timeout: Optional[float] = 30, operation_timeout: Optional[float] = None):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.operation_timeout = operation_timeout
+
+    def retryable(self, method: str, error: Exception) -> bool:
+        """
+        :param method: the failed request's HTTP method
+        :param error: the error raised by the request
+        :return: whether the request can be retried
+        """
+
+        if method.upper() not in self.IDEMPOTENT_METHODS:
+            return False
+        if isinstance(error, RequestError):
+            return error.status_code >= 500 or any(message in error.error.lower() for message in self.BUSY_MESSAGES)
+        if isinstance(error, (requests.exceptions.SSLError, ssl.SSLError)):  # certificate or handshake failures won't fix themselves
+            return False
+        return isinstance(error, (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError, EOFError))  # EOFError: connection closed mid-response
+
+    def delay(self, attempt: int) -> float:
+        """
+        :param attempt: the number of the retry, starting at 0
+        :return: in seconds, the delay before the retry, randomized to spread the retries of concurrent jobs ("full jitter")
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class Operation:
+    """
+    A handle on an asynchronous LXD operation (see https://linuxcontainers.org/lxd/docs/master/rest-api#async-operations).
+    Several operations can be waited for together with zebr0_lxd.Client.wait_all.
+
+    :param client: the Client that started the operation
+    :param path: the operation's path relative to the LXD API base URL
+    :param metadata: the operation's metadata, as returned by LXD
+    """
+
+    def __init__(self, client: "Client", path: str, metadata: dict):
+        self.client = client
+        self.path = path
+        self.metadata = metadata
+
+    def id(self) -> str:
+        """
+        :return: the operation's UUID
+        """
+        return self.metadata.get("id")
+
+    def done(self) -> bool:
+        """
+        :return: whether the operation is over, successfully or not (status codes 2xx or 4xx, see https://linuxcontainers.org/lxd/docs/master/rest-api#list-of-current-status-codes)
+        """
+        return self.metadata.get("status_code", 0) >= 200
+
+    def check(self) -> None:
+        """
+        Raises an OperationError if the operation failed or was cancelled.
+        """
+
+        if self.done() and self.metadata.get("status_code") != 200:
+            if self.client.inventory and self.client.inventory.ttl is not None:  # the changes anticipated in the Client's cache may not have happened
+                self.client.inventory.invalidate()
+            raise OperationError(self)
+
+    def wait(self, timeout: Optional[float] = None) -> "Operation":
+        """
+        Blocks until the operation is over (see https://linuxcontainers.org/lxd/docs/master/rest-api#10operationsuuidwait).
+
+        :param timeout: in seconds, how long to wait before raising an OperationTimeout, defaults to the Client's retry policy
+        :return: the operation itself
+        """
+
+        timeout = timeout if timeout is not None else self.client.retry.operation_timeout
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self.client.instrumentation.span("operation", name="wait"):
+            while not self.done():
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise OperationTimeout(self, f"operation {self.id()} not over after {timeout}s")
+
+                # LXD's wait is bounded so that it doesn't outlast the request's own timeout
+                chunk = min(filter(None, [remaining, self.client.retry.timeout and self.client.retry.timeout / 2, 60]))
+                self.metadata = self.client.session.get(self.client.url + self.path + f"/wait?timeout={max(1, int(chunk))}").json().get("metadata")
+        self.check()
+        return self
+
+
+class Inventory:
+    """
+    A snapshot of the resources existing on LXD, fetched lazily with a single recursive list call per resource type.
+    It's kept up to date with the changes made through the Client that owns it (see zebr0_lxd.Client.snapshot).
+    Used as a longer-lived cache (see the Client's cache_ttl parameter), each resource type is fetched again once it's older than the TTL,
+    or once it's been invalidated, e.g. by LXD's events (see zebr0_lxd.watch.follow_events).
+
+    :param client: the Client used to fetch the resources
+    :param ttl: in seconds, how long a fetched resource type is used before being fetched again, defaults to None (forever)
+    """
+
+    def __init__(self, client: "Client", ttl: Optional[float] = None):
+        self.client = client
+        self.ttl = ttl
+        self.resources = {}  # resource type -> resource name -> resource metadata
+        self.fetched = {}  # resource type -> time it was fetched at
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, resource: Resource) -> Dict[str, dict]:
+        """
+        :param resource: the resources' type
+        :return: the existing resources of this type, as a dictionary of metadata indexed by name
+        """
+
+        with self.lock:
+            if resource in self.resources and (self.ttl is None or time.monotonic() - self.fetched.get(resource, 0) < self.ttl):
+                self.hits += 1
+            else:
+                self.misses += 1
+                self.resources[resource] = self.client.list(resource)
+                self.fetched[resource] = time.monotonic()
+            return self.resources[resource]
+
+    def invalidate(self, resource: Optional[Resource] = None) -> None:
+        """
+        Forgets a resource type, so that it's fetched again when needed.
+
+        :param resource: the resources' type, defaults to all of them
+        """
+
+        with self.lock:
+            for key in [resource] if resource else list(self.resources):
+                self.resources.pop(key, None)
+
+    def handle(self, event: dict) -> None:
+        """
+        Invalidates the resource type concerned by a LXD lifecycle event (see https://linuxcontainers.org/lxd/docs/master/events).
+
+        :param event: the event, as received from LXD (e.g. {"type": "lifecycle", "metadata": {"action": "instance-stopped", "source": "/1.0/instances/test-instance"}})
+        """
+
+        if event.get("type") == "lifecycle":
+            parts = urllib.parse.urlparse((event.get("metadata") or {}).get("source") or "").path.split("/")  # e.g. ["", "1.0", "instances", "test-instance"]
+            if len(parts) > 2 and parts[2] in [resource.value for resource in Resource]:
+                self.invalidate(Resource(parts[2]))
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: the numbers of lookups answered from memory ("hits") and from LXD ("misses")
+        """
+        return {"hits": self.hits, "misses": self.misses}
+
+    def add(self, resource: Resource, metadata: dict) -> None:
+        """
+        :param resource: the resource's type
+        :param metadata: the metadata of the resource that has been created or modified
+        """
+
+        with self.lock:
+            if resource in self.resources:
+                self.resources[resource][metadata.get("name")] = metadata
+
+    def discard(self, resource: Resource, name: str) -> None:
+        """
+        :param resource: the resource's type
+        :param name: the name of the resource that has been deleted
+        """
+
+        with self.lock:
+            if resource in self.resources:
+                self.resources[resource].pop(name, None)
+
+
+class Journal:
+    """
+    Records the steps completed by a stack operation in a checkpoint file, one json line per step, as they're done.
+    When a run fails, the next one can resume from the checkpoint, skipping the steps already done without checking them against LXD again,
+    or the resources created can be deleted (see zebr0_lxd.Client.create_stack and zebr0_lxd.Client.apply_stack).
+    A step only counts as done if the resource's configuration hasn't changed since.
+
+    :param path: path to the checkpoint file
+    :param resume: whether to keep the steps recorded by the previous runs, defaults to False (the file is reset)
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self.steps = {}  # (resource, name) -> step, as recorded in the file
+        self.lock = threading.Lock()
+
+        if resume and os.path.isfile(path):
+            with open(path) as file:
+                for line in file:
+                    with contextlib.suppress(ValueError):  # e.g. a line truncated by a crash
+                        step = json.loads(line)
+                        self.steps[(Resource(step.get("resource")), step.get("name"))] = step
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            open(path, "w").close()
+
+    @staticmethod
+    def digest(config: dict) -> str:
+        """
+        :param config: a resource's configuration
+        :return: a hash of the configuration
+        """
+        return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+    def done(self, resource: Resource, name: str, config: dict) -> bool:
+        """
+        :param resource: the resource's type
+        :param name: the resource's name
+        :param config: the resource's configuration
+        :return: whether the step has been recorded for this very configuration
+        """
+
+        step = self.steps.get((resource, name))
+        return step is not None and step.get("digest") == self.digest(config)
+
+    def record(self, action: str, resource: Resource, name: str, config: dict, created: bool) -> None:
+        """
+        :param action: the step's action (e.g. "create")
+        :param resource: the resource's type
+        :param name: the resource's name
+        :param config: the resource's configuration
+        :param created: whether the resource has been created by this step (as opposed to already existing)
+        """
+
+        previous = self.steps.get((resource, name)) or {}
+        step = {"action": action, "resource": resource.value, "name": name, "digest": self.digest(config), "created": created or previous.get("created", False)}
+        with self.lock:
+            self.steps[(resource, name)] = step
+            with open(self.path, "a") as file:
+                file.write(json.dumps(step) + "\n")
+
+    def created(self) -> List[Tuple[Resource, str]]:
+        """
+        :return: the keys of the resources created by the journaled runs
+        """
+        return [key for key, step in self.steps.items() if step.get("created")]
+
+    def clear(self) -> None:
+        """
+        Removes the checkpoint file, once the run is over.
+        """
+
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+
+
+def checkpoint_path(url: str, key: str, cache_directory: str = STACK_CACHE_DEFAULT) -> str:
+    """
+    :param url: URL of the LXD API
+    :param key: the stack's key
+    :param cache_directory: path to the cache directory, defaults to $XDG_CACHE_HOME/zebr0-lxd
+    :return: the path to the checkpoint file of the stack's runs on this LXD (see zebr0_lxd.Journal)
+    """
+    return os.path.join(cache_directory, "checkpoints", hashlib.sha256(f"{url} {key}".encode()).hexdigest() + ".jsonl")
+
+
 class Client:
     """
     A simple wrapper around the LXD REST API to manage resources either directly or via "stacks".
 
-    This Client connects to the LXD API through the Unix socket (for now).
-    Apart from how asynchronous operations are handled, it's mainly a convenient, idempotent passthrough.
+    This Client connects to the LXD API either through the Unix socket or remotely over HTTPS, authenticated by a client certificate (see https://linuxcontainers.org/lxd/docs/master/security).
+    Remote connections are kept alive in a pool, so that the TLS handshake isn't paid on each request.
+    Apart from how asynchronous operations are handled (see zebr0_lxd.Operation), it's mainly a convenient, idempotent passthrough.
     Therefore, the official documentation is where you'll find all the configuration details you'll need to create LXD resources:
 
     * storage-pools: https://linuxcontainers.org/lxd/docs/master/rest-api#10storage-pools and https://linuxcontainers.org/lxd/docs/master/storage
@@ -47,28 +972,164 @@ class Client:
     * "storage_pools" has been renamed "storage-pools" to match the API
     * the root "config" element is ignored (use a real preseed file if you want to configure LXD that way)
     * instances are managed through a new root element, "instances"
+    * an instance can declare "replicas", optionally cloned from the first one (see zebr0_lxd.expand_replicas)
+    * a stack can be a template, with parameters, per-level overrides and loops (see zebr0_lxd.render_stack)
 
     A typical stack example can be found in tests/test_cli.py.
     Check the various functions to see what you can do with stacks and resources.
+    An asyncio counterpart, sharing the same API, is available as zebr0_lxd.aio.AsyncClient.
 
-    :param url: URL of the LXD API (scheme is "http+unix", socket path is percent-encoded into the host field), defaults to "http+unix://%2Fvar%2Fsnap%2Flxd%2Fcommon%2Flxd%2Funix.socket"
+    :param url: URL of the LXD API (scheme is either "http+unix", with the socket path percent-encoded into the host field, or "https"), defaults to "http+unix://%2Fvar%2Fsnap%2Flxd%2Fcommon%2Flxd%2Funix.socket"
+    :param cert: for HTTPS, paths to the client certificate and its private key, defaults to None
+    :param verify: for HTTPS, either the path to the server's certificate (or its CA) or whether to verify it against the system's CAs, defaults to True
+    :param pool_size: for HTTPS, maximum number of connections kept alive, defaults to 10 (should match the number of concurrent jobs)
+    :param instrumentation: collects the timings and counters of the Client's activity, defaults to a new one (see zebr0_lxd.instrumentation.Instrumentation)
+    :param retry: timeouts and retries of the requests, defaults to a new zebr0_lxd.RetryPolicy
+    :param cache_ttl: in seconds, enables a cache of the resources and instance states, shared by all the calls and refreshed once older than this, defaults to None (no cache, see zebr0_lxd.Inventory)
+    :param trace: records the API calls, defaults to None (see zebr0_lxd.instrumentation.Trace)
+    :param dry_run: whether to only send the read-only API calls, the others being answered without doing anything (see zebr0_lxd.instrumentation.TracingAdapter), defaults to False
     """
 
-    def __init__(self, url: str = URL_DEFAULT):
-        self.url = url
+    def __init__(self, url: str = URL_DEFAULT, cert: Optional[Tuple[str, str]] = None, verify: Union[bool, str] = True, pool_size: int = 10, instrumentation: Optional[Instrumentation] = None, retry: Optional[RetryPolicy] = None,
+                 cache_ttl: Optional[float] = None, trace: Optional[Trace] = None, dry_run: bool = False):
+        self.url = url.rstrip("/")
+        self.instrumentation = instrumentation or Instrumentation()
+        self.retry = retry or RetryPolicy()
 
         # this "hook" will be executed after each request (see http://docs.python-requests.org/en/master/user/advanced/#event-hooks)
         def hook(response, **_):
             if not response.ok:
-                raise Exception(response.text)
-
-            # some lxd operations are asynchronous (see https://linuxcontainers.org/lxd/docs/master/rest-api#async-operations)
-            # this can be problematic so we have to wait for them to finish before continuing (see https://linuxcontainers.org/lxd/docs/master/rest-api#10operationsuuidwait)
-            if response.json().get("type") == "async":
-                self.session.get(self.url + response.json().get("operation") + "/wait")
+                raise RequestError(response.request.method, response.url, response.status_code, response.text)
 
         self.session = requests_unixsocket.Session()
         self.session.hooks["response"].append(hook)
+        self.session.cert = cert
+        self.session.verify = verify
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+        if trace or dry_run:
+            for prefix in ("http+unix://", "https://"):
+                self.session.mount(prefix, TracingAdapter(self.session.get_adapter(prefix), trace, dry_run))
+
+        # measures each request, and the part of it spent waiting for LXD's response (see zebr0_lxd.instrumentation.Instrumentation)
+        request = self.session.request
+
+        def instrumented_request(method, url, *args, **kwargs):
+            labels = {"method": method.upper(), "resource": url[len(self.url):].split("?")[0].split("/")[2]}
+            start = time.perf_counter()
+            try:
+                response = request(method, url, *args, **kwargs)
+                self.instrumentation.record("server", response.elapsed.total_seconds(), **labels)
+                return response
+            finally:
+                self.instrumentation.record("request", time.perf_counter() - start, **labels)
+
+        # applies the timeout and retries of the retry policy (see zebr0_lxd.RetryPolicy)
+        def retrying_request(method, url, *args, **kwargs):
+            kwargs.setdefault("timeout", self.retry.timeout)
+            kwargs.setdefault("verify", self.session.verify)  # per request, as requests lets REQUESTS_CA_BUNDLE or CURL_CA_BUNDLE override the session's
+            kwargs.setdefault("cert", self.session.cert)
+            attempt = 0
+            while True:
+                try:
+                    return instrumented_request(method, url, *args, **kwargs)
+                except Exception as error:
+                    if attempt >= self.retry.retries or not self.retry.retryable(method, error):
+                        raise
+                    delay = self.retry.delay(attempt)
+                    self.logger.warning("retrying %s %s in %.1fs (%s)", method.upper(), url[len(self.url):], delay, error)
+                    time.sleep(delay)
+                    attempt += 1
+
+        self.session.request = retrying_request
+
+        self.inventory = Inventory(self, cache_ttl) if cache_ttl is not None else None  # type: Optional[Inventory]
+        self.logger = logger  # type: Union[logging.Logger, logging.LoggerAdapter]
+        self.dry_run = dry_run
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        """
+        Context manager during which existence and status checks are answered by a single Inventory instead of one API call each.
+        Nested snapshots share the outermost one, as well as the Client's cache, if any.
+        Resources modified outside of this Client during the snapshot won't be seen.
+        """
+
+        if self.inventory:
+            yield self.inventory
+            return
+
+        self.inventory = Inventory(self)
+        try:
+            yield self.inventory
+        finally:
+            self.inventory = None
+
+    def list(self, resource: Resource) -> Dict[str, dict]:
+        """
+        :param resource: the resources' type
+        :return: the existing resources of this type, as a dictionary of metadata indexed by name
+        """
+
+        return {metadata.get("name"): metadata for metadata in self.session.get(self.url + resource.path() + "?recursion=1").json().get("metadata")}
+
+    def operation(self, response) -> Optional[Operation]:
+        """
+        :param response: the response of a request to the LXD API
+        :return: a handle on the asynchronous operation started by the request, None if the request was synchronous
+        """
+
+        if response.json().get("type") == "async":
+            return Operation(self, response.json().get("operation"), response.json().get("metadata"))
+
+    def wait_all(self, operations: Iterable[Optional[Operation]], interval: float = 0.5, timeout: Optional[float] = None) -> None:
+        """
+        Blocks until all the given operations are over, then raises an OperationError if any of them failed.
+        Instead of one blocking call per operation, the list of operations is polled (see https://linuxcontainers.org/lxd/docs/master/rest-api#10operations).
+        The operations missing from the list, as LXD purges the finished ones after a few seconds, are read one by one.
+
+        :param operations: the operations, None values (i.e. synchronous requests) are ignored
+        :param interval: in seconds, the maximum delay between two polls, defaults to 0.5
+        :param timeout: in seconds, how long to wait before raising an OperationTimeout, defaults to the retry policy's
+        """
+
+        operations = [operation for operation in operations if operation]
+        pending = {operation.id(): operation for operation in operations if not operation.done()}
+        timeout = timeout if timeout is not None else self.retry.operation_timeout
+
+        if len(pending) == 1:
+            pending.popitem()[1].wait(timeout)
+
+        delay = 0.05
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self.instrumentation.span("operation", name="wait_all"):
+            while pending:
+                # returns the operations grouped by status, LXD keeps the finished ones for a few seconds
+                listed = set()
+                for metadatas in (self.session.get(self.url + "/1.0/operations?recursion=1").json().get("metadata") or {}).values():
+                    for metadata in metadatas:
+                        if metadata.get("id") in pending:
+                            pending[metadata.get("id")].metadata = metadata
+                            listed.add(metadata.get("id"))
+
+                for key in pending.keys() - listed:  # over and purged from the list since the last poll
+                    try:
+                        pending[key].metadata = self.session.get(self.url + pending[key].path).json().get("metadata")
+                    except RequestError as error:
+                        if error.status_code != 404:
+                            raise
+                        self.logger.warning("operation %s purged by LXD, assuming it succeeded", key)
+                        pending[key].metadata = dict(pending[key].metadata, status="Success", status_code=200)
+
+                pending = {key: operation for key, operation in pending.items() if not operation.done()}
+                if pending and deadline is not None and time.monotonic() >= deadline:
+                    operation = next(iter(pending.values()))
+                    raise OperationTimeout(operation, f"{len(pending)} operations (e.g. {operation.id()}) not over after {timeout}s")
+                if pending:
+                    time.sleep(delay)
+                    delay = min(delay * 2, interval)
+
+        for operation in operations:
+            operation.check()
 
     def exists(self, resource: Resource, name: str) -> bool:
         """
@@ -77,36 +1138,193 @@ class Client:
         :return: whether the resource exists or not
         """
 
-        print(f"checking {resource}/{name}")
+        self.logger.info("checking %s/%s", resource.value, name, extra={"event": {"action": "check", "resource": resource.value, "name": name}})
+        if self.inventory:
+            return name in self.inventory.get(resource)
+
         return any(filter(
             lambda a: a == resource.path() + "/" + name,
             self.session.get(self.url + resource.path()).json().get("metadata")  # returns a list of existing resources
         ))
 
-    def create(self, resource: Resource, config: dict) -> None:
+    def create(self, resource: Resource, config: dict, wait: bool = True) -> Optional[Operation]:
         """
         Creates a resource if it doesn't exist (based on its name).
         The required configuration depends on the resource's type (see zebr0_lxd.Client).
 
         :param resource: the resource's type
         :param config: the resource's desired configuration
+        :param wait: whether to wait for the creation to be over, defaults to True
+        :return: the creation's operation if it's asynchronous, None otherwise
         """
 
         if not self.exists(resource, config.get("name")):
-            print(f"creating {resource}/{json.dumps(config)}")
-            self.session.post(self.url + resource.path(), json=config)
+            self.logger.info("creating %s/%s", resource.value, LazyJson(config), extra={"event": {"action": "create", "resource": resource.value, "name": config.get("name"), "config": config}})
+            operation = self.operation(self.session.post(self.url + resource.path(), json=config))
+            if self.inventory:
+                self.inventory.add(resource, dict(config, status="Stopped") if resource == Resource.INSTANCES else config)
+            return operation.wait() if operation and wait else operation
 
-    def delete(self, resource: Resource, name: str) -> None:
+    def delete(self, resource: Resource, name: str, wait: bool = True) -> Optional[Operation]:
         """
         Deletes a resource if it exists (based on its name).
 
         :param resource: the resource's type
         :param name: the resource's name
+        :param wait: whether to wait for the deletion to be over, defaults to True
+        :return: the deletion's operation if it's asynchronous, None otherwise
         """
 
         if self.exists(resource, name):
-            print(f"deleting {resource}/{name}")
-            self.session.delete(self.url + resource.path() + "/" + name)
+            self.logger.info("deleting %s/%s", resource.value, name, extra={"event": {"action": "delete", "resource": resource.value, "name": name}})
+            operation = self.operation(self.session.delete(self.url + resource.path() + "/" + name))
+            if self.inventory:
+                self.inventory.discard(resource, name)
+            return operation.wait() if operation and wait else operation
+
+    def update(self, resource: Resource, name: str, changes: dict, wait: bool = True) -> Optional[Operation]:
+        """
+        Updates only the given fields of a resource (see zebr0_lxd.diff).
+
+        :param resource: the resource's type
+        :param name: the resource's name
+        :param changes: the fields to update
+        :param wait: whether to wait for the update to be over, defaults to True
+        :return: the update's operation if it's asynchronous, None otherwise
+        """
+
+        self.logger.info("updating %s/%s/%s", resource.value, name, LazyJson(changes), extra={"event": {"action": "update", "resource": resource.value, "name": name, "changes": changes}})
+        operation = self.operation(self.session.patch(self.url + resource.path() + "/" + name, json=changes))
+        if self.inventory and name in self.inventory.get(resource):
+            live = dict(self.inventory.get(resource).get(name))
+            for key, value in changes.items():
+                live[key] = dict(live.get(key), **value) if isinstance(value, dict) and isinstance(live.get(key), dict) else value
+            self.inventory.add(resource, live)
+        return operation.wait() if operation and wait else operation
+
+    def create_snapshot(self, name: str, snapshot: str, wait: bool = True) -> Optional[Operation]:
+        """
+        Creates a snapshot of an instance if it doesn't exist (based on its name).
+
+        :param name: the instance's name
+        :param snapshot: the snapshot's name
+        :param wait: whether to wait for the snapshot to be taken, defaults to True
+        :return: the snapshot's operation
+        """
+
+        path = Resource.INSTANCES.path() + "/" + name + "/snapshots"
+        try:
+            snapshots = self.session.get(self.url + path).json().get("metadata")
+        except RequestError as error:
+            if not (self.dry_run and error.status_code == 404):
+                raise
+            snapshots = []  # the instance only exists in the dry run
+
+        if path + "/" + snapshot not in snapshots:
+            self.logger.info("creating %s/%s/snapshots/%s", Resource.INSTANCES.value, name, snapshot, extra={"event": {"action": "snapshot", "resource": Resource.INSTANCES.value, "name": name, "snapshot": snapshot}})
+            operation = self.operation(self.session.post(self.url + path, json={"name": snapshot}))
+            return operation.wait() if operation and wait else operation
+
+    def rename(self, name: str, new_name: str, wait: bool = True) -> Optional[Operation]:
+        """
+        Renames a stopped instance, along with its snapshots.
+
+        :param name: the instance's name
+        :param new_name: the instance's new name
+        :param wait: whether to wait for the renaming to be over, defaults to True
+        :return: the renaming's operation
+        """
+
+        self.logger.info("renaming %s/%s to %s", Resource.INSTANCES.value, name, new_name, extra={"event": {"action": "rename", "resource": Resource.INSTANCES.value, "name": name, "new_name": new_name}})
+        operation = self.operation(self.session.post(self.url + Resource.INSTANCES.path() + "/" + name, json={"name": new_name}))
+        if self.inventory and name in self.inventory.get(Resource.INSTANCES):
+            self.inventory.add(Resource.INSTANCES, dict(self.inventory.get(Resource.INSTANCES).get(name), name=new_name))
+            self.inventory.discard(Resource.INSTANCES, name)
+        return operation.wait() if operation and wait else operation
+
+    def exec(self, name: str, command: List[str], timeout: Optional[float] = None) -> int:
+        """
+        Runs a command in an instance, without any input nor recorded output (see https://linuxcontainers.org/lxd/docs/master/rest-api#10instancesnameexec).
+
+        :param name: the instance's name
+        :param command: the command and its arguments
+        :param timeout: in seconds, how long to wait for the command to be over before raising an OperationTimeout, defaults to the retry policy's
+        :return: the command's exit code
+        """
+
+        operation = self.operation(self.session.post(self.url + Resource.INSTANCES.path() + "/" + name + "/exec", json={"command": command, "wait-for-websocket": False, "interactive": False, "record-output": False}))
+        return (operation.wait(timeout).metadata.get("metadata") or {}).get("return")
+
+    def is_ready(self, name: str, condition: str, timeout: Optional[float] = None) -> bool:
+        """
+        :param name: the instance's name
+        :param condition: either "ipv4" (a global IPv4 address is assigned), "cloud-init" (cloud-init is over) or "exec:<command>" (the command succeeds)
+        :param timeout: in seconds, how long a command may run before the instance is considered not ready, defaults to the retry policy's operation timeout
+        :return: whether the instance meets the condition
+        """
+
+        if condition == "ipv4":
+            state = self.session.get(self.url + Resource.INSTANCES.path() + "/" + name + "/state").json().get("metadata") or {}
+            return any(address.get("family") == "inet" and address.get("scope") == "global"
+                       for interface, network in (state.get("network") or {}).items() if interface != "lo" for address in network.get("addresses") or [])
+
+        try:  # e.g. the instance's agent isn't up yet, or the command hangs (OperationTimeout)
+            return self.exec(name, CLOUD_INIT_PROBE if condition == "cloud-init" else shlex.split(condition[len("exec:"):]), timeout) == 0
+        except LXDError:
+            return False
+
+    def wait_ready(self, names: List[str], conditions: List[str], timeout: Optional[float] = 300, jobs: Optional[int] = None, interval: float = 1) -> Dict[str, float]:
+        """
+        Blocks until the given instances are ready, i.e. meet all the readiness conditions in turn (see zebr0_lxd.Client.is_ready).
+        The instances are probed concurrently, against a deadline shared by all of them, a slow probe only delaying its own instance's next one.
+
+        :param names: the instances' names
+        :param conditions: the readiness conditions
+        :param timeout: in seconds, how long to wait for all the instances before raising a ReadinessTimeout, defaults to 300 (None to wait forever)
+        :param jobs: maximum number of instances probed concurrently, defaults to all of them (up to PROBE_JOBS)
+        :param interval: in seconds, the maximum delay between two rounds of probes, defaults to 1
+        :return: the readiness latency of each instance, in seconds since the call
+        """
+
+        unknown = [condition for condition in conditions if condition not in ("ipv4", "cloud-init") and not condition.startswith("exec:")]
+        if unknown:
+            raise ValueError(f"unknown readiness condition(s) {', '.join(unknown)}")
+
+        start = time.monotonic()
+        remaining = {name: list(conditions) for name in names}  # instance name -> conditions not met yet
+        latencies = {}
+
+        def probe(name: str) -> None:
+            # a hanging command mustn't outlast the deadline
+            while remaining.get(name) and self.is_ready(name, remaining.get(name)[0], max(start + timeout - time.monotonic(), 0.1) if timeout is not None else None):
+                remaining.get(name).pop(0)
+            if not remaining.get(name):
+                latencies[name] = time.monotonic() - start
+                self.logger.info("ready %s/%s in %.1fs", Resource.INSTANCES.value, name, latencies.get(name), extra={"event": {"action": "ready", "resource": Resource.INSTANCES.value, "name": name, "latency": latencies.get(name)}})
+                self.instrumentation.record("readiness", latencies.get(name))
+
+        delay = 0.1
+        probing = {}  # instance name -> its probe in progress
+        with self.instrumentation.span("phase", name="wait_ready"), concurrent.futures.ThreadPoolExecutor(max(min(jobs or PROBE_JOBS, len(names)), 1)) as executor:
+            while True:
+                end = time.monotonic() + delay
+                for name in names:
+                    if remaining.get(name) and name not in probing:
+                        probing[name] = executor.submit(probe, name)
+
+                # the round isn't held back by a slow probe (e.g. a hanging command), which is collected by a later one
+                concurrent.futures.wait(probing.values(), timeout=delay)
+                for name, future in list(probing.items()):
+                    if future.done():
+                        probing.pop(name).result()
+
+                pending = {name: remaining.get(name) for name in names if remaining.get(name)}
+                if not pending:
+                    return latencies
+                if timeout is not None and time.monotonic() - start >= timeout:
+                    raise ReadinessTimeout(f"{len(pending)} instance(s) not ready after {timeout}s: " + ", ".join(f"{name} ({conditions[0]})" for name, conditions in pending.items()), pending)
+                time.sleep(max(end - time.monotonic(), 0))
+                delay = min(delay * 2, interval)
 
     def is_running(self, name: str) -> bool:
         """
@@ -114,86 +1332,429 @@ class Client:
         :return: whether the instance is running or not
         """
 
-        print(f"checking {Resource.INSTANCES}/{name}")
+        self.logger.info("checking %s/%s", Resource.INSTANCES.value, name, extra={"event": {"action": "check", "resource": Resource.INSTANCES.value, "name": name}})
+        if self.inventory:
+            return self.inventory.get(Resource.INSTANCES).get(name, {}).get("status") == "Running"
+
         return self.session.get(self.url + Resource.INSTANCES.path() + "/" + name).json().get("metadata").get("status") == "Running"
 
-    def start(self, name: str) -> None:
+    def start(self, name: str, wait: bool = True) -> Optional[Operation]:
         """
         Starts an instance if it's not running (based on its name).
 
         :param name: the instance's name
+        :param wait: whether to wait for the instance to be started, defaults to True
+        :return: the state change's operation
         """
 
         if not self.is_running(name):
-            print(f"starting {Resource.INSTANCES}/{name}")
-            self.session.put(self.url + Resource.INSTANCES.path() + "/" + name + "/state", json={"action": "start"})
+            self.logger.info("starting %s/%s", Resource.INSTANCES.value, name, extra={"event": {"action": "start", "resource": Resource.INSTANCES.value, "name": name}})
+            operation = self.operation(self.session.put(self.url + Resource.INSTANCES.path() + "/" + name + "/state", json={"action": "start"}))
+            metadata = self.inventory.get(Resource.INSTANCES).get(name) if self.inventory else None
+            if metadata:  # e.g. not in a dry run, where the instance wasn't actually created
+                self.inventory.add(Resource.INSTANCES, dict(metadata, status="Running"))
+            return operation.wait() if operation and wait else operation
 
-    def stop(self, name: str) -> None:
+    def stop(self, name: str, wait: bool = True, force: bool = False, timeout: Optional[int] = None) -> Optional[Operation]:
         """
         Stops an instance if it's running (based on its name).
 
         :param name: the instance's name
+        :param wait: whether to wait for the instance to be stopped, defaults to True
+        :param force: whether to kill the instance instead of shutting it down cleanly, defaults to False
+        :param timeout: in seconds, how long LXD waits for a clean shutdown before giving up, defaults to LXD's own default
+        :return: the state change's operation
         """
 
         if self.is_running(name):
-            print(f"stopping {Resource.INSTANCES}/{name}")
-            self.session.put(self.url + Resource.INSTANCES.path() + "/" + name + "/state", json={"action": "stop"})
+            self.logger.info("stopping %s/%s", Resource.INSTANCES.value, name, extra={"event": {"action": "stop", "resource": Resource.INSTANCES.value, "name": name}})
+            state = dict({"action": "stop"}, **({"force": True} if force else {}), **({"timeout": timeout} if timeout is not None else {}))
+            operation = self.operation(self.session.put(self.url + Resource.INSTANCES.path() + "/" + name + "/state", json=state))
+            metadata = self.inventory.get(Resource.INSTANCES).get(name) if self.inventory else None
+            if metadata:  # e.g. not in a dry run, where the instance wasn't actually created
+                self.inventory.add(Resource.INSTANCES, dict(metadata, status="Stopped"))
+            return operation.wait() if operation and wait else operation
 
-    def create_stack(self, stack: dict) -> None:
+    def create_stack(self, stack: dict, jobs: int = 1, journal: Optional[Journal] = None, rollback: bool = False) -> None:
         """
         Creates the resources in the given stack if they don't exist (based on their name).
         The required configurations depend on the resource's type (see zebr0_lxd.Client).
+        A resource is only created once the resources it depends on have been (see zebr0_lxd.build_graph).
+        Existence checks rely on a single snapshot of the existing resources (see zebr0_lxd.Client.snapshot).
 
         :param stack: the stack as a dictionary
+        :param jobs: maximum number of resources processed concurrently, defaults to 1
+        :param journal: records each step, and skips the ones already done, defaults to None (see zebr0_lxd.Journal)
+        :param rollback: on failure, whether to delete the resources created by the journaled runs, defaults to False
+        """
+
+        with self.instrumentation.span("phase", name="create_stack"), self.snapshot():
+            self.warm_images_stack(stack)
+            self.journaled(stack, jobs, journal, rollback, {key: ("create", node.resource, node.name, node.config) for key, node in build_graph(stack).items()})
+
+    def journaled(self, stack: dict, jobs: int, journal: Optional[Journal], rollback: bool, plan: Dict[Tuple[Resource, str], Tuple[str, Resource, str, dict]]) -> None:
         """
+        Executes the steps of a plan (see zebr0_lxd.Client.plan_stack) in the stack's dependency order, recording them in the journal, if any.
+        On failure, the resources created by the journaled runs are deleted if requested, in reverse dependency order.
+        The snapshots instances are copied from are taken just before the first copy (see zebr0_lxd.expand_replicas).
+        """
+
+        graph = build_graph(stack)
+        snapshots, taken, lock = clone_snapshots(graph), set(), threading.Lock()
 
-        for resource in list(Resource):  # order: storage pools, networks, profiles, instances
-            for config in stack.get(resource) or []:
+        def step(node: Node) -> None:
+            action, resource, name, config = plan.get(node.key())
+            created = journal is not None and name not in self.inventory.get(resource)  # journaled runs happen during a snapshot
+            if action == "create":
+                source = str((config.get("source") or {}).get("source")).split("/")[0]
+                if resource == Resource.INSTANCES and source in snapshots and name not in self.inventory.get(resource):
+                    with lock:
+                        if source not in taken:
+                            self.create_snapshot(source, snapshots.get(source))
+                            taken.add(source)
                 self.create(resource, config)
+            else:
+                self.update(resource, name, config)
+            if journal:
+                journal.record(action, resource, name, node.config, created)
+
+        try:
+            execute({key: node for key, node in graph.items() if key in plan and not (journal and journal.done(node.resource, node.name, node.config))}, step, jobs)
+        except Exception:
+            if journal and rollback:
+                created = set(journal.created())
+                self.logger.warning("rolling back %s created resource(s)", len(created))
+                execute({key: node for key, node in graph.items() if key in created}, lambda node: self.delete(node.resource, node.name), jobs, reverse=True)
+                journal.clear()
+            raise
+
+        if journal:
+            journal.clear()
+
+    def warm_images_stack(self, stack: dict) -> None:
+        """
+        Downloads the images of the instances in the given stack, unless they're already present in the local image store.
+        Each distinct image is downloaded once, all the downloads running concurrently (see zebr0_lxd.Client.wait_all).
+        Instances that already exist are ignored, as well as the ones whose source isn't a remote image.
+
+        :param stack: the stack as a dictionary
+        """
+
+        candidates = [(config.get("name"), config.get("source")) for config in stack.get(Resource.INSTANCES) or []
+                      if (config.get("source") or {}).get("type") == "image" and config.get("source").get("server") and (config.get("source").get("alias") or config.get("source").get("fingerprint"))]
+        if not candidates:
+            return
+
+        with self.instrumentation.span("phase", name="warm_images_stack"), self.snapshot() as inventory:
+            instances = inventory.get(Resource.INSTANCES)
+            sources = {}  # (server, alias or fingerprint) -> image source, to deduplicate the downloads
+            for name, source in candidates:
+                if name not in instances:
+                    sources.setdefault((source.get("server"), source.get("alias") or source.get("fingerprint")), source)
+
+            # remote images cached by LXD remember where they come from in their "update_source"
+            images = self.session.get(self.url + "/1.0/images?recursion=1").json().get("metadata") or []
+            present = {((image.get("update_source") or {}).get("server"), (image.get("update_source") or {}).get("alias")) for image in images}
+            fingerprints = [image.get("fingerprint") for image in images]
+
+            operations = []
+            for (server, reference), source in sources.items():
+                if (server, reference) in present or (source.get("fingerprint") and any(fingerprint.startswith(source.get("fingerprint")) for fingerprint in fingerprints)):
+                    continue
+                image = {key: value for key, value in source.items() if key in IMAGE_SOURCE_FIELDS}
+                self.logger.info("downloading images/%s", LazyJson(image), extra={"event": {"action": "download", "resource": "images", "source": image}})
+                operations.append(self.operation(self.session.post(self.url + "/1.0/images", json={"source": dict(image, type="image", mode="pull")})))
+            self.wait_all(operations)
+
+    def plan_stack(self, stack: dict) -> List[Tuple[str, Resource, str, dict]]:
+        """
+        Computes the minimal changes needed for LXD to match the given stack, without applying them.
+        Live configurations are fetched with a single call per resource type (see zebr0_lxd.Client.snapshot).
 
-    def delete_stack(self, stack: dict) -> None:
+        :param stack: the stack as a dictionary
+        :return: the changes, in the stack's dependency order, as ("create", resource, name, config) or ("update", resource, name, fields) tuples
+        """
+
+        plan = []
+        with self.instrumentation.span("phase", name="plan_stack"), self.snapshot() as inventory:
+            for node in build_graph(stack).values():
+                live = inventory.get(node.resource).get(node.name)
+                if live is None:
+                    plan.append(("create", node.resource, node.name, node.config))
+                else:
+                    changes = diff(node.config, live)
+                    if changes:
+                        plan.append(("update", node.resource, node.name, changes))
+        return plan
+
+    def apply_stack(self, stack: dict, jobs: int = 1, journal: Optional[Journal] = None, rollback: bool = False) -> None:
+        """
+        Creates the missing resources of the given stack, and updates only the changed fields of the existing ones (see zebr0_lxd.Client.plan_stack).
+        Unlike a deletion followed by a creation, existing instances are modified in place.
+
+        :param stack: the stack as a dictionary
+        :param jobs: maximum number of resources processed concurrently, defaults to 1
+        :param journal: records each step, and skips the ones already done without fetching them, defaults to None (see zebr0_lxd.Journal)
+        :param rollback: on failure, whether to delete the resources created by the journaled runs (updates aren't reverted), defaults to False
+        """
+
+        with self.instrumentation.span("phase", name="apply_stack"), self.snapshot():
+            graph = build_graph(stack)
+            pending = {resource: [node.config for node in graph.values() if node.resource == resource and not (journal and journal.done(resource, node.name, node.config))] for resource in Resource}
+            plan = {(resource, name): (action, resource, name, config) for action, resource, name, config in self.plan_stack(pending)}
+            self.journaled(stack, jobs, journal, rollback, plan)
+
+    def export_stack(self, selector: str = "*") -> Iterator[Tuple[Resource, dict]]:
+        """
+        Reads the live resources back as a stack (see zebr0_lxd.dump_stack), e.g. to start managing an existing host with stacks.
+        Each resource type is fetched with a single recursive call, and the fields set by LXD are stripped (see zebr0_lxd.strip_generated).
+        The resources whose name matches the selector are exported, along with the ones they depend on (see zebr0_lxd.build_graph).
+        Unmanaged networks (i.e. the host's interfaces) are never exported.
+
+        :param selector: shell-style pattern (see fnmatch) matching the names of the resources to export, defaults to "*"
+        :return: the resources, in the stack's order, as (resource, config) tuples
+        """
+
+        with self.instrumentation.span("phase", name="export_stack"):
+            live = {resource: [metadata for metadata in self.list(resource).values() if metadata.get("managed", True)] for resource in Resource}
+
+        graph = build_graph(live)
+        selected = set()
+        pending = [key for key in graph if fnmatch.fnmatchcase(key[1], selector)]
+        while pending:
+            key = pending.pop()
+            if key not in selected:
+                selected.add(key)
+                pending.extend(graph.get(key).dependencies)
+
+        for key, node in graph.items():
+            if key in selected:
+                yield node.resource, strip_generated(node.resource, node.config)
+
+    def delete_stack(self, stack: dict, jobs: int = 1) -> None:
         """
         Deletes the resources in the given stack if they exist (based on their name).
+        A resource is only deleted once the resources depending on it have been (see zebr0_lxd.build_graph).
+        Resources shared with other stacks aren't protected, see zebr0_lxd.Client.delete_stacks.
 
         :param stack: the stack as a dictionary
+        :param jobs: maximum number of resources processed concurrently, defaults to 1
+        """
+
+        with self.instrumentation.span("phase", name="delete_stack"), self.snapshot():
+            execute(build_graph(stack), lambda node: self.delete(node.resource, node.name), jobs, reverse=True)
+
+    def delete_stacks(self, stacks: List[dict], jobs: int = 1, keep: Iterable[dict] = ()) -> None:
         """
+        Deletes the resources of several stacks in a single pass, with a single snapshot of the existing resources (see zebr0_lxd.merge_stacks).
+        Unlike instances, shared resources (storage pools, networks and profiles) are reference-counted, and kept if they're still referenced:
 
-        for resource in reversed(Resource):  # order: instances, profiles, networks, storage pools
-            for config in stack.get(resource) or []:
-                self.delete(resource, config.get("name"))
+        * either by one of the stacks to keep
+        * or, according to LXD's "used_by" field, by an instance or profile that isn't deleted in this pass (e.g. an instance from a stack not given here)
 
-    def start_stack(self, stack: dict) -> None:
+        Other users, like the images and volumes LXD keeps in a storage pool once an image has been unpacked on it, don't retain a resource.
+
+        :param stacks: the stacks to delete, as dictionaries
+        :param jobs: maximum number of resources processed concurrently, defaults to 1
+        :param keep: the stacks remaining on the host, as dictionaries, defaults to none
+        """
+
+        def reference(path: str) -> Optional[Tuple[Resource, str]]:
+            parts = urllib.parse.urlparse(path).path.split("/")  # e.g. ["", "1.0", "instances", "test-instance"], but also ["", "1.0", "images", "<fingerprint>"]
+            if len(parts) == 4 and parts[2] in (Resource.INSTANCES.value, Resource.PROFILES.value):
+                return Resource(parts[2]), urllib.parse.unquote(parts[3])
+
+        def delete(node: Node) -> None:
+            if node.resource != Resource.INSTANCES:
+                if node.key() in kept:
+                    self.logger.info("keeping %s/%s, still referenced by another stack", node.resource.value, node.name, extra={"event": {"action": "keep", "resource": node.resource.value, "name": node.name}})
+                    retained.add(node.key())
+                    return
+
+                # the resources depending on this one have been processed already, hence the "retained" set being up to date
+                used_by = [path for path in (inventory.get(node.resource).get(node.name) or {}).get("used_by") or [] if reference(path) and (reference(path) not in graph or reference(path) in retained)]
+                if used_by:
+                    self.logger.info("keeping %s/%s, still used by %s", node.resource.value, node.name, LazyJson(used_by), extra={"event": {"action": "keep", "resource": node.resource.value, "name": node.name, "used_by": used_by}})
+                    retained.add(node.key())
+                    return
+            self.delete(node.resource, node.name)
+
+        stack, _ = merge_stacks(stacks)
+        _, kept = merge_stacks(keep)
+        retained = set()  # keys of the shared resources kept so far
+        with self.instrumentation.span("phase", name="delete_stacks"), self.snapshot() as inventory:
+            graph = build_graph(stack)
+            execute(graph, delete, jobs, reverse=True)
+
+    def start_stack(self, stack: dict, jobs: int = 1, ready: Iterable[str] = (), ready_timeout: Optional[float] = 300) -> Dict[str, float]:
         """
         Starts the instances in the given stack if they're not running (based on their name).
+        The states are read in a single call, then all the state changes are dispatched before being waited for together (see zebr0_lxd.Client.wait_all).
+        Then, if readiness conditions are given, waits for the instances to be ready (see zebr0_lxd.Client.wait_ready).
 
         :param stack: the stack as a dictionary
+        :param jobs: maximum number of state changes dispatched concurrently, defaults to 1
+        :param ready: the readiness conditions (see zebr0_lxd.Client.is_ready), defaults to none
+        :param ready_timeout: in seconds, how long to wait for all the instances to be ready, defaults to 300
+        :return: the readiness latency of each instance, if waited for
         """
 
-        for config in stack.get(Resource.INSTANCES) or []:
-            self.start(config.get("name"))
+        operations = []
+        graph = build_graph({Resource.INSTANCES: stack.get(Resource.INSTANCES)})
+        with self.instrumentation.span("phase", name="start_stack"), self.snapshot():
+            execute(graph, lambda node: operations.append(self.start(node.name, wait=False)), jobs)
+            self.wait_all(operations)
 
-    def stop_stack(self, stack: dict) -> None:
+        return self.wait_ready([node.name for node in graph.values()], list(ready), ready_timeout) if ready else {}
+
+    def stop_stack(self, stack: dict, jobs: int = 1, force: bool = False, timeout: Optional[int] = None) -> None:
         """
         Stops the instances in the given stack if they're running (based on their name).
+        The states are read in a single call, then all the state changes are dispatched before being waited for together (see zebr0_lxd.Client.wait_all).
+
+        :param stack: the stack as a dictionary
+        :param jobs: maximum number of state changes dispatched concurrently, defaults to 1
+        :param force: whether to kill the instances instead of shutting them down cleanly, defaults to False
+        :param timeout: in seconds, how long LXD waits for each clean shutdown before giving up, defaults to LXD's own default
+        """
+
+        operations = []
+        with self.instrumentation.span("phase", name="stop_stack"), self.snapshot():
+            execute(build_graph({Resource.INSTANCES: stack.get(Resource.INSTANCES)}), lambda node: operations.append(self.stop(node.name, wait=False, force=force, timeout=timeout)), jobs)
+            self.wait_all(operations)
+
+    def rolling_stack(self, stack: dict, mode: str = "restart", max_unavailable: int = 1, max_surge: int = 0, ready: Iterable[str] = (), ready_timeout: Optional[float] = 300,
+                      force: bool = False, timeout: Optional[int] = None) -> Dict[str, float]:
+        """
+        Restarts ("restart" mode) or re-creates ("replace" mode) the instances in the given stack, a few at a time, so that the others keep serving.
+        Instead of lockstep batches, the instances are rolled through a sliding window: as soon as one is back (i.e. started, and ready if readiness conditions are given), the next one is taken down.
+        In "replace" mode, up to "max_surge" replacements are created ahead of time under a temporary name (see zebr0_lxd.SURGE_SUFFIX) while their instances still run,
+        so that an instance is only down while it's swapped with its replacement. An instance copied from another one is only replaced once its source has been.
+        When an instance fails to roll, no new one is taken down and the exception is raised once the rolling ones are over.
 
         :param stack: the stack as a dictionary
+        :param mode: either "restart" or "replace", defaults to "restart"
+        :param max_unavailable: maximum number of instances down at the same time, defaults to 1
+        :param max_surge: in "replace" mode, maximum number of replacements created ahead of time, defaults to 0
+        :param ready: the readiness conditions an instance must meet to be back (see zebr0_lxd.Client.is_ready), defaults to none
+        :param ready_timeout: in seconds, how long to wait for each instance to be ready, defaults to 300
+        :param force: whether to kill the instances instead of shutting them down cleanly, defaults to False
+        :param timeout: in seconds, how long LXD waits for each clean shutdown before giving up, defaults to LXD's own default
+        :return: how long each instance was down, in seconds
         """
 
-        for config in stack.get(Resource.INSTANCES) or []:
-            self.stop(config.get("name"))
+        if mode not in ROLLING_MODES:
+            raise ValueError(f"unknown rolling mode {mode}")
+
+        graph = build_graph({Resource.INSTANCES: stack.get(Resource.INSTANCES)})
+        snapshots, taken, lock = clone_snapshots(graph), set(), threading.Lock()
+        surge = mode == "replace" and max_surge > 0
+        surging, unavailable = threading.Semaphore(max(max_surge, 1)), threading.Semaphore(max(max_unavailable, 1))
+        rolled = {key: threading.Event() for key in graph}
+        failed = threading.Event()
+        downtimes = {}
+
+        def prepare(node: Node, name: str) -> None:
+            source = str((node.config.get("source") or {}).get("source")).split("/")[0]
+            if source in snapshots:  # the previous one went away with the replaced source
+                with lock:
+                    if source not in taken:
+                        self.create_snapshot(source, snapshots.get(source))
+                        taken.add(source)
+            self.create(Resource.INSTANCES, dict(node.config, name=name))
+
+        def roll(node: Node) -> None:
+            surged = False  # whether this instance holds a surge slot
+            try:
+                for dependency in node.dependencies:  # earlier in the stack, hence already rolling
+                    rolled.get(dependency).wait()
+
+                if surge:
+                    surging.acquire()
+                    surged = True
+                    if failed.is_set():
+                        return
+                    prepare(node, node.name + SURGE_SUFFIX)
+
+                with unavailable:
+                    if failed.is_set():
+                        return
+                    start = time.monotonic()
+                    self.stop(node.name, force=force, timeout=timeout)
+                    if mode == "replace":
+                        self.delete(Resource.INSTANCES, node.name)
+                        if surge:
+                            self.rename(node.name + SURGE_SUFFIX, node.name)
+                            surging.release()  # the next replacement can be created while this instance starts
+                            surged = False
+                        else:
+                            prepare(node, node.name)
+                    self.start(node.name)
+                    if ready:
+                        self.wait_ready([node.name], list(ready), ready_timeout)
+                    downtimes[node.name] = time.monotonic() - start
+                    self.logger.info("rolled %s/%s in %.1fs", Resource.INSTANCES.value, node.name, downtimes.get(node.name), extra={"event": {"action": "rolled", "resource": Resource.INSTANCES.value, "name": node.name, "downtime": downtimes.get(node.name)}})
+            except Exception:
+                failed.set()
+                raise
+            finally:
+                if surged:
+                    surging.release()
+                rolled.get(node.key()).set()
+
+        with self.instrumentation.span("phase", name="rolling_stack"), self.snapshot(), concurrent.futures.ThreadPoolExecutor(max(max_unavailable, 1) + (max_surge if surge else 0)) as executor:
+            for future in [executor.submit(roll, node) for node in graph.values()]:  # in the stack's order, so that the sources roll before their copies
+                future.result()
+
+        return downtimes
+
+
+def run_fleet(urls: List[str], function: Callable[[Client], None], jobs: int = 10, **kwargs) -> Dict[str, Optional[Exception]]:
+    """
+    Calls a function on a Client per LXD host, with up to "jobs" hosts processed concurrently.
+    A failure on a host doesn't prevent the other hosts from being processed.
+    The Clients' logs are attributed to their host (see zebr0_lxd.HostAdapter).
+
+    :param urls: URLs of the LXD APIs
+    :param function: the function to call on each host's Client
+    :param jobs: maximum number of hosts processed concurrently, defaults to 10
+    :param kwargs: other parameters of the Clients (see zebr0_lxd.Client)
+    :return: the result per URL: None if the call succeeded, its exception otherwise
+    """
+
+    def run(url: str) -> Optional[Exception]:
+        client = Client(url, **kwargs)
+        client.logger = HostAdapter(logger, {"host": url})
+        try:
+            function(client)
+        except Exception as exception:
+            return exception
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        return dict(zip(urls, executor.map(run, urls)))
+
+
+def read_hosts(path: str) -> List[str]:
+    """
+    :param path: path to a file listing one LXD API URL per line (empty lines and lines starting with "#" are ignored)
+    :return: the URLs
+    """
+
+    with open(path) as file:
+        return [line.strip() for line in file if line.strip() and not line.strip().startswith("#")]
 
 
 def main(args: Optional[List[str]] = None) -> None:
     """
-    usage: zebr0-lxd [-h] [-u <url>] [-l [<level> [<level> ...]]] [-c <duration>] [-f <path>] [--lxd-url <url>] {create,delete,start,stop} [key]
+    usage: zebr0-lxd [-h] [-u <url>] [-l [<level> [<level> ...]]] [-c <duration>] [-f <path>] [--lxd-url <url>] [--lxd-cert <path>] [--lxd-key <path>] [--lxd-verify <path>] [--lxd-hosts <path>] [--host-jobs <n>] [--jobs <n>] [--stop-force] [--stop-timeout <seconds>] [--profile] [--log-format {human,json}] [--quiet] [--watch-debounce <seconds>] [--watch-interval <seconds>] [--retries <n>] [--timeout <seconds>] [--operation-timeout <seconds>] [--resume] [--rollback-on-failure] [--selector <pattern>] [--keep <key>] [--ready <condition>] [--ready-timeout <seconds>] [--rolling-mode {restart,replace}] [--max-unavailable <n>] [--max-surge <n>] [--dry-run] [--trace <path>] {create,delete,start,stop,plan,apply,warm-images,watch,export,rolling} [key [key ...]]
 
     LXD provisioning based on zebr0 key-value system.
     Fetches a stack from the key-value server and manages it on LXD.
 
     positional arguments:
-      {create,delete,start,stop}
-                            operation to execute on the stack
-      key                   the stack's key, defaults to 'lxd-stack'
+      {create,delete,start,stop,plan,apply,warm-images,watch,export,rolling}
+                            operation to execute on the stack, "watch" keeps the stack created and running by reacting to LXD's events, "export" prints the live resources as a yaml stack, "rolling" restarts or re-creates the instances a few at a time
+      key                   the stack's key, defaults to 'lxd-stack', several stacks can be given (fetched concurrently and managed as one, their shared resources once)
 
     optional arguments:
       -h, --help            show this help message and exit
@@ -205,23 +1766,148 @@ def main(args: Optional[List[str]] = None) -> None:
                             in seconds, the duration of the cache of http responses, defaults to 300 seconds
       -f <path>, --configuration-file <path>
                             path to the configuration file, defaults to /etc/zebr0.conf for a system-wide configuration
-      --lxd-url <url>       URL of the LXD API (scheme is "http+unix", socket path is percent-encoded into the host field), defaults to "http+unix://%2Fvar%2Fsnap%2Flxd%2Fcommon%2Flxd%2Funix.socket"
+      --lxd-url <url>       URL of the LXD API (scheme is either "http+unix", with the socket path percent-encoded into the host field, or "https"), defaults to "http+unix://%2Fvar%2Fsnap%2Flxd%2Fcommon%2Flxd%2Funix.socket", can be repeated to manage several hosts
+      --lxd-cert <path>     for HTTPS, path to the client certificate
+      --lxd-key <path>      for HTTPS, path to the client certificate's private key
+      --lxd-verify <path>   for HTTPS, path to the server's certificate (or its CA), defaults to the system's CAs
+      --lxd-hosts <path>
+                            path to a file listing LXD API URLs, one per line, to manage several hosts
+      --host-jobs <n>       maximum number of hosts processed concurrently, defaults to 10
+      --jobs <n>            maximum number of resources processed concurrently, defaults to 1
+      --stop-force          when stopping or rolling, kills the instances instead of shutting them down cleanly
+      --stop-timeout <seconds>
+                            when stopping or rolling, how long LXD waits for each clean shutdown before giving up
+      --profile             prints a breakdown of where the time went at the end of the run
+      --log-format {human,json}
+                            format of the log of checks and changes, defaults to "human"
+      --quiet               doesn't log the checks and changes
+      --watch-debounce <seconds>
+                            when watching, how long to wait after the last event before reconciling, defaults to 1
+      --watch-interval <seconds>
+                            when watching, the minimum delay between two reconciliations, defaults to 5
+      --retries <n>         maximum number of retries of an idempotent request when LXD is busy or unreachable, defaults to 3
+      --timeout <seconds>   how long to wait for LXD's response to a request, defaults to 30
+      --operation-timeout <seconds>
+                            how long to wait for an asynchronous operation (e.g. an instance creation) to be over, defaults to forever
+      --resume              when creating or applying, skips the steps completed by the previous failed run (recorded in $XDG_CACHE_HOME/zebr0-lxd/checkpoints)
+      --rollback-on-failure
+                            when creating or applying, deletes the resources created by the run (and the runs it resumes) if it fails
+      --selector <pattern>  when exporting, shell-style pattern matching the names of the resources to export (along with their dependencies), defaults to "*"
+      --keep <key>          when deleting, key of a stack remaining on the host, whose shared resources are kept, can be repeated
+      --ready <condition>   when starting or rolling, waits for the instances to be ready: "ipv4" (an address is assigned), "cloud-init" (it's over) or "exec:<command>" (the command succeeds), can be repeated
+      --ready-timeout <seconds>
+                            when starting, how long to wait for all the instances to be ready, when rolling, for each instance, defaults to 300
+      --rolling-mode {restart,replace}
+                            when rolling, whether to restart the instances or to re-create them, defaults to "restart"
+      --max-unavailable <n>
+                            when rolling, maximum number of instances down at the same time, defaults to 1
+      --max-surge <n>       when rolling in "replace" mode, maximum number of replacements created ahead of time, defaults to 0
+      --dry-run             only reads from LXD, logging the changes that would be made instead of making them
+      --trace <path>        path to a file recording the API calls, with their responses and timings, as json lines (see zebr0_lxd.testing.TestServer to replay it)
     """
 
     argparser = zebr0.build_argument_parser(description="LXD provisioning based on zebr0 key-value system.\nFetches a stack from the key-value server and manages it on LXD.", formatter_class=argparse.RawDescriptionHelpFormatter)
-    argparser.add_argument("command", choices=["create", "delete", "start", "stop"], help="operation to execute on the stack")
-    argparser.add_argument("key", nargs="?", default="lxd-stack", help="the stack's key, defaults to 'lxd-stack'")
-    argparser.add_argument("--lxd-url", default=URL_DEFAULT, help='URL of the LXD API (scheme is "http+unix", socket path is percent-encoded into the host field), defaults to "http+unix://%%2Fvar%%2Fsnap%%2Flxd%%2Fcommon%%2Flxd%%2Funix.socket"', metavar="<url>")
+    argparser.add_argument("command", choices=["create", "delete", "start", "stop", "plan", "apply", "warm-images", "watch", "export", "rolling"], help='operation to execute on the stack, "watch" keeps the stack created and running by reacting to LXD\'s events, "export" prints the live resources as a yaml stack, "rolling" restarts or re-creates the instances a few at a time')
+    argparser.add_argument("key", nargs="*", default=[KEY_DEFAULT], help="the stack's key, defaults to 'lxd-stack', several stacks can be given (fetched concurrently and managed as one, their shared resources once)")
+    argparser.add_argument("--lxd-url", action="append", help='URL of the LXD API (scheme is either "http+unix", with the socket path percent-encoded into the host field, or "https"), defaults to "http+unix://%%2Fvar%%2Fsnap%%2Flxd%%2Fcommon%%2Flxd%%2Funix.socket", can be repeated to manage several hosts', metavar="<url>")
+    argparser.add_argument("--lxd-cert", help="for HTTPS, path to the client certificate", metavar="<path>")
+    argparser.add_argument("--lxd-key", help="for HTTPS, path to the client certificate's private key", metavar="<path>")
+    argparser.add_argument("--lxd-verify", default=True, help="for HTTPS, path to the server's certificate (or its CA), defaults to the system's CAs", metavar="<path>")
+    argparser.add_argument("--lxd-hosts", help="path to a file listing LXD API URLs, one per line, to manage several hosts", metavar="<path>")
+    argparser.add_argument("--host-jobs", type=int, default=10, help="maximum number of hosts processed concurrently, defaults to 10", metavar="<n>")
+    argparser.add_argument("--jobs", type=int, default=1, help="maximum number of resources processed concurrently, defaults to 1", metavar="<n>")
+    argparser.add_argument("--stop-force", action="store_true", help="when stopping or rolling, kills the instances instead of shutting them down cleanly")
+    argparser.add_argument("--stop-timeout", type=int, help="when stopping or rolling, how long LXD waits for each clean shutdown before giving up", metavar="<seconds>")
+    argparser.add_argument("--profile", action="store_true", help="prints a breakdown of where the time went at the end of the run")
+    argparser.add_argument("--log-format", choices=["human", "json"], default="human", help='format of the log of checks and changes, defaults to "human"')
+    argparser.add_argument("--quiet", action="store_true", help="doesn't log the checks and changes")
+    argparser.add_argument("--watch-debounce", type=float, default=1, help="when watching, how long to wait after the last event before reconciling, defaults to 1", metavar="<seconds>")
+    argparser.add_argument("--watch-interval", type=float, default=5, help="when watching, the minimum delay between two reconciliations, defaults to 5", metavar="<seconds>")
+    argparser.add_argument("--retries", type=int, default=3, help="maximum number of retries of an idempotent request when LXD is busy or unreachable, defaults to 3", metavar="<n>")
+    argparser.add_argument("--timeout", type=float, default=30, help="how long to wait for LXD's response to a request, defaults to 30", metavar="<seconds>")
+    argparser.add_argument("--operation-timeout", type=float, help="how long to wait for an asynchronous operation (e.g. an instance creation) to be over, defaults to forever", metavar="<seconds>")
+    argparser.add_argument("--resume", action="store_true", help="when creating or applying, skips the steps completed by the previous failed run (recorded in $XDG_CACHE_HOME/zebr0-lxd/checkpoints)")
+    argparser.add_argument("--rollback-on-failure", action="store_true", help="when creating or applying, deletes the resources created by the run (and the runs it resumes) if it fails")
+    argparser.add_argument("--selector", default="*", help='when exporting, shell-style pattern matching the names of the resources to export (along with their dependencies), defaults to "*"', metavar="<pattern>")
+    argparser.add_argument("--keep", action="append", help="when deleting, key of a stack remaining on the host, whose shared resources are kept, can be repeated", metavar="<key>")
+    argparser.add_argument("--ready", action="append", help='when starting or rolling, waits for the instances to be ready: "ipv4" (an address is assigned), "cloud-init" (it\'s over) or "exec:<command>" (the command succeeds), can be repeated', metavar="<condition>")
+    argparser.add_argument("--ready-timeout", type=float, default=300, help="when starting, how long to wait for all the instances to be ready, when rolling, for each instance, defaults to 300", metavar="<seconds>")
+    argparser.add_argument("--rolling-mode", choices=ROLLING_MODES, default="restart", help='when rolling, whether to restart the instances or to re-create them, defaults to "restart"')
+    argparser.add_argument("--max-unavailable", type=int, default=1, help="when rolling, maximum number of instances down at the same time, defaults to 1", metavar="<n>")
+    argparser.add_argument("--max-surge", type=int, default=0, help='when rolling in "replace" mode, maximum number of replacements created ahead of time, defaults to 0', metavar="<n>")
+    argparser.add_argument("--dry-run", action="store_true", help="only reads from LXD, logging the changes that would be made instead of making them")
+    argparser.add_argument("--trace", help="path to a file recording the API calls, with their responses and timings, as json lines (see zebr0_lxd.testing.TestServer to replay it)", metavar="<path>")
     args = argparser.parse_args(args)
 
-    value = zebr0.Client(args.url, args.levels, args.cache, args.configuration_file).get(args.key)
-    if not value:
-        print(f"key '{args.key}' not found on server {args.url}")
+    configure_logging(args.log_format, args.quiet or args.command == "export")  # the export's output is the yaml stack itself
+
+    stacks, kept = {}, {}  # key -> stack, for the stacks to manage and the ones to keep when deleting
+    for key, value in (fetch_values(args.key + (args.keep or []), args.url, args.levels, args.cache, args.configuration_file) if args.command != "export" else {}).items():
+        if not value:
+            print(f"key '{key}' not found on server {args.url}")
+            exit(1)
+
+        try:
+            (stacks if key in args.key else kept)[key] = stack = render_stack(compile_stack(value), args.levels)
+            build_graph(stack)  # the rendering is lazy, this checks the generated resources before anything is done
+        except StackError as error:
+            print(f"key '{key}' on server {args.url} {error}")
+            exit(1)
+
+    try:  # several stacks are managed as one, in a single pass
+        stack = merge_stacks(stacks.values())[0] if len(stacks) > 1 else next(iter(stacks.values()), {})
+    except StackError as error:
+        print(f"keys '{' '.join(stacks)}' on server {args.url} {error}")
         exit(1)
 
-    stack = yaml.load(value, Loader=yaml.BaseLoader)
-    if not isinstance(stack, dict):
-        print(f"key '{args.key}' on server {args.url} is not a proper yaml or json dictionary")
+    ready = args.ready if args.ready and not args.dry_run else ()  # nothing is started in dry-run mode
+
+    urls = (args.lxd_url or []) + (read_hosts(args.lxd_hosts) if args.lxd_hosts else [])
+
+    def run(client: Client) -> None:
+        prefix = client.url + ": " if len(urls) > 1 else ""  # the output of concurrent hosts is interleaved
+        if args.command == "export":
+            dump_stack(client.export_stack(args.selector), sys.stdout)
+        elif args.command == "watch":
+            from zebr0_lxd.watch import Watcher  # the module depends on this one
+            Watcher(client, stack, args.watch_debounce, args.watch_interval, args.jobs).run()
+        elif args.command == "plan":
+            for action, resource, name, config in client.plan_stack(stack):
+                print(f"{prefix}{action} {resource.value}/{name}/{json.dumps(config)}")
+        elif args.command == "warm-images":
+            client.warm_images_stack(stack)
+        elif args.command == "stop":
+            client.stop_stack(stack, args.jobs, args.stop_force, args.stop_timeout)
+        elif args.command in ("create", "apply"):
+            journal = Journal(checkpoint_path(client.url, " ".join(stacks)), args.resume) if not args.dry_run else None
+            getattr(client, args.command + "_stack")(stack, args.jobs, journal, args.rollback_on_failure)
+        elif args.command == "rolling":
+            client.rolling_stack(stack, args.rolling_mode, args.max_unavailable, args.max_surge, ready, args.ready_timeout, args.stop_force, args.stop_timeout)
+        elif args.command == "delete":
+            client.delete_stacks(list(stacks.values()), args.jobs, list(kept.values()))
+        else:
+            client.start_stack(stack, args.jobs, ready, args.ready_timeout)
+
+        if args.profile:
+            print("\n".join(prefix + line for line in client.instrumentation.report().splitlines()))
+
+    trace = Trace() if args.trace else None
+    options = {"cert": (args.lxd_cert, args.lxd_key) if args.lxd_cert else None, "verify": args.lxd_verify, "pool_size": max(args.jobs, 10), "retry": RetryPolicy(args.retries, timeout=args.timeout, operation_timeout=args.operation_timeout),
+               "trace": trace, "dry_run": args.dry_run}
+    if args.command == "export" and len(urls) > 1:
+        print("export works on a single host")
         exit(1)
+    try:  # the trace is written even if the run fails, slow or failed runs being the ones worth replaying
+        if len(urls) <= 1:
+            run(Client(urls[0] if urls else URL_DEFAULT, **options))
+            return
+        results = run_fleet(urls, run, args.host_jobs, **options)
+    finally:
+        if trace:
+            with open(args.trace, "w") as file:
+                trace.dump(file)
 
-    getattr(Client(args.lxd_url), args.command + "_stack")(stack)
+    for url, exception in results.items():
+        print(f"{url}: {'ok' if exception is None else 'failed: ' + str(exception)}")
+    if any(results.values()):
+        exit(1)
@@ -0,0 +1,403 @@
+import asyncio
+import json
+import urllib.parse
+from typing import Optional, Dict, Tuple, Callable, Awaitable, Iterable
+
+from zebr0_lxd import URL_DEFAULT, Resource, Node, Inventory, Operation, OperationTimeout, LazyJson, RequestError, RetryPolicy, build_graph, clone_snapshots, logger
+
+
+class UnixTransport:
+    """
+    A minimal asyncio HTTP/1.1 client over a Unix socket, keeping its connections alive in a pool.
+
+    :param path: path of the Unix socket
+    :param pool_size: maximum number of simultaneous connections, defaults to 100
+    """
+
+    def __init__(self, path: str, pool_size: int = 100):
+        self.path = path
+        self.idle = []  # connections ready to be reused, as (reader, writer) tuples
+        self.semaphore = asyncio.Semaphore(pool_size)
+
+    async def request(self, method: str, path: str, body: Optional[dict] = None) -> Tuple[int, dict]:
+        """
+        :param method: the HTTP method
+        :param path: the request's path
+        :param body: the request's body, sent as json if not None
+        :return: the response's status code and json content
+        """
+
+        content = json.dumps(body).encode() if body is not None else b""
+        head = f"{method} {path} HTTP/1.1\r\nHost: lxd\r\nContent-Type: application/json\r\nContent-Length: {len(content)}\r\n\r\n".encode()
+
+        async with self.semaphore:
+            while True:
+                reused = bool(self.idle)
+                reader, writer = self.idle.pop() if reused else await asyncio.open_unix_connection(self.path)
+                try:
+                    writer.write(head + content)
+                    await writer.drain()
+                    status, keep_alive, payload = await self.read_response(reader)
+                    break
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if not reused:  # a reused connection may have been closed by the server in the meantime, so let's retry once with a new one
+                        raise
+                except BaseException:
+                    writer.close()
+                    raise
+
+            if keep_alive:
+                self.idle.append((reader, writer))
+            else:
+                writer.close()
+
+        return status, json.loads(payload) if payload else {}
+
+    @staticmethod
+    async def read_response(reader: asyncio.StreamReader) -> Tuple[int, bool, bytes]:
+        """
+        :param reader: the connection's reader
+        :return: the response's status code, whether the connection can be reused and the response's body
+        """
+
+        status_line = await reader.readuntil(b"\r\n")
+        status = int(status_line.split()[1])
+
+        headers = {}
+        while True:
+            line = (await reader.readuntil(b"\r\n")).decode().strip()
+            if not line:
+                break
+            key, _, value = line.partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                chunks.append(await reader.readexactly(size + 2))  # including the trailing CRLF
+                if size == 0:
+                    break
+            payload = b"".join(chunk[:-2] for chunk in chunks)
+        elif "content-length" in headers:
+            payload = await reader.readexactly(int(headers.get("content-length")))
+        else:
+            return status, False, await reader.read()
+
+        return status, headers.get("connection", "").lower() != "close", payload
+
+    def close(self) -> None:
+        """
+        Closes the idle connections.
+        """
+
+        while self.idle:
+            self.idle.pop()[1].close()
+
+
+class AsyncClient:
+    """
+    The asyncio counterpart of zebr0_lxd.Client, with the same API as coroutines.
+    Many calls can be in flight at once, without threads, sharing a pool of connections to the LXD Unix socket.
+
+    :param url: URL of the LXD API (scheme is "http+unix", socket path is percent-encoded into the host field), defaults to "http+unix://%2Fvar%2Fsnap%2Flxd%2Fcommon%2Flxd%2Funix.socket"
+    :param pool_size: maximum number of simultaneous connections to LXD, defaults to 100
+    :param retry: timeouts and retries of the requests, defaults to a new zebr0_lxd.RetryPolicy
+    """
+
+    def __init__(self, url: str = URL_DEFAULT, pool_size: int = 100, retry: Optional[RetryPolicy] = None):
+        self.url = url
+        self.retry = retry or RetryPolicy()
+        self.transport = UnixTransport(urllib.parse.unquote(urllib.parse.urlparse(url).netloc), pool_size)
+        self.inventory = None  # type: Optional[Inventory]
+
+    async def __aenter__(self) -> "AsyncClient":
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        self.transport.close()
+
+    async def request(self, method: str, path: str, body: Optional[dict] = None) -> dict:
+        """
+        :param method: the HTTP method
+        :param path: the path relative to the LXD API base URL
+        :param body: the request's body, sent as json if not None
+        :return: the response's json content
+        """
+
+        attempt = 0
+        while True:
+            try:
+                status, response = await asyncio.wait_for(self.transport.request(method, path, body), self.retry.timeout)
+                if status >= 400:
+                    raise RequestError(method, path, status, json.dumps(response))
+                return response
+            except (RequestError, ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError) as error:
+                if attempt >= self.retry.retries or not self.retry.retryable(method, error):
+                    raise
+                delay = self.retry.delay(attempt)
+                logger.warning("retrying %s %s in %.1fs (%s)", method, path, delay, error)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def operation(self, response: dict) -> Optional[Operation]:
+        """
+        :param response: the json content of a response of the LXD API
+        :return: a handle on the asynchronous operation started by the request, None if the request was synchronous
+        """
+
+        if response.get("type") == "async":
+            return Operation(self, response.get("operation"), response.get("metadata"))
+
+    async def wait_all(self, operations: Iterable[Optional[Operation]], interval: float = 0.5, timeout: Optional[float] = None) -> None:
+        """
+        Waits for all the given operations to be over, then raises an OperationError if any of them failed.
+
+        :param operations: the operations, None values (i.e. synchronous requests) are ignored
+        :param interval: in seconds, the maximum delay between two polls of the list of operations, defaults to 0.5
+        :param timeout: in seconds, how long to wait before raising an OperationTimeout, defaults to the retry policy's
+        """
+
+        operations = [operation for operation in operations if operation]
+        pending = {operation.id(): operation for operation in operations if not operation.done()}
+        timeout = timeout if timeout is not None else self.retry.operation_timeout
+
+        delay = 0.05
+        deadline = asyncio.get_running_loop().time() + timeout if timeout is not None else None
+        while pending:
+            listed = set()
+            for metadatas in ((await self.request("GET", "/1.0/operations?recursion=1")).get("metadata") or {}).values():
+                for metadata in metadatas:
+                    if metadata.get("id") in pending:
+                        pending[metadata.get("id")].metadata = metadata
+                        listed.add(metadata.get("id"))
+
+            for key in pending.keys() - listed:  # over and purged from the list since the last poll
+                try:
+                    pending[key].metadata = (await self.request("GET", pending[key].path)).get("metadata")
+                except RequestError as error:
+                    if error.status_code != 404:
+                        raise
+                    logger.warning("operation %s purged by LXD, assuming it succeeded", key)
+                    pending[key].metadata = dict(pending[key].metadata, status="Success", status_code=200)
+
+            pending = {key: operation for key, operation in pending.items() if not operation.done()}
+            if pending and deadline is not None and asyncio.get_running_loop().time() >= deadline:
+                operation = next(iter(pending.values()))
+                raise OperationTimeout(operation, f"{len(pending)} operations (e.g. {operation.id()}) not over after {timeout}s")
+            if pending:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, interval)
+
+        for operation in operations:
+            operation.check()
+
+    async def wait(self, operation: Optional[Operation], timeout: Optional[float] = None) -> Optional[Operation]:
+        """
+        :param operation: the operation to wait for, ignored if None
+        :param timeout: in seconds, how long to wait before raising an OperationTimeout, defaults to the retry policy's
+        :return: the operation itself, once it's over
+        """
+
+        timeout = timeout if timeout is not None else self.retry.operation_timeout
+        deadline = asyncio.get_running_loop().time() + timeout if timeout is not None else None
+        while operation and not operation.done():
+            remaining = deadline - asyncio.get_running_loop().time() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                raise OperationTimeout(operation, f"operation {operation.id()} not over after {timeout}s")
+
+            # LXD's wait is bounded so that it doesn't outlast the request's own timeout
+            chunk = min(filter(None, [remaining, self.retry.timeout and self.retry.timeout / 2, 60]))
+            operation.metadata = (await self.request("GET", operation.path + f"/wait?timeout={max(1, int(chunk))}")).get("metadata")
+        if operation:
+            operation.check()
+        return operation
+
+    async def snapshot(self) -> Inventory:
+        """
+        Fetches all the resource types concurrently into an Inventory, used by the following checks until it's reset to None.
+        See zebr0_lxd.Client.snapshot.
+
+        :return: the inventory
+        """
+
+        inventory = Inventory(self)
+        for resource, resources in zip(Resource, await asyncio.gather(*(self.list(resource) for resource in Resource))):
+            inventory.resources[resource] = resources
+        self.inventory = inventory
+        return inventory
+
+    async def list(self, resource: Resource) -> Dict[str, dict]:
+        """
+        :param resource: the resources' type
+        :return: the existing resources of this type, as a dictionary of metadata indexed by name
+        """
+
+        return {metadata.get("name"): metadata for metadata in (await self.request("GET", resource.path() + "?recursion=1")).get("metadata")}
+
+    async def exists(self, resource: Resource, name: str) -> bool:
+        """
+        :param resource: the resource's type
+        :param name: the resource's name
+        :return: whether the resource exists or not
+        """
+
+        logger.info("checking %s/%s", resource.value, name, extra={"event": {"action": "check", "resource": resource.value, "name": name}})
+        if self.inventory:
+            return name in self.inventory.get(resource)
+
+        return resource.path() + "/" + name in (await self.request("GET", resource.path())).get("metadata")
+
+    async def create(self, resource: Resource, config: dict, wait: bool = True) -> Optional[Operation]:
+        """
+        See zebr0_lxd.Client.create.
+        """
+
+        if not await self.exists(resource, config.get("name")):
+            logger.info("creating %s/%s", resource.value, LazyJson(config), extra={"event": {"action": "create", "resource": resource.value, "name": config.get("name"), "config": config}})
+            operation = self.operation(await self.request("POST", resource.path(), config))
+            if self.inventory:
+                self.inventory.add(resource, dict(config, status="Stopped") if resource == Resource.INSTANCES else config)
+            return await self.wait(operation) if wait else operation
+
+    async def delete(self, resource: Resource, name: str, wait: bool = True) -> Optional[Operation]:
+        """
+        See zebr0_lxd.Client.delete.
+        """
+
+        if await self.exists(resource, name):
+            logger.info("deleting %s/%s", resource.value, name, extra={"event": {"action": "delete", "resource": resource.value, "name": name}})
+            operation = self.operation(await self.request("DELETE", resource.path() + "/" + name))
+            if self.inventory:
+                self.inventory.discard(resource, name)
+            return await self.wait(operation) if wait else operation
+
+    async def create_snapshot(self, name: str, snapshot: str, wait: bool = True) -> Optional[Operation]:
+        """
+        See zebr0_lxd.Client.create_snapshot.
+        """
+
+        path = Resource.INSTANCES.path() + "/" + name + "/snapshots"
+        if path + "/" + snapshot not in (await self.request("GET", path)).get("metadata"):
+            logger.info("creating %s/%s/snapshots/%s", Resource.INSTANCES.value, name, snapshot, extra={"event": {"action": "snapshot", "resource": Resource.INSTANCES.value, "name": name, "snapshot": snapshot}})
+            operation = self.operation(await self.request("POST", path, {"name": snapshot}))
+            return await self.wait(operation) if wait else operation
+
+    async def is_running(self, name: str) -> bool:
+        """
+        See zebr0_lxd.Client.is_running.
+        """
+
+        logger.info("checking %s/%s", Resource.INSTANCES.value, name, extra={"event": {"action": "check", "resource": Resource.INSTANCES.value, "name": name}})
+        if self.inventory:
+            return self.inventory.get(Resource.INSTANCES).get(name, {}).get("status") == "Running"
+
+        return (await self.request("GET", Resource.INSTANCES.path() + "/" + name)).get("metadata").get("status") == "Running"
+
+    async def start(self, name: str, wait: bool = True) -> Optional[Operation]:
+        """
+        See zebr0_lxd.Client.start.
+        """
+
+        if not await self.is_running(name):
+            logger.info("starting %s/%s", Resource.INSTANCES.value, name, extra={"event": {"action": "start", "resource": Resource.INSTANCES.value, "name": name}})
+            operation = self.operation(await self.request("PUT", Resource.INSTANCES.path() + "/" + name + "/state", {"action": "start"}))
+            if self.inventory:
+                self.inventory.add(Resource.INSTANCES, dict(self.inventory.get(Resource.INSTANCES).get(name), status="Running"))
+            return await self.wait(operation) if wait else operation
+
+    async def stop(self, name: str, wait: bool = True, force: bool = False, timeout: Optional[int] = None) -> Optional[Operation]:
+        """
+        See zebr0_lxd.Client.stop.
+        """
+
+        if await self.is_running(name):
+            logger.info("stopping %s/%s", Resource.INSTANCES.value, name, extra={"event": {"action": "stop", "resource": Resource.INSTANCES.value, "name": name}})
+            state = dict({"action": "stop"}, **({"force": True} if force else {}), **({"timeout": timeout} if timeout is not None else {}))
+            operation = self.operation(await self.request("PUT", Resource.INSTANCES.path() + "/" + name + "/state", state))
+            if self.inventory:
+                self.inventory.add(Resource.INSTANCES, dict(self.inventory.get(Resource.INSTANCES).get(name), status="Stopped"))
+            return await self.wait(operation) if wait else operation
+
+    async def execute(self, stack: dict, function: Callable[[Node], Awaitable], jobs: int, reverse: bool = False, resources: Iterable[Resource] = Resource) -> None:
+        """
+        Calls a coroutine function on each node of the stack's graph, see zebr0_lxd.execute.
+        Unlike its synchronous counterpart, up to "jobs" nodes are processed concurrently within the event loop.
+        """
+
+        graph = build_graph({resource: stack.get(resource) for resource in resources})
+        semaphore = asyncio.Semaphore(max(jobs, 1))
+        tasks = {}
+
+        async def process(node: Node) -> None:
+            # a node waits for its dependencies, or for its dependents if "reverse" is set
+            if reverse:
+                await asyncio.gather(*(tasks[other.key()] for other in graph.values() if node.key() in other.dependencies))
+            else:
+                await asyncio.gather(*(tasks[dependency] for dependency in node.dependencies))
+            async with semaphore:
+                await function(node)
+
+        snapshot = self.inventory is None
+        if snapshot:
+            await self.snapshot()
+        try:
+            for node in graph.values():
+                tasks[node.key()] = asyncio.ensure_future(process(node))
+            await asyncio.gather(*tasks.values())
+        finally:
+            for task in tasks.values():  # on failure, the remaining nodes are abandoned
+                task.cancel()
+            if snapshot:
+                self.inventory = None
+
+    async def create_stack(self, stack: dict, jobs: int = 100) -> None:
+        """
+        See zebr0_lxd.Client.create_stack.
+        """
+
+        snapshots, taken = clone_snapshots(build_graph(stack)), {}  # instance name -> snapshot task, shared by its copies
+
+        async def create(node: Node) -> None:
+            source = str((node.config.get("source") or {}).get("source")).split("/")[0]
+            if node.resource == Resource.INSTANCES and source in snapshots and node.name not in self.inventory.get(node.resource):
+                if source not in taken:
+                    taken[source] = asyncio.ensure_future(self.create_snapshot(source, snapshots.get(source)))
+                await taken[source]
+            await self.create(node.resource, node.config)
+
+        await self.execute(stack, create, jobs)
+
+    async def delete_stack(self, stack: dict, jobs: int = 100) -> None:
+        """
+        See zebr0_lxd.Client.delete_stack.
+        """
+
+        await self.execute(stack, lambda node: self.delete(node.resource, node.name), jobs, reverse=True)
+
+    async def start_stack(self, stack: dict, jobs: int = 100) -> None:
+        """
+        See zebr0_lxd.Client.start_stack.
+        """
+
+        operations = []
+
+        async def start(node: Node) -> None:
+            operations.append(await self.start(node.name, wait=False))
+
+        await self.execute(stack, start, jobs, resources=[Resource.INSTANCES])
+        await self.wait_all(operations)
+
+    async def stop_stack(self, stack: dict, jobs: int = 100, force: bool = False, timeout: Optional[int] = None) -> None:
+        """
+        See zebr0_lxd.Client.stop_stack.
+        """
+
+        operations = []
+
+        async def stop(node: Node) -> None:
+            operations.append(await self.stop(node.name, wait=False, force=force, timeout=timeout))
+
+        await self.execute(stack, stop, jobs, resources=[Resource.INSTANCES])
+        await self.wait_all(operations)
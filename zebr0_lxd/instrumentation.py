@@ -0,0 +1,203 @@
+import collections
+import contextlib
+import json
+import threading
+import time
+from typing import Callable, List, Optional, TextIO
+
+import requests
+import requests.adapters
+
+READ_ONLY_METHODS = ["GET", "HEAD"]  # requests sent to LXD even in dry-run mode
+DRY_RUN_RESPONSE = {"type": "sync", "status": "Success", "status_code": 200, "metadata": {}}  # answer to the other requests in dry-run mode
+
+
+class Instrumentation:
+    """
+    Collects the timings and counters of a Client's activity, and passes each measure to its listeners (e.g. zebr0_lxd.instrumentation.JsonLinesExporter).
+
+    Measures have a kind and labels:
+
+    * "request" (labels: method, resource): the whole HTTP request, as seen by the Client (connection pool, socket and LXD)
+    * "server" (labels: method, resource): the part of the request spent waiting for LXD's response
+    * "operation" (labels: name): waiting for asynchronous operations to be over
+    * "phase" (labels: name): the stack operations (e.g. create_stack)
+    * "readiness" (no labels): how long the instances took to be ready after being started (see zebr0_lxd.Client.wait_ready)
+    """
+
+    def __init__(self):
+        self.counts = collections.Counter()  # (kind, labels) -> number of measures
+        self.durations = collections.Counter()  # (kind, labels) -> cumulated duration in seconds
+        self.listeners = []  # type: List[Callable[[dict], None]]
+        self.lock = threading.Lock()
+
+    def record(self, kind: str, duration: float, **labels) -> None:
+        """
+        :param kind: the measure's kind
+        :param duration: in seconds, the measure's duration
+        :param labels: the measure's labels
+        """
+
+        key = (kind, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counts[key] += 1
+            self.durations[key] += duration
+
+        if self.listeners:
+            measure = dict(labels, kind=kind, duration=duration, time=time.time())
+            for listener in self.listeners:
+                listener(measure)
+
+    @contextlib.contextmanager
+    def span(self, kind: str, **labels):
+        """
+        Context manager measuring the duration of its block.
+
+        :param kind: the measure's kind
+        :param labels: the measure's labels
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(kind, time.perf_counter() - start, **labels)
+
+    def total(self, kind: str) -> float:
+        """
+        :param kind: a kind of measure
+        :return: in seconds, the cumulated duration of this kind of measure
+        """
+        return sum(duration for (measure_kind, _), duration in self.durations.items() if measure_kind == kind)
+
+    def report(self) -> str:
+        """
+        :return: a human-readable breakdown of the measures
+        """
+
+        lines = [f"{'kind':<10}{'labels':<40}{'count':>8}{'total (s)':>12}{'mean (ms)':>12}"]
+        with self.lock:
+            for (kind, labels), count in sorted(self.counts.items()):
+                duration = self.durations.get((kind, labels))
+                lines.append(f"{kind:<10}{' '.join(f'{key}={value}' for key, value in labels):<40}{count:>8}{duration:>12.3f}{duration / count * 1000:>12.1f}")
+
+        requests, server = self.total("request"), self.total("server")
+        lines.append(f"requests: {requests:.3f}s, of which {server:.3f}s waiting for LXD and {requests - server:.3f}s in the client and socket")
+        lines.append(f"operations: {self.total('operation'):.3f}s waiting for asynchronous operations")
+        return "\n".join(lines)
+
+    def prometheus(self) -> str:
+        """
+        :return: the measures in the Prometheus text format (see https://prometheus.io/docs/instrumenting/exposition_formats/)
+        """
+
+        lines = []
+        with self.lock:
+            for kind in sorted({kind for kind, _ in self.counts}):
+                for metric, values in ((f"zebr0_lxd_{kind}_total", self.counts), (f"zebr0_lxd_{kind}_seconds_total", self.durations)):
+                    lines.append(f"# TYPE {metric} counter")
+                    for (measure_kind, labels), value in sorted(values.items()):
+                        if measure_kind == kind:
+                            lines.append(metric + "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "} " + str(value))
+        return "\n".join(lines) + "\n"
+
+
+class JsonLinesExporter:
+    """
+    Listener of an Instrumentation writing each measure as a json line.
+
+    :param file: the file to write to
+    """
+
+    def __init__(self, file: TextIO):
+        self.file = file
+        self.lock = threading.Lock()
+
+    def __call__(self, measure: dict) -> None:
+        line = json.dumps(measure) + "\n"
+        with self.lock:
+            self.file.write(line)
+
+
+class Trace:
+    """
+    The sequence of API calls made by one or more Clients, along with their responses and timings (see zebr0_lxd.instrumentation.TracingAdapter).
+    Saved as json lines, it can be replayed by the TestServer, to reproduce a run (e.g. a slow one) without LXD.
+
+    :param entries: the recorded calls, defaults to none
+    """
+
+    def __init__(self, entries: Optional[List[dict]] = None):
+        self.entries = entries or []
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def record(self, entry: dict) -> None:
+        """
+        :param entry: a call, as a dictionary (see zebr0_lxd.instrumentation.TracingAdapter)
+        """
+
+        with self.lock:
+            self.entries.append(entry)
+
+    def dump(self, file: TextIO) -> None:
+        """
+        :param file: the file to write the calls to, as json lines
+        """
+
+        with self.lock:
+            for entry in self.entries:
+                file.write(json.dumps(entry) + "\n")
+
+    @staticmethod
+    def load(file: TextIO) -> "Trace":
+        """
+        :param file: a file written by zebr0_lxd.instrumentation.Trace.dump
+        :return: the trace
+        """
+        return Trace([json.loads(line) for line in file if line.strip()])
+
+
+class TracingAdapter(requests.adapters.BaseAdapter):
+    """
+    A transport adapter (see https://requests.readthedocs.io/en/latest/user/advanced/#transport-adapters) recording each call to a Trace,
+    with its method, path, body, response, start time (relative to the trace's) and duration.
+    In dry-run mode, only the read-only calls are sent to LXD, the others are answered as if they had succeeded synchronously, without doing anything.
+
+    :param adapter: the adapter actually sending the requests
+    :param trace: the trace to record the calls to, defaults to None (no recording)
+    :param dry_run: whether to answer the calls that would change something instead of sending them, defaults to False
+    """
+
+    def __init__(self, adapter: requests.adapters.BaseAdapter, trace: Optional[Trace] = None, dry_run: bool = False):
+        super().__init__()
+        self.adapter = adapter
+        self.trace = trace
+        self.dry_run = dry_run
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        start = time.perf_counter()
+        dry_run = self.dry_run and request.method.upper() not in READ_ONLY_METHODS
+        if dry_run:
+            response = requests.Response()
+            response.status_code, response.reason, response.url, response.request = 200, "OK", request.url, request
+            response.headers["Content-Type"] = "application/json"
+            response._content = json.dumps(DRY_RUN_RESPONSE).encode()
+        else:
+            response = self.adapter.send(request, **kwargs)
+
+        if self.trace:
+            body = request.body.decode() if isinstance(request.body, bytes) else request.body
+            try:
+                content = response.json() if response.content else None
+            except ValueError:  # e.g. an error page from a proxy
+                content = response.text
+            self.trace.record({
+                "time": start - self.trace.start, "duration": time.perf_counter() - start, "dry_run": dry_run,
+                "method": request.method.upper(), "path": request.path_url, "body": json.loads(body) if body else None,
+                "status": response.status_code, "response": content
+            })
+        return response
+
+    def close(self) -> None:
+        self.adapter.close()
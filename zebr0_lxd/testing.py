@@ -0,0 +1,378 @@
+import base64
+import collections
+import hashlib
+import http.server
+import json
+import os
+import queue
+import socketserver
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+from typing import Optional, Dict, Tuple
+
+from zebr0_lxd import Resource
+from zebr0_lxd.instrumentation import Trace
+
+ASYNC_OPERATIONS = [("POST", Resource.INSTANCES), ("DELETE", Resource.INSTANCES), ("PUT", Resource.INSTANCES), ("POST", "images")]  # as in LXD, the others are synchronous
+STATE_EVENTS = {"start": "instance-started", "stop": "instance-stopped", "restart": "instance-restarted", "freeze": "instance-paused", "unfreeze": "instance-resumed"}
+
+
+class TestServer:
+    """
+    A stand-in for the LXD API, served on a Unix socket by a background thread, to test and benchmark the Client without LXD.
+    It implements the subset of the API the Client uses, keeping the resources in memory:
+
+    * listing (with or without recursion), creation, reading, update (PATCH) and deletion of storage pools, networks, profiles and instances
+    * instance state changes, renaming, snapshots and copies
+    * instance states (with an IPv4 address once booted) and commands (succeeding once booted)
+    * listing of images and their download from a remote source
+    * asynchronous operations (instance creation, deletion and state changes, image downloads), their listing and the "wait" endpoint
+    * the lifecycle events of the resources, streamed over websockets
+
+    Given a trace (see zebr0_lxd.instrumentation.Trace), it replays it: each request matching a recorded call (same method, path and body, in the recorded order)
+    gets the recorded response, after the recorded duration, so that a run can be reproduced deterministically. The other requests are served as usual.
+
+    Typical usage:
+
+    with TestServer(latency=0.001) as server:
+        zebr0_lxd.Client(server.url).create_stack(stack)
+        print(server.requests)
+
+    :param latency: in seconds, how long each request takes to be answered, defaults to 0
+    :param operation_latency: in seconds, how long each asynchronous operation takes to complete, defaults to 0
+    :param failures: requests to fail, as a dictionary of HTTP status codes indexed by (method, path) tuples, defaults to none
+    :param operation_failures: asynchronous operations to fail, as a set of (method, path) tuples of the requests starting them, defaults to none
+    :param boot_latency: in seconds, how long a started instance takes to be ready (i.e. to get an IPv4 address and to run commands successfully), defaults to 0
+    :param trace: the calls to replay, defaults to None
+    """
+
+    __test__ = False  # not a test class, despite its name
+
+    def __init__(self, latency: float = 0, operation_latency: float = 0, failures: Optional[Dict[Tuple[str, str], int]] = None, operation_failures: Optional[set] = None, boot_latency: float = 0, trace: Optional[Trace] = None):
+        self.latency = latency
+        self.operation_latency = operation_latency
+        self.failures = failures or {}
+        self.operation_failures = operation_failures or set()
+        self.boot_latency = boot_latency
+        self.replayed = list(trace.entries) if trace else []  # the recorded calls not replayed yet
+
+        self.resources = {resource: {} for resource in Resource}  # resource type -> resource name -> resource metadata
+        self.images = []  # images metadata
+        self.snapshots = collections.defaultdict(list)  # instance name -> snapshot names
+        self.boots = {}  # instance name -> time it was started at
+        self.operations = {}  # operation id -> operation metadata
+        self.events = {}  # operation id -> event set when the operation is over
+        self.requests = collections.Counter()  # (method, resource type) -> number of requests
+        self.subscribers = []  # queues of the events streamed to each websocket client
+        self.lock = threading.RLock()
+
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "unix.socket")
+        self.url = "http+unix://" + urllib.parse.quote(self.path, safe="")
+        self.server = None
+
+    def __enter__(self) -> "TestServer":
+        self.start()
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        """
+        Starts serving in a background thread.
+        """
+
+        test_server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive
+
+            def handle_request(self) -> None:
+                if self.path.startswith("/1.0/events") and self.headers.get("Upgrade", "").lower() == "websocket":
+                    self.stream_events()
+                    return
+
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                status, response = test_server.handle(self.command, self.path, json.loads(body) if body else None)
+                content = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def stream_events(self) -> None:
+                accept = base64.b64encode(hashlib.sha1((self.headers.get("Sec-WebSocket-Key") + "258EAFA5-E914-47DA-95CA-C5AB0DC85B11").encode()).digest()).decode()
+                self.send_response(101)
+                self.send_header("Upgrade", "websocket")
+                self.send_header("Connection", "Upgrade")
+                self.send_header("Sec-WebSocket-Accept", accept)
+                self.end_headers()
+                self.wfile.flush()
+
+                events = queue.Queue()
+                with test_server.lock:
+                    test_server.subscribers.append(events)
+                try:
+                    while True:
+                        event = events.get()
+                        if event is None:
+                            self.wfile.write(bytes([0x88, 0]))  # close frame
+                            break
+                        content = json.dumps(event).encode()
+                        length = bytes([len(content)]) if len(content) < 126 else bytes([126]) + len(content).to_bytes(2, "big")
+                        self.wfile.write(bytes([0x81]) + length + content)  # text frame
+                        self.wfile.flush()
+                finally:
+                    with test_server.lock:
+                        test_server.subscribers.remove(events)
+                    self.close_connection = True
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_request
+
+            def log_message(self, *_) -> None:
+                pass
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+            request_queue_size = 128  # enough for many concurrent clients
+
+            def get_request(self):
+                request, _ = super().get_request()
+                return request, ("localhost", 0)  # BaseHTTPRequestHandler expects a (host, port) client address
+
+        self.server = Server(self.path, Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        """
+        Stops serving and removes the socket.
+        """
+
+        with self.lock:
+            for events in self.subscribers:
+                events.put(None)
+        self.server.shutdown()
+        self.server.server_close()
+        os.remove(self.path)
+        os.rmdir(self.directory)
+
+    def count(self) -> int:
+        """
+        :return: the total number of requests received so far
+        """
+        return sum(self.requests.values())
+
+    def emit(self, action: str, resource: Resource, name: str) -> None:
+        """
+        Streams a lifecycle event to the websocket clients.
+
+        :param action: the event's action (e.g. "instance-stopped")
+        :param resource: the resource's type
+        :param name: the resource's name
+        """
+
+        with self.lock:
+            for events in self.subscribers:
+                events.put({"type": "lifecycle", "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "metadata": {"action": action, "source": resource.path() + "/" + name}})
+
+    def handle(self, method: str, path: str, body: Optional[dict]) -> Tuple[int, dict]:
+        """
+        :param method: the request's HTTP method
+        :param path: the request's path, including its query string
+        :param body: the request's json body, if any
+        :return: the response's HTTP status code and json body
+        """
+
+        url = urllib.parse.urlparse(path)
+        parts = url.path.split("/")[2:]  # skips "" and "1.0"
+        query = urllib.parse.parse_qs(url.query)
+        recursion = query.get("recursion") == ["1"]
+
+        with self.lock:
+            self.requests[(method, parts[0] if parts else "")] += 1
+            entry = next((entry for entry in self.replayed if (entry.get("method"), entry.get("path"), entry.get("body")) == (method, path, body)), None)
+            if entry:
+                self.replayed.remove(entry)
+        if entry:
+            time.sleep(entry.get("duration"))
+            return entry.get("status"), entry.get("response")
+        time.sleep(self.latency)
+
+        if (method, url.path) in self.failures:
+            return self.error(self.failures.get((method, url.path)), "injected failure")
+
+        if parts and parts[0] == "operations":
+            return self.handle_operations(method, parts[1:], query)
+        if parts and parts[0] == "images":
+            return self.handle_images(method, parts[1:], body)
+        if not parts or parts[0] not in [resource.value for resource in Resource]:
+            return self.error(404, "not found")
+
+        resource, name, rest = Resource(parts[0]), parts[1] if len(parts) > 1 else None, parts[2:]
+        with self.lock:
+            resources = self.resources.get(resource)
+
+            if name is None and method == "GET":
+                return self.sync([self.read(resource, metadata) for metadata in resources.values()] if recursion else [resource.path() + "/" + key for key in resources])
+            if name is None and method == "POST":
+                if not body or not body.get("name"):
+                    return self.error(400, "no name provided")
+                if body.get("name") in resources:
+                    return self.error(409, "already exists")
+                if (body.get("source") or {}).get("type") == "copy":
+                    origin, _, snapshot = str(body.get("source").get("source")).partition("/")
+                    if origin not in resources or (snapshot and snapshot not in self.snapshots.get(origin, [])):
+                        return self.error(404, "copy source not found")
+                resources[body.get("name")] = dict(body, status="Stopped") if resource == Resource.INSTANCES else dict(body)
+                self.emit(resource.value[:-1] + "-created", resource, body.get("name"))  # e.g. "instance-created"
+                return self.respond(method, url.path, resource)
+
+            if name not in resources:
+                return self.error(404, "not found")
+            if method == "GET" and not rest:
+                return self.sync(self.read(resource, resources.get(name)))
+            if method == "PATCH" and not rest:
+                for key, value in (body or {}).items():
+                    resources.get(name)[key] = dict(resources.get(name).get(key) or {}, **value) if isinstance(value, dict) else value
+                self.emit(resource.value[:-1] + "-updated", resource, name)
+                return self.respond(method, url.path, resource)
+            if method == "POST" and not rest and resource == Resource.INSTANCES:
+                if resources.get(name).get("status") == "Running":
+                    return self.error(400, "instance is running")
+                if (body or {}).get("name") in resources:
+                    return self.error(409, "already exists")
+                resources[body.get("name")] = dict(resources.pop(name), name=body.get("name"))
+                if name in self.snapshots:
+                    self.snapshots[body.get("name")] = self.snapshots.pop(name)
+                self.emit("instance-renamed", resource, body.get("name"))
+                return self.respond(method, url.path, resource)
+            if method == "DELETE" and not rest:
+                if resource == Resource.INSTANCES and resources.get(name).get("status") == "Running":
+                    return self.error(400, "instance is running")
+                del resources[name]
+                self.snapshots.pop(name, None)
+                self.emit(resource.value[:-1] + "-deleted", resource, name)
+                return self.respond(method, url.path, resource)
+            if rest == ["snapshots"] and resource == Resource.INSTANCES:
+                if method == "GET":
+                    return self.sync([url.path + "/" + snapshot for snapshot in self.snapshots.get(name, [])])
+                if method == "POST":
+                    self.snapshots[name].append(body.get("name"))
+                    self.emit("instance-snapshot-created", resource, name)
+                    return self.respond(method, url.path, resource)
+            if method == "GET" and rest == ["state"] and resource == Resource.INSTANCES:
+                addresses = [{"family": "inet", "address": "10.0.0.1", "netmask": "24", "scope": "global"}] if self.booted(name) else []
+                return self.sync({"status": resources.get(name).get("status"), "network": {"eth0": {"addresses": addresses}, "lo": {"addresses": [{"family": "inet", "address": "127.0.0.1", "netmask": "8", "scope": "local"}]}}})
+            if method == "POST" and rest == ["exec"] and resource == Resource.INSTANCES:
+                if resources.get(name).get("status") != "Running":
+                    return self.error(400, "instance is not running")
+                return self.respond(method, url.path, resource, {"return": 0 if self.booted(name) else 1})
+            if method == "PUT" and rest == ["state"] and resource == Resource.INSTANCES:
+                resources.get(name)["status"] = "Running" if body.get("action") in ("start", "restart") else "Stopped"
+                if resources.get(name).get("status") == "Running":
+                    self.boots[name] = time.monotonic()
+                self.emit(STATE_EVENTS.get(body.get("action")), resource, name)
+                return self.respond(method, url.path, resource)
+
+        return self.error(400, "unsupported request")
+
+    def read(self, resource: Resource, metadata: dict) -> dict:
+        """
+        :param resource: the resource's type
+        :param metadata: the resource's metadata
+        :return: a copy of the metadata, along with the "used_by" field for storage pools, networks and profiles
+        """
+
+        if resource == Resource.INSTANCES:
+            return dict(metadata)
+
+        used_by = []
+        for other in (Resource.PROFILES, Resource.INSTANCES):
+            for name, config in self.resources.get(other).items():
+                references = set(config.get("profiles") or []) if resource == Resource.PROFILES and other == Resource.INSTANCES else set()
+                for device in (config.get("devices") or {}).values():
+                    references.update([device.get("pool")] if resource == Resource.STORAGE_POOLS else [device.get("network"), device.get("parent")] if resource == Resource.NETWORKS else [])
+                if metadata.get("name") in references:
+                    used_by.append(other.path() + "/" + name)
+        return dict(metadata, used_by=used_by)
+
+    def handle_operations(self, method: str, parts: list, query: Dict[str, list]) -> Tuple[int, dict]:
+        """
+        Serves the /1.0/operations endpoints.
+        """
+
+        if method == "GET" and not parts:
+            with self.lock:
+                grouped = collections.defaultdict(list)
+                for operation in self.operations.values():
+                    grouped[operation.get("status").lower()].append(dict(operation))
+                return self.sync(dict(grouped))
+
+        if not parts or parts[0] not in self.operations:
+            return self.error(404, "not found")
+        if method == "GET" and parts[1:] == ["wait"]:
+            timeout = float((query.get("timeout") or ["-1"])[0])
+            self.events.get(parts[0]).wait(timeout if timeout >= 0 else None)  # as in LXD, -1 waits forever
+        return self.sync(dict(self.operations.get(parts[0])))
+
+    def handle_images(self, method: str, parts: list, body: Optional[dict]) -> Tuple[int, dict]:
+        """
+        Serves the /1.0/images endpoints.
+        """
+
+        with self.lock:
+            if method == "GET" and not parts:
+                return self.sync([dict(image) for image in self.images])
+            if method == "POST" and not parts:
+                source = (body or {}).get("source") or {}
+                self.images.append({"fingerprint": uuid.uuid4().hex, "update_source": {"server": source.get("server"), "protocol": source.get("protocol"), "alias": source.get("alias")}})
+                return self.respond(method, "/1.0/images", "images")
+        return self.error(400, "unsupported request")
+
+    def booted(self, name: str) -> bool:
+        """
+        :param name: an instance's name
+        :return: whether the instance is running since long enough to be ready (see boot_latency)
+        """
+        return self.resources.get(Resource.INSTANCES).get(name, {}).get("status") == "Running" and time.monotonic() - self.boots.get(name, 0) >= self.boot_latency
+
+    def respond(self, method: str, path: str, resource: Resource, metadata: Optional[dict] = None) -> Tuple[int, dict]:
+        """
+        :return: a synchronous response, or the response of a new asynchronous operation (with the given metadata) depending on the request
+        """
+
+        if (method, resource) not in ASYNC_OPERATIONS:
+            return self.sync({})
+
+        key = str(uuid.uuid4())
+        operation = {"id": key, "status": "Running", "status_code": 103, "err": "", "metadata": metadata}
+        self.operations[key] = operation
+        self.events[key] = threading.Event()
+
+        def finish():
+            with self.lock:
+                if (method, path) in self.operation_failures:
+                    operation.update(status="Failure", status_code=400, err="injected failure")
+                else:
+                    operation.update(status="Success", status_code=200)
+            self.events.get(key).set()
+
+        if self.operation_latency:
+            threading.Timer(self.operation_latency, finish).start()
+        else:
+            finish()
+
+        return 202, {"type": "async", "status": "Operation created", "status_code": 100, "operation": "/1.0/operations/" + key, "metadata": dict(operation)}
+
+    @staticmethod
+    def sync(metadata) -> Tuple[int, dict]:
+        return 200, {"type": "sync", "status": "Success", "status_code": 200, "metadata": metadata}
+
+    @staticmethod
+    def error(code: int, message: str) -> Tuple[int, dict]:
+        return code, {"type": "error", "error": message, "error_code": code}
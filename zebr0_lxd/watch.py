@@ -0,0 +1,288 @@
+import base64
+import json
+import os
+import socket
+import ssl
+import struct
+import threading
+import time
+import urllib.parse
+from typing import Iterator, Optional
+
+from zebr0_lxd import Client, Resource, build_graph, execute, logger
+
+
+class EventStream:
+    """
+    A minimal websocket client for LXD's event stream (see https://linuxcontainers.org/lxd/docs/master/events), over the Unix socket or HTTPS.
+    It reuses the connection settings (URL, client certificate, verification) of the given Client.
+
+    :param client: the Client whose LXD to listen to
+    :param types: comma-separated types of events to receive, defaults to "lifecycle"
+    """
+
+    def __init__(self, client: Client, types: str = "lifecycle"):
+        self.client = client
+        self.types = types
+        self.socket = None
+
+    def connect(self) -> None:
+        """
+        Opens the connection and performs the websocket handshake.
+        """
+
+        url = urllib.parse.urlparse(self.client.url)
+        if url.scheme == "http+unix":
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(urllib.parse.unquote(url.netloc))
+        else:
+            context = ssl.create_default_context(cafile=self.client.session.verify if isinstance(self.client.session.verify, str) else None)
+            if self.client.session.verify is False:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            if self.client.session.cert:
+                context.load_cert_chain(*self.client.session.cert)
+            self.socket = context.wrap_socket(socket.create_connection((url.hostname, url.port or 8443)), server_hostname=url.hostname)
+
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.socket.sendall(f"GET /1.0/events?type={self.types} HTTP/1.1\r\nHost: lxd\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n".encode())
+
+        response = b""
+        while b"\r\n\r\n" not in response:
+            chunk = self.socket.recv(1024)
+            if not chunk:
+                raise ConnectionError("connection closed during the websocket handshake")
+            response += chunk
+        if response.split(b" ", 2)[1] != b"101":
+            raise ConnectionError("websocket handshake refused: " + response.split(b"\r\n")[0].decode())
+        self.buffer = response.split(b"\r\n\r\n", 1)[1]
+
+    def close(self) -> None:
+        """
+        Closes the connection.
+        """
+
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+
+    def read(self, size: int) -> bytes:
+        """
+        :param size: number of bytes to read
+        :return: exactly that number of bytes
+        """
+
+        while len(self.buffer) < size:
+            chunk = self.socket.recv(65536)
+            if not chunk:
+                raise ConnectionError("event stream closed")
+            self.buffer += chunk
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def send(self, opcode: int, payload: bytes = b"") -> None:
+        """
+        Sends a single (masked, as required from a client) frame.
+        """
+
+        mask = os.urandom(4)
+        self.socket.sendall(bytes([0x80 | opcode, 0x80 | len(payload)]) + mask + bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload)))
+
+    def __iter__(self) -> Iterator[dict]:
+        """
+        :return: the events, as they come, until the stream is closed
+        """
+
+        message = b""
+        while True:
+            header = self.read(2)
+            opcode, length = header[0] & 0x0F, header[1] & 0x7F
+            if length == 126:
+                length = struct.unpack("!H", self.read(2))[0]
+            elif length == 127:
+                length = struct.unpack("!Q", self.read(8))[0]
+            mask = self.read(4) if header[1] & 0x80 else None
+            payload = self.read(length)
+            if mask:
+                payload = bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+
+            if opcode == 0x8:  # close
+                return
+            if opcode == 0x9:  # ping
+                self.send(0xA, payload[:125])
+            elif opcode in (0x0, 0x1, 0x2):  # continuation, text, binary
+                message += payload
+                if header[0] & 0x80:  # final fragment
+                    yield json.loads(message)
+                    message = b""
+
+
+def follow_events(client: Client) -> threading.Event:
+    """
+    Keeps the cache of a Client (see its cache_ttl parameter) up to date with LXD's lifecycle events, in a background thread.
+    As events may have been missed, the whole cache is invalidated whenever the event stream has to be reconnected.
+
+    :param client: the Client, with a cache
+    :return: an Event to set to stop following the events
+    """
+
+    stopped = threading.Event()
+
+    def follow():
+        delay = 1
+        while not stopped.is_set():
+            stream = EventStream(client)
+            try:
+                stream.connect()
+                delay = 1
+                for event in stream:
+                    client.inventory.handle(event)
+                    if stopped.is_set():
+                        break
+            except (OSError, ValueError) as error:
+                client.logger.warning("event stream failure (%s), reconnecting in %ss", error, delay)
+            finally:
+                stream.close()
+
+            client.inventory.invalidate()
+            stopped.wait(delay)
+            delay = min(delay * 2, 60)
+
+    threading.Thread(target=follow, daemon=True).start()
+    return stopped
+
+
+class Watcher:
+    """
+    Keeps the resources of a stack created and its instances running, reconciling only what drifts.
+    Instead of polling LXD, it listens to its lifecycle events (see zebr0_lxd.watch.EventStream) to keep an in-memory model of the stack's state.
+    Bursts of events are debounced, and reconciliations are rate-limited.
+
+    :param client: the Client to use
+    :param stack: the stack as a dictionary
+    :param debounce: in seconds, how long to wait after the last event before reconciling, defaults to 1
+    :param interval: in seconds, the minimum delay between two reconciliations, defaults to 5
+    :param jobs: maximum number of resources processed concurrently, defaults to 1
+    """
+
+    def __init__(self, client: Client, stack: dict, debounce: float = 1, interval: float = 5, jobs: int = 1):
+        self.client = client
+        self.graph = build_graph(stack)
+        self.debounce = debounce
+        self.interval = interval
+        self.jobs = jobs
+        self.logger = client.logger if client else logger
+
+        self.state = {key: "unknown" for key in self.graph}  # the model: resource key -> last known state
+        self.dirty = set()  # keys of the resources that drifted since the last reconciliation
+        self.last_event = 0
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+
+    def handle(self, event: dict) -> None:
+        """
+        Updates the model from a LXD event, marking the resource as dirty if it drifted.
+
+        :param event: the event, as received from LXD (e.g. {"type": "lifecycle", "metadata": {"action": "instance-stopped", "source": "/1.0/instances/test-instance"}})
+        """
+
+        if event.get("type") != "lifecycle":
+            return
+
+        metadata = event.get("metadata") or {}
+        parts = urllib.parse.urlparse(metadata.get("source") or "").path.split("/")  # e.g. ["", "1.0", "instances", "test-instance"]
+        if len(parts) != 4 or parts[2] not in [resource.value for resource in Resource]:
+            return
+        key = (Resource(parts[2]), urllib.parse.unquote(parts[3]))
+        if key not in self.graph:
+            return
+
+        action = (metadata.get("action") or "").rsplit("-", 1)[-1]  # e.g. "deleted" for "instance-deleted"
+        self.state[key] = action
+        if action in ("deleted", "stopped", "shutdown"):
+            self.logger.info("drift on %s/%s: %s", key[0].value, key[1], action, extra={"event": {"action": "drift", "resource": key[0].value, "name": key[1], "state": action}})
+            with self.condition:
+                self.dirty.add(key)
+                self.last_event = time.monotonic()
+                self.condition.notify()
+
+    def reconcile(self, keys: Optional[set] = None) -> None:
+        """
+        Creates the given resources if they don't exist, and starts the instances among them if they're not running.
+
+        :param keys: the keys of the resources to reconcile, defaults to the whole stack
+        """
+
+        graph = {key: node for key, node in self.graph.items() if keys is None or key in keys}
+        with self.client.snapshot():
+            execute(graph, lambda node: self.client.create(node.resource, node.config), self.jobs)
+            instances = [node for node in graph.values() if node.resource == Resource.INSTANCES]
+            self.client.wait_all([self.client.start(node.name, wait=False) for node in instances])
+        for key in graph:
+            self.state[key] = "running" if key[0] == Resource.INSTANCES else "present"
+
+    def listen(self) -> None:
+        """
+        Feeds the events to the model until the Watcher is stopped, reconnecting (and marking the whole stack as dirty, as events may have been missed) on failure.
+        """
+
+        delay = 1
+        while not self.stopped.is_set():
+            stream = EventStream(self.client)
+            try:
+                stream.connect()
+                delay = 1
+                for event in stream:
+                    self.handle(event)
+            except (OSError, ValueError) as error:
+                self.logger.warning("event stream failure (%s), reconnecting in %ss", error, delay)
+            finally:
+                stream.close()
+
+            with self.condition:
+                self.dirty.update(self.graph)
+                self.last_event = time.monotonic()
+                self.condition.notify()
+            self.stopped.wait(delay)
+            delay = min(delay * 2, 60)
+
+    def run(self) -> None:
+        """
+        Reconciles the whole stack, then only the resources that drift, until the Watcher is stopped.
+        """
+
+        threading.Thread(target=self.listen, daemon=True).start()  # first, so that no drift is missed during the initial reconciliation
+        self.reconcile()
+
+        last_reconciliation = time.monotonic()
+        while not self.stopped.is_set():
+            with self.condition:
+                while not self.dirty and not self.stopped.is_set():
+                    self.condition.wait(1)
+
+                # debounce: waits for the events to calm down, and rate limit: waits for the minimum interval
+                while not self.stopped.is_set():
+                    remaining = max(self.last_event + self.debounce, last_reconciliation + self.interval) - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+
+                keys, self.dirty = self.dirty, set()
+
+            if keys and not self.stopped.is_set():
+                try:
+                    self.reconcile(keys)
+                except Exception as error:
+                    self.logger.warning("reconciliation failure (%s), will retry", error)
+                    with self.condition:
+                        self.dirty.update(keys)
+                last_reconciliation = time.monotonic()
+
+    def stop(self) -> None:
+        """
+        Stops the Watcher.
+        """
+
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify()